@@ -0,0 +1 @@
+__gittag__ = 'dev'
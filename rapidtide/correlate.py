@@ -31,6 +31,7 @@ from sklearn.metrics import mutual_info_score, normalized_mutual_info_score, adj
 
 import rapidtide.util as tide_util
 import rapidtide.resample as tide_resample
+import rapidtide.filter as tide_filt
 import rapidtide.fit as tide_fit
 import rapidtide.miscmath as tide_math
 
@@ -366,6 +367,43 @@ def cepstraldelay(data1, data2, timestep, displayplots=True):
     return timestep * np.argmax(residual_cepstrum.real[0:len(residual_cepstrum) // 2])
 
 
+def corrnormalizerows(thedata, prewindow=True, detrendorder=1, windowfunc='hamming'):
+    """
+    Apply miscmath.corrnormalize to every row of thedata at once.
+
+    Parameters
+    ----------
+    thedata: 2D array
+        The timecourses to normalize, one per row
+    prewindow: bool, optional
+        Apply a window function after detrending.  Default is True.
+    detrendorder: int, optional
+        Order of the polynomial to remove from each row.  Default is 1.
+    windowfunc: str, optional
+        The window function to use.  Default is 'hamming'.
+
+    Returns
+    -------
+    normdata: 2D array
+        The normalized timecourses
+    """
+    thedata = np.asarray(thedata, dtype=np.float64)
+    numpoints = thedata.shape[1]
+
+    def _stdnormalizerows(thevecs):
+        demeaned = thevecs - np.mean(thevecs, axis=1)[:, None]
+        sigstd = np.std(demeaned, axis=1)
+        return demeaned / np.where(sigstd > 0.0, sigstd, 1.0)[:, None]
+
+    if detrendorder > 0:
+        intervecs = _stdnormalizerows(tide_fit.detrend_batch(thedata, order=detrendorder, demean=True))
+    else:
+        intervecs = _stdnormalizerows(thedata)
+    if prewindow:
+        intervecs = tide_filt.windowfunction(numpoints, type=windowfunc)[None, :] * intervecs
+    return _stdnormalizerows(intervecs) / np.sqrt(numpoints)
+
+
 class aliasedcorrelator:
 
     def __init__(self, hiressignal, hires_Fs, lores_Fs, timerange, hiresstarttime=0.0, loresstarttime=0.0, padvalue=30.0):
@@ -392,7 +430,33 @@ class aliasedcorrelator:
         self.highresaxis = np.arange(0.0, len(self.hiressignal)) * (1.0 / self.hires_Fs) - self.hiresstarttime
         self.padvalue = padvalue
         self.tcgenerator = tide_resample.fastresampler(self.highresaxis, self.hiressignal, padvalue=self.padvalue)
-        self.aliasedsignals = {}
+        self.aliasedmatrices = {}
+
+    def aliasedmatrix(self, numpoints, extraoffset):
+        """
+
+        Parameters
+        ----------
+        numpoints: int
+            The length of the aliased waveform to match
+        extraoffset: float
+            Additional offset to apply to hiressignal (e.g. for slice offset)
+
+        Returns
+        -------
+        aliasedmatrix: 2D array
+            The (len(timerange) x numpoints) matrix of normalized, aliased hires waveforms, one row per delay.
+            Matrices are cached, so this is only calculated once for each extraoffset.
+        """
+        thekey = (numpoints, extraoffset)
+        try:
+            return self.aliasedmatrices[thekey]
+        except KeyError:
+            loresaxis = np.arange(0.0, numpoints) * (1.0 / self.lores_Fs) - self.loresstarttime
+            theoffsets = self.timerange + extraoffset
+            self.aliasedmatrices[thekey] = corrnormalizerows(
+                self.tcgenerator.yfromx(loresaxis[None, :] + theoffsets[:, None]))
+            return self.aliasedmatrices[thekey]
 
     def apply(self, loressignal, extraoffset):
         """
@@ -409,21 +473,26 @@ class aliasedcorrelator:
         corrfunc: 1D array
             The correlation function evaluated at timepoints of timerange
         """
-        loresaxis = np.arange(0.0, len(loressignal)) * (1.0 / self.lores_Fs) - self.loresstarttime
         targetsignal = tide_math.corrnormalize(loressignal)
-        corrfunc = self.timerange * 0.0
-        for i in range(len(self.timerange)):
-            theoffset = self.timerange[i] + extraoffset
-            offsetkey = "{:.3f}".format(theoffset)
-            try:
-                aliasedhiressignal = self.aliasedsignals[offsetkey]
-                #print(offsetkey, ' - cache hit')
-            except KeyError:
-                #print(offsetkey, ' - cache miss')
-                self.aliasedsignals[offsetkey] = tide_math.corrnormalize(self.tcgenerator.yfromx(loresaxis + theoffset))
-                aliasedhiressignal = self.aliasedsignals[offsetkey]
-            corrfunc[i] = np.dot(aliasedhiressignal, targetsignal)
-        return corrfunc
+        return np.dot(self.aliasedmatrix(len(loressignal), extraoffset), targetsignal)
+
+    def applybatch(self, loressignals, extraoffset):
+        """
+
+        Parameters
+        ----------
+        loressignals: 2D array
+            The aliased waveforms to match, one per row
+        extraoffset: float
+            Additional offset to apply to hiressignal (e.g. for slice offset)
+
+        Returns
+        -------
+        corrfuncs: 2D array
+            The correlation functions evaluated at timepoints of timerange, one per row
+        """
+        targetsignals = corrnormalizerows(loressignals)
+        return np.dot(targetsignals, self.aliasedmatrix(np.shape(loressignals)[1], extraoffset).T)
 
 
 def aliasedcorrelate(hiressignal, hires_Fs, lowressignal, lowres_Fs, timerange, hiresstarttime=0.0, lowresstarttime=0.0, padvalue=30.0):
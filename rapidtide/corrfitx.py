@@ -34,6 +34,16 @@ import rapidtide.fit as tide_fit
 import rapidtide.multiproc as tide_multiproc
 import rapidtide.util as tide_util
 
+# fit failure bits, as reported in the fail image
+FML_BADAMPLOW = np.uint16(0x01)
+FML_BADAMPHIGH = np.uint16(0x02)
+FML_BADSEARCHWINDOW = np.uint16(0x04)
+FML_BADWIDTH = np.uint16(0x08)
+FML_BADLAG = np.uint16(0x10)
+FML_HITEDGE = np.uint16(0x20)
+FML_FITFAIL = np.uint16(0x40)
+FML_INITFAIL = np.uint16(0x80)
+
 
 def onecorrfitx(correlationfunc,
                 thefitter,
@@ -158,6 +168,114 @@ def _procOneVoxelFitcorrx(vox,
            thewindowout, theR2, maskval, failreason
 
 
+def _procVoxelBlockFitcorrx(corr_ys,
+                            lagtcgenerator,
+                            timeaxis,
+                            thefitter,
+                            initiallags=None,
+                            rt_floatset=np.float64,
+                            rt_floattype='float64'):
+    # the block equivalent of onecorrfitx and _procOneVoxelFitcorrx for gaussian fits
+    thefitter.setlthresh(0.0)
+    if initiallags is not None:
+        thefitter.setguess(True)
+    else:
+        thefitter.setguess(False)
+    maxindex, maxlag, maxval, maxsigma, maskval, failreason, peakstart, peakend = \
+        thefitter.fit_batch(corr_ys, maxguesses=initiallags)
+
+    thelagtcs = rt_floatset(lagtcgenerator.yfromx(timeaxis[None, :] - maxlag[:, None]))
+
+    # bad fits keep their search windows, good ones get their fitted gaussians
+    bad = (maskval == 0) & thefitter.zerooutbadfit
+    lagindices = np.arange(np.shape(corr_ys)[1])[None, :]
+    thewindowouts = rt_floatset((lagindices >= peakstart[:, None]) & (lagindices <= peakend[:, None]))
+    thewindowouts[~bad, :] = 0.0
+    thetimes = rt_floatset(np.where(bad, 0.0, np.fmod(maxlag, thefitter.lagmod)))
+    thestrengths = rt_floatset(np.where(bad, 0.0, maxval))
+    thesigmas = rt_floatset(np.where(bad, 0.0, maxsigma))
+    thegaussouts = np.zeros(np.shape(corr_ys), dtype=rt_floattype)
+    dogauss = (~bad) & (maxsigma != 0.0)
+    if np.any(dogauss):
+        thegaussouts[dogauss, :] = tide_fit.gauss_eval(thefitter.corrtimeaxis[None, :],
+                                                       [maxval[dogauss][:, None],
+                                                        maxlag[dogauss][:, None],
+                                                        maxsigma[dogauss][:, None]])
+    theR2s = thestrengths * thestrengths
+
+    return np.sum(~bad), thelagtcs, thetimes, thestrengths, thesigmas, thegaussouts, \
+           thewindowouts, theR2s, maskval, failreason
+
+
+def _fitcorrblock(val, state):
+    # fit a block of voxels, writing the results straight into the (shared) output arrays in state
+    if state['initiallags'] is None:
+        theselags = None
+    else:
+        theselags = state['initiallags'][val]
+    thefitter = state['thefitter']
+    if (not state['fixdelay']) and (thefitter.findmaxtype == 'gauss'):
+        volumetotalinc, \
+        state['lagtc'][val, :], \
+        state['lagtimes'][val], \
+        state['lagstrengths'][val], \
+        state['lagsigma'][val], \
+        state['gaussout'][val, :], \
+        state['windowout'][val, :], \
+        state['R2'][val], \
+        state['lagmask'][val], \
+        failreasons = \
+            _procVoxelBlockFitcorrx(state['corrout'][val, :],
+                                    state['lagtcgenerator'],
+                                    state['timeaxis'],
+                                    thefitter,
+                                    initiallags=theselags,
+                                    rt_floatset=state['rt_floatset'],
+                                    rt_floattype=state['rt_floattype'])
+    else:
+        volumetotalinc = 0
+        failreasons = np.zeros(len(val), dtype=np.uint16)
+        for i in range(len(val)):
+            if theselags is None:
+                thislag = None
+            else:
+                thislag = theselags[i]
+            dummy, \
+            thisvolumetotalinc, \
+            state['lagtc'][val[i], :], \
+            state['lagtimes'][val[i]], \
+            state['lagstrengths'][val[i]], \
+            state['lagsigma'][val[i]], \
+            state['gaussout'][val[i], :], \
+            state['windowout'][val[i], :], \
+            state['R2'][val[i]], \
+            state['lagmask'][val[i]], \
+            failreasons[i] = \
+                _procOneVoxelFitcorrx(val[i],
+                                      state['corrout'][val[i], :],
+                                      state['lagtcgenerator'],
+                                      state['timeaxis'],
+                                      thefitter,
+                                      disablethresholds=False,
+                                      despeckle_thresh=state['despeckle_thresh'],
+                                      initiallag=thislag,
+                                      fixdelay=state['fixdelay'],
+                                      rt_floatset=state['rt_floatset'],
+                                      rt_floattype=state['rt_floattype'])
+            volumetotalinc += thisvolumetotalinc
+    state['failimage'][val] = failreasons & 0x3f
+
+    # just send back the counts
+    return (len(val),
+            volumetotalinc,
+            np.sum(((FML_BADAMPLOW | FML_BADAMPHIGH) & failreasons) > 0),
+            np.sum((FML_BADSEARCHWINDOW & failreasons) > 0),
+            np.sum((FML_BADWIDTH & failreasons) > 0),
+            np.sum((FML_BADLAG & failreasons) > 0),
+            np.sum((FML_HITEDGE & failreasons) > 0),
+            np.sum(((FML_FITFAIL | FML_INITFAIL) & failreasons) > 0))
+
+
 def fitcorrx(lagtcgenerator,
             timeaxis,
             lagtc,
@@ -176,6 +294,9 @@ def fitcorrx(lagtcgenerator,
             fixdelay=False,
             showprogressbar=True,
             chunksize=1000,
+            batchsize=1000,
+            usesharedmem=False,
+            thepool=None,
             despeckle_thresh=5.0,
             initiallags=None,
             rt_floatset=np.float64,
@@ -189,18 +310,43 @@ def fitcorrx(lagtcgenerator,
         themask = np.where(initiallags > -1000000.0, 1, 0)
     reportstep = 1000
     volumetotal, ampfails, lagfails, windowfails, widthfails, edgefails, fitfails = 0, 0, 0, 0, 0, 0, 0
-    FML_BADAMPLOW = np.uint16(0x01)
-    FML_BADAMPHIGH = np.uint16(0x02)
-    FML_BADSEARCHWINDOW = np.uint16(0x04)
-    FML_BADWIDTH = np.uint16(0x08)
-    FML_BADLAG = np.uint16(0x10)
-    FML_HITEDGE = np.uint16(0x20)
-    FML_FITFAIL = np.uint16(0x40)
-    FML_INITFAIL = np.uint16(0x80)
     zerolagtc = rt_floatset(lagtcgenerator.yfromx(timeaxis))
     sliceoffsettime = 0.0
 
-    if nprocs > 1:
+    if nprocs > 1 and usesharedmem and batchsize > 1:
+        state = {'corrout': corrout,
+                 'lagtc': lagtc,
+                 'lagtimes': lagtimes,
+                 'lagstrengths': lagstrengths,
+                 'lagsigma': lagsigma,
+                 'gaussout': gaussout,
+                 'windowout': windowout,
+                 'R2': R2,
+                 'lagmask': lagmask,
+                 'failimage': failimage,
+                 'lagtcgenerator': lagtcgenerator,
+                 'timeaxis': timeaxis,
+                 'thefitter': thefitter,
+                 'initiallags': initiallags,
+                 'fixdelay': fixdelay,
+                 'despeckle_thresh': despeckle_thresh,
+                 'rt_floatset': rt_floatset,
+                 'rt_floattype': rt_floattype}
+        tokens = tide_multiproc.run_blockfunc(_fitcorrblock, state,
+                                              inputshape, themask,
+                                              nprocs=nprocs,
+                                              thepool=thepool,
+                                              showprogressbar=showprogressbar,
+                                              rangesize=batchsize)
+        for thetoken in tokens:
+            volumetotal += thetoken[1]
+            ampfails += thetoken[2]
+            windowfails += thetoken[3]
+            widthfails += thetoken[4]
+            lagfails += thetoken[5]
+            edgefails += thetoken[6]
+            fitfails += thetoken[7]
+    elif nprocs > 1:
         # define the consumer function here so it inherits most of the arguments
         def fitcorr_consumer(inQ, outQ):
             while True:
@@ -265,6 +411,44 @@ def fitcorrx(lagtcgenerator,
             if (FML_FITFAIL | FML_INITFAIL) & voxel[10]:
                 fitfails += 1
         del data_out
+    elif (batchsize > 1) and (not fixdelay) and (thefitter.findmaxtype == 'gauss'):
+        if themask is None:
+            voxlist = np.arange(inputshape[0])
+        else:
+            voxlist = np.where(themask > 0)[0]
+        for startidx in range(0, len(voxlist), batchsize):
+            thevoxels = voxlist[startidx:startidx + batchsize]
+            if showprogressbar:
+                tide_util.progressbar(startidx + len(thevoxels), len(voxlist), label='Percent complete')
+            if initiallags is None:
+                theselags = None
+            else:
+                theselags = initiallags[thevoxels]
+            volumetotalinc, \
+            lagtc[thevoxels, :], \
+            lagtimes[thevoxels], \
+            lagstrengths[thevoxels], \
+            lagsigma[thevoxels], \
+            gaussout[thevoxels, :], \
+            windowout[thevoxels, :], \
+            R2[thevoxels], \
+            lagmask[thevoxels], \
+            failreasons = \
+                _procVoxelBlockFitcorrx(corrout[thevoxels, :],
+                                        lagtcgenerator,
+                                        timeaxis,
+                                        thefitter,
+                                        initiallags=theselags,
+                                        rt_floatset=rt_floatset,
+                                        rt_floattype=rt_floattype)
+            failimage[thevoxels] = failreasons & 0x3f
+            volumetotal += volumetotalinc
+            ampfails += np.sum(((FML_BADAMPLOW | FML_BADAMPHIGH) & failreasons) > 0)
+            windowfails += np.sum((FML_BADSEARCHWINDOW & failreasons) > 0)
+            widthfails += np.sum((FML_BADWIDTH & failreasons) > 0)
+            lagfails += np.sum((FML_BADLAG & failreasons) > 0)
+            edgefails += np.sum((FML_HITEDGE & failreasons) > 0)
+            fitfails += np.sum(((FML_FITFAIL | FML_INITFAIL) & failreasons) > 0)
     else:
         for vox in range(0, inputshape[0]):
             if (vox % reportstep == 0 or vox == inputshape[0] - 1) and showprogressbar:
@@ -53,11 +53,15 @@ def _procOneVoxelCorrelation(vox,
                              os_fmri_x,
                              oversampfactor=1,
                              interptype='univariate',
+                             theresampmatrix=None,
                              rt_floatset=np.float64,
                              rt_floattype='float64'
                              ):
     if oversampfactor >= 1:
-        thetc[:] = tide_resample.doresample(fmri_x, fmritc, os_fmri_x, method=interptype)
+        if theresampmatrix is None:
+            thetc[:] = tide_resample.doresample(fmri_x, fmritc, os_fmri_x, method=interptype)
+        else:
+            thetc[:] = theresampmatrix @ fmritc
     else:
         thetc[:] = fmritc
     thexcorr_y, thexcorr_x, theglobalmax = thecorrelator.run(thetc)
@@ -65,6 +69,41 @@ def _procOneVoxelCorrelation(vox,
     return vox, np.mean(thetc), thexcorr_y, thexcorr_x, theglobalmax
 
 
+def _procVoxelBlockCorrelation(thecorrelator,
+                               fmri_x,
+                               fmritcs,
+                               os_fmri_x,
+                               oversampfactor=1,
+                               interptype='univariate',
+                               theresampmatrix=None,
+                               rt_floatset=np.float64,
+                               rt_floattype='float64'
+                               ):
+    if oversampfactor >= 1:
+        thetcs = tide_resample.batchresample(fmri_x, fmritcs, os_fmri_x, method=interptype,
+                                             theresampmatrix=theresampmatrix).astype(rt_floattype)
+    else:
+        thetcs = fmritcs
+    thexcorrs_y, thexcorr_x, theglobalmaxes = thecorrelator.run_batch(thetcs)
+
+    return np.mean(thetcs, axis=1), thexcorrs_y, thexcorr_x, theglobalmaxes
+
+
+def _correlationblock(val, state):
+    # process a block of voxels, writing the results straight into the (shared) output arrays in state
+    state['meanval'][val], state['corrout'][val, :], dummy, theglobalmaxes = \
+        _procVoxelBlockCorrelation(state['thecorrelator'],
+                                   state['fmri_x'],
+                                   state['fmridata'][val, :],
+                                   state['os_fmri_x'],
+                                   oversampfactor=state['oversampfactor'],
+                                   interptype=state['interptype'],
+                                   theresampmatrix=state['theresampmatrix'],
+                                   rt_floatset=state['rt_floatset'],
+                                   rt_floattype=state['rt_floattype'])
+    return len(val), val, theglobalmaxes
+
+
 def correlationpass(fmridata,
                     referencetc,
                     thecorrelator,
@@ -80,6 +119,9 @@ def correlationpass(fmridata,
                     interptype='univariate',
                     showprogressbar=True,
                     chunksize=1000,
+                    batchsize=1000,
+                    usesharedmem=False,
+                    thepool=None,
                     rt_floatset=np.float64,
                     rt_floattype='float64'):
     """
@@ -102,6 +144,13 @@ def correlationpass(fmridata,
     interptype
     showprogressbar
     chunksize
+    batchsize : int
+        Number of voxels to correlate at once.  Values less than 2 correlate one voxel at a time.
+    usesharedmem : bool
+        The output arrays (corrout and meanval) are in shared memory, so worker processes can write their
+        results into them directly, batchsize voxels at a time.
+    thepool : workerpool, optional
+        A persistent pool of worker processes to use instead of starting new ones.
     rt_floatset
     rt_floattype
 
@@ -111,13 +160,45 @@ def correlationpass(fmridata,
     """
     thecorrelator.setreftc(referencetc)
     thecorrelator.setlimits(lagmininpts, lagmaxinpts)
+    if thecorrelator.lagrangemethod is not None:
+        print('calculating lag range only, using', thecorrelator.lagrangemethod, 'correlation')
+
+    # all the voxels share the same time axes, so make the resampling operator once
+    if oversampfactor >= 1:
+        theresampmatrix = tide_resample.resamplematrix(fmri_x, os_fmri_x, method=interptype)
+    else:
+        theresampmatrix = None
 
     inputshape = np.shape(fmridata)
     volumetotal = 0
     reportstep = 1000
     thetc = np.zeros(np.shape(os_fmri_x), dtype=rt_floattype)
     theglobalmaxlist = []
-    if nprocs > 1:
+    if nprocs > 1 and usesharedmem and batchsize > 1:
+        state = {'fmridata': fmridata,
+                 'corrout': corrout,
+                 'meanval': meanval,
+                 'thecorrelator': thecorrelator,
+                 'fmri_x': fmri_x,
+                 'os_fmri_x': os_fmri_x,
+                 'oversampfactor': oversampfactor,
+                 'interptype': interptype,
+                 'theresampmatrix': theresampmatrix,
+                 'rt_floatset': rt_floatset,
+                 'rt_floattype': rt_floattype}
+        tokens = tide_multiproc.run_blockfunc(_correlationblock, state,
+                                              inputshape, None,
+                                              nprocs=nprocs,
+                                              thepool=thepool,
+                                              showprogressbar=showprogressbar,
+                                              rangesize=batchsize)
+        theglobalmaxes = np.zeros(inputshape[0], dtype=np.int64)
+        for thetoken in tokens:
+            volumetotal += thetoken[0]
+            theglobalmaxes[thetoken[1]] = thetoken[2]
+        theglobalmaxlist = list(theglobalmaxes)
+        dummy, thecorrscale, dummy = thecorrelator.getcorrelation()
+    elif nprocs > 1:
         # define the consumer function here so it inherits most of the arguments
         def correlation_consumer(inQ, outQ):
             while True:
@@ -138,6 +219,7 @@ def correlationpass(fmridata,
                                                       os_fmri_x,
                                                       oversampfactor=oversampfactor,
                                                       interptype=interptype,
+                                                      theresampmatrix=theresampmatrix,
                                                       rt_floatset=rt_floatset,
                                                       rt_floattype=rt_floattype))
 
@@ -161,6 +243,23 @@ def correlationpass(fmridata,
             theglobalmaxlist.append(voxel[4] + 0)
             volumetotal += 1
         del data_out
+    elif batchsize > 1:
+        for startvox in range(0, inputshape[0], batchsize):
+            endvox = min(startvox + batchsize, inputshape[0])
+            if showprogressbar:
+                tide_util.progressbar(endvox, inputshape[0], label='Percent complete')
+            meanval[startvox:endvox], corrout[startvox:endvox, :], thecorrscale, theglobalmaxes = \
+                _procVoxelBlockCorrelation(thecorrelator,
+                                           fmri_x,
+                                           fmridata[startvox:endvox, :],
+                                           os_fmri_x,
+                                           oversampfactor=oversampfactor,
+                                           interptype=interptype,
+                                           theresampmatrix=theresampmatrix,
+                                           rt_floatset=rt_floatset,
+                                           rt_floattype=rt_floattype)
+            theglobalmaxlist += list(theglobalmaxes)
+            volumetotal += endvox - startvox
     else:
         for vox in range(0, inputshape[0]):
             if (vox % reportstep == 0 or vox == inputshape[0] - 1) and showprogressbar:
@@ -173,6 +272,7 @@ def correlationpass(fmridata,
                                                                                           os_fmri_x,
                                                                                           oversampfactor=oversampfactor,
                                                                                           interptype=interptype,
+                                                                                          theresampmatrix=theresampmatrix,
                                                                                           rt_floatset=rt_floatset,
                                                                                           rt_floattype=rt_floattype
                                                                                           )
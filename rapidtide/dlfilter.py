@@ -27,7 +27,6 @@ import numpy as np
 import os
 import sys
 from statsmodels.robust.scale import mad
-import glob
 from scipy import fftpack
 
 try:
@@ -40,6 +39,8 @@ except ImportError:
     pyfftwexists = False
 
 import rapidtide.io as tide_io
+from rapidtide.dlfilterdata import tobadpts, targettoinput, getmatchedfiles, datacachename, readindata
+import rapidtide.npdlfilter as tide_npdlfilt
 
 try:
     import plaidml.keras
@@ -111,6 +112,8 @@ class dlfilter:
                  readlim=None,
                  readskip=None,
                  countlim=None,
+                 nprocs=1,
+                 cachedir=None,
                  **kwargs):
 
         self.window_size = window_size
@@ -136,6 +139,8 @@ class dlfilter:
         self.readlim = readlim
         self.readskip = readskip
         self.countlim = countlim
+        self.nprocs = nprocs
+        self.cachedir = cachedir
         self.model = None
         self.initialized = False
         self.trained = False
@@ -184,7 +189,9 @@ class dlfilter:
                 excludebysubject=self.excludebysubject,
                 readlim=self.readlim,
                 readskip=self.readskip,
-                countlim=self.countlim)
+                countlim=self.countlim,
+                nprocs=self.nprocs,
+                cachedir=self.cachedir)
         else:
             self.train_x, self.train_y, self.val_x, self.val_y, self.Ns, self.tclen, self.thebatchsize = prep(
                 self.window_size,
@@ -202,7 +209,9 @@ class dlfilter:
                 excludebysubject=self.excludebysubject,
                 readlim=self.readlim,
                 readskip=self.readskip,
-                countlim=self.countlim)
+                countlim=self.countlim,
+                nprocs=self.nprocs,
+                cachedir=self.cachedir)
 
     def evaluate(self):
         self.lossfilename = os.path.join(self.modelname, 'loss.png')
@@ -264,6 +273,9 @@ class dlfilter:
         if usehdf:
             # save the trained model as a single hdf file
             self.model.save(os.path.join(self.modelname, 'model.h5'))
+
+            # and export the weights for keras-free inference
+            tide_npdlfilt.exportmodel(self.model, os.path.join(self.modelname, tide_npdlfilt.npzmodelname))
         else:
             # save the model structure to JSON
             model_json = self.model.to_json()
@@ -337,31 +349,8 @@ class dlfilter:
         self.trained = True
 
     def apply(self, inputdata, badpts=None):
-        initscale = mad(inputdata)
-        scaleddata = inputdata / initscale
-        predicteddata = scaleddata * 0.0
-        weightarray = scaleddata * 0.0
-        N_pts = len(scaleddata)
-        if self.usebadpts:
-            if badpts is None:
-                badpts = scaleddata * 0.0
-            X = np.zeros(((N_pts - self.window_size - 1), self.window_size, 2))
-            for i in range(X.shape[0]):
-                X[i, :, 0] = scaleddata[i:i + self.window_size]
-                X[i, :, 1] = badpts[i:i + self.window_size]
-        else:
-            X = np.zeros(((N_pts - self.window_size - 1), self.window_size, 1))
-            for i in range(X.shape[0]):
-                X[i, :, 0] = scaleddata[i:i + self.window_size]
-
-        Y = self.model.predict(X)
-        for i in range(X.shape[0]):
-            predicteddata[i:i + self.window_size] += Y[i, :, 0]
-
-        weightarray[:] = self.window_size
-        weightarray[0:self.window_size] = np.linspace(1.0, self.window_size, self.window_size, endpoint=False)
-        weightarray[-(self.window_size + 1):-1] = np.linspace(self.window_size, 1.0, self.window_size, endpoint=False)
-        return initscale * predicteddata / weightarray
+        """Filter one or more timecourses with the trained model - see npdlfilter.applymodel."""
+        return tide_npdlfilt.applymodel(self.model, self.window_size, self.usebadpts, inputdata, badpts=badpts)
 
 
 class cnn(dlfilter):
@@ -837,139 +826,6 @@ def filtscale(data, scalefac=1.0, reverse=False, hybrid=False, lognormalize=True
             return fftpack.ifft(specvals).real
 
 
-def tobadpts(name):
-    return name.replace('.txt', '_badpts.txt')
-
-
-def targettoinput(name, targetfrag='xyz', inputfrag='abc', debug=False):
-    if debug:
-        print('replacing', targetfrag, 'with', inputfrag)
-    return name.replace(targetfrag, inputfrag)
-
-
-def getmatchedfiles(searchstring, usebadpts=False, targetfrag='xyz', inputfrag='abc', debug=False):
-    # list all of the target files
-    fromfile = sorted(glob.glob(searchstring))
-    if debug:
-        print('searchstring:', searchstring, '->', fromfile)
-
-    # make sure all files exist
-    matchedfilelist = []
-    for targetname in fromfile:
-        if os.path.isfile(targettoinput(targetname, targetfrag=targetfrag, inputfrag=inputfrag, debug=debug)):
-            if usebadpts:
-                if os.path.isfile(tobadpts(targetname.replace('alignedpleth', 'pleth'))) \
-                        and os.path.isfile(
-                            tobadpts(targettoinput(targetname, targetfrag=targetfrag, inputfrag=inputfrag, debug=debug))):
-                                matchedfilelist.append(targetname)
-                                if debug:
-                                    print(matchedfilelist[-1])
-            else:
-                matchedfilelist.append(targetname)
-                if debug:
-                    print(matchedfilelist[-1])
-    if usebadpts:
-        print(len(matchedfilelist), 'runs pass all 4 files present check')
-    else:
-        print(len(matchedfilelist), 'runs pass both files present check')
-
-    # find out how long the files are
-    tempy = np.loadtxt(matchedfilelist[0])
-    tempx = np.loadtxt(targettoinput(matchedfilelist[0], targetfrag=targetfrag, inputfrag=inputfrag, debug=debug))
-    tclen = np.min([tempx.shape[0], tempy.shape[0]])
-    print('tclen set to', tclen)
-    return matchedfilelist, tclen
-
-
-def readindata(matchedfilelist, tclen, targetfrag='xyz', inputfrag='abc', usebadpts=False,
-               startskip=0, endskip=0,
-               readlim=None, readskip=None, debug=False):
-    print('readindata called with usebadpts, startskip, endskip, readlim, readskip, targetfrag, inputfrag =',
-          usebadpts, startskip, endskip, readlim, readskip, targetfrag, inputfrag)
-    # allocate target arrays
-    print('allocating arrays')
-    s = len(matchedfilelist[readskip:])
-    if readlim is not None:
-        if s > readlim:
-            print('trimming read list to', readlim, 'from', s)
-            s = readlim
-    x1 = np.zeros((tclen, s))
-    y1 = np.zeros((tclen, s))
-    names = []
-    if usebadpts:
-        bad1 = np.zeros((tclen, s))
-
-    # now read the data in
-    count = 0
-    print('checking data')
-    nanfiles = []
-    shortfiles = []
-    strangemagfiles = []
-    for i in range(readskip, readskip + s):
-        nanfound = False
-        print('processing ', matchedfilelist[i])
-        tempy = np.loadtxt(matchedfilelist[i])
-        tempx = np.loadtxt(targettoinput(matchedfilelist[i], targetfrag=targetfrag, inputfrag=inputfrag, debug=debug))
-        if np.any(np.isnan(tempy)):
-            print('NaN found in file', matchedfilelist[i], '- discarding')
-            nanfound = True
-            nanfiles.append(matchedfilelist[i])
-        if np.any(np.isnan(tempx)):
-            print('NaN found in file', targettoinput(matchedfilelist[i], targetfrag=targetfrag, inputfrag=inputfrag), '- discarding')
-            nanfound = True
-            nanfiles.append(targettoinput(matchedfilelist[i], targetfrag=targetfrag, inputfrag=inputfrag))
-        strangefound = False
-        if not (0.5 < np.std(tempx) < 20.0):
-            print('file', targettoinput(matchedfilelist[i], targetfrag=targetfrag, inputfrag=inputfrag),
-                 'has an extreme standard deviation - discarding')
-            strangefound = True
-            strangemagfiles.append(targettoinput(matchedfilelist[i], targetfrag=targetfrag, inputfrag=inputfrag))
-        if not (0.5 < np.std(tempy) < 20.0):
-            print('file', matchedfilelist[i], 'has an extreme standard deviation - discarding')
-            strangefound = True
-            strangemagfiles.append(matchedfilelist[i])
-        shortfound = False
-        ntempx = tempx.shape[0]
-        ntempy = tempy.shape[0]
-        if ntempx < tclen:
-            print('file', targettoinput(matchedfilelist[i], targetfrag=targetfrag, inputfrag=inputfrag), 'is short - discarding')
-            shortfound = True
-            shortfiles.append(targettoinput(matchedfilelist[i], targetfrag=targetfrag, inputfrag=inputfrag))
-        if ntempy < tclen:
-            print('file', matchedfilelist[i], 'is short - discarding')
-            shortfound = True
-            shortfiles.append(matchedfilelist[i])
-        if (ntempx >= tclen) and (ntempy >= tclen) and (not nanfound) and (not shortfound) and (not strangefound):
-            x1[:tclen, count] = tempx[:tclen]
-            y1[:tclen, count] = tempy[:tclen]
-            names.append(matchedfilelist[i])
-            if usebadpts:
-                tempbad1 = np.loadtxt(tobadpts(matchedfilelist[i].replace('alignedpleth', 'pleth')))
-                tempbad2 = np.loadtxt(tobadpts(
-                    targettoinput(matchedfilelist[i], targetfrag=targetfrag, inputfrag=inputfrag, debug=debug)))
-                bad1[:tclen, count] = 1.0 - (1.0 - tempbad1[:tclen]) * (1.0 - tempbad2[:tclen])
-            count += 1
-    print(count, 'runs pass file length check')
-    if len(nanfiles) > 0:
-        print('files with NaNs:')
-        for thefile in nanfiles:
-            print('\t', thefile)
-    if len(shortfiles) > 0:
-        print('short files:')
-        for thefile in shortfiles:
-            print('\t', thefile)
-    if len(strangemagfiles) > 0:
-        print('files with extreme standard deviations:')
-        for thefile in strangemagfiles:
-            print('\t', thefile)
-
-    if usebadpts:
-        return x1[startskip:-endskip, :count], y1[startskip:-endskip, :count], names[:count], bad1[startskip:-endskip,
-                                                                                              :count]
-    else:
-        return x1[startskip:-endskip, :count], y1[startskip:-endskip, :count], names[:count]
-
-
 def prep(window_size,
          step=1,
          excludethresh=4.0,
@@ -985,7 +841,9 @@ def prep(window_size,
          debug=False,
          readlim=None,
          readskip=None,
-         countlim=None):
+         countlim=None,
+         nprocs=1,
+         cachedir=None):
     '''
     prep - reads in training and validation data for 1D filter
 
@@ -1007,6 +865,8 @@ def prep(window_size,
     readlim
     readskip
     countlim
+    nprocs
+    cachedir
 
     Returns
     -------
@@ -1026,12 +886,14 @@ def prep(window_size,
                                       targetfrag=targetfrag, inputfrag=inputfrag,
                                       usebadpts=True,
                                       startskip=startskip, endskip=endskip,
-                                      readlim=readlim, readskip=readskip, debug=debug)
+                                      readlim=readlim, readskip=readskip,
+                                      nprocs=nprocs, cachedir=cachedir, debug=debug)
     else:
         x, y, names = readindata(matchedfilelist, tclen,
                                  targetfrag=targetfrag, inputfrag=inputfrag,
                                  startskip=startskip, endskip=endskip,
-                                 readlim=readlim, readskip=readskip, debug=debug)
+                                 readlim=readlim, readskip=readskip,
+                                 nprocs=nprocs, cachedir=cachedir, debug=debug)
     print('xshape, yshape:', x.shape, y.shape)
 
     # normalize input and output data
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Reading and checking the paired timecourse files used to train the deep learning filters.
+
+None of this needs keras, so the training data can be prepared (and cached) on machines without it.
+"""
+
+from __future__ import print_function, division
+
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import rapidtide.io as tide_io
+import rapidtide.multiproc as tide_multiproc
+
+
+def tobadpts(name):
+    return name.replace('.txt', '_badpts.txt')
+
+
+def targettoinput(name, targetfrag='xyz', inputfrag='abc', debug=False):
+    if debug:
+        print('replacing', targetfrag, 'with', inputfrag)
+    return name.replace(targetfrag, inputfrag)
+
+
+def getmatchedfiles(searchstring, usebadpts=False, targetfrag='xyz', inputfrag='abc', debug=False):
+    # list all of the target files
+    fromfile = sorted(glob.glob(searchstring))
+    if debug:
+        print('searchstring:', searchstring, '->', fromfile)
+
+    # make sure all files exist
+    matchedfilelist = []
+    for targetname in fromfile:
+        if os.path.isfile(targettoinput(targetname, targetfrag=targetfrag, inputfrag=inputfrag, debug=debug)):
+            if usebadpts:
+                if os.path.isfile(tobadpts(targetname.replace('alignedpleth', 'pleth'))) \
+                        and os.path.isfile(
+                            tobadpts(targettoinput(targetname, targetfrag=targetfrag, inputfrag=inputfrag, debug=debug))):
+                                matchedfilelist.append(targetname)
+                                if debug:
+                                    print(matchedfilelist[-1])
+            else:
+                matchedfilelist.append(targetname)
+                if debug:
+                    print(matchedfilelist[-1])
+    if usebadpts:
+        print(len(matchedfilelist), 'runs pass all 4 files present check')
+    else:
+        print(len(matchedfilelist), 'runs pass both files present check')
+
+    # find out how long the files are
+    tempy = np.loadtxt(matchedfilelist[0])
+    tempx = np.loadtxt(targettoinput(matchedfilelist[0], targetfrag=targetfrag, inputfrag=inputfrag, debug=debug))
+    tclen = np.min([tempx.shape[0], tempy.shape[0]])
+    print('tclen set to', tclen)
+    return matchedfilelist, tclen
+
+
+def _readrunblock(indices, state):
+    # read and check a block of runs, putting the ones that pass into the (shared) output arrays
+    tclen = state['tclen']
+    results = []
+    for i in indices:
+        targetname = state['filelist'][i]
+        if state['debug']:
+            print('processing ', targetname)
+        inputname = targettoinput(targetname, targetfrag=state['targetfrag'], inputfrag=state['inputfrag'],
+                                  debug=state['debug'])
+        tempy = np.loadtxt(targetname)
+        tempx = np.loadtxt(inputname)
+        nanfiles = []
+        shortfiles = []
+        strangemagfiles = []
+        if np.any(np.isnan(tempy)):
+            nanfiles.append(targetname)
+        if np.any(np.isnan(tempx)):
+            nanfiles.append(inputname)
+        if not (0.5 < np.std(tempx) < 20.0):
+            strangemagfiles.append(inputname)
+        if not (0.5 < np.std(tempy) < 20.0):
+            strangemagfiles.append(targetname)
+        if tempx.shape[0] < tclen:
+            shortfiles.append(inputname)
+        if tempy.shape[0] < tclen:
+            shortfiles.append(targetname)
+        passed = (len(nanfiles) + len(shortfiles) + len(strangemagfiles)) == 0
+        if passed:
+            state['x1'][:, i] = tempx[:tclen]
+            state['y1'][:, i] = tempy[:tclen]
+            if state['usebadpts']:
+                tempbad1 = np.loadtxt(tobadpts(targetname.replace('alignedpleth', 'pleth')))
+                tempbad2 = np.loadtxt(tobadpts(inputname))
+                state['bad1'][:, i] = 1.0 - (1.0 - tempbad1[:tclen]) * (1.0 - tempbad2[:tclen])
+        results.append((i, passed, nanfiles, shortfiles, strangemagfiles))
+    return len(indices), results
+
+
+def datacachename(cachedir, filelist, tclen, targetfrag='xyz', inputfrag='abc', usebadpts=False):
+    r"""Return the root name of the cache files for a set of training runs.
+
+    The name depends on everything that determines the contents of the cache: the files, the timecourse
+    length, and how the input and bad point files are found.
+    """
+    thekey = json.dumps([list(filelist), int(tclen), targetfrag, inputfrag, bool(usebadpts)])
+    return os.path.join(cachedir, 'dlfiltercache_' + hashlib.sha1(thekey.encode('utf-8')).hexdigest())
+
+
+def readindata(matchedfilelist, tclen, targetfrag='xyz', inputfrag='abc', usebadpts=False,
+               startskip=0, endskip=0,
+               readlim=None, readskip=None, nprocs=1, cachedir=None, debug=False):
+    r"""Read in, check and trim the matched training runs.
+
+    Runs with NaNs, with fewer than tclen points, or with an extreme standard deviation in either the input or
+    the target file are discarded.
+
+    Parameters
+    ----------
+    matchedfilelist : list of str
+        The target files
+    tclen : int
+        The number of points to keep from each file
+    targetfrag, inputfrag : str
+        The input file name is the target file name with targetfrag replaced by inputfrag
+    usebadpts : bool
+        Also read the bad point files
+    startskip, endskip : int
+        Points to trim from the start and end of each run
+    readlim : int, optional
+        The maximum number of runs to read
+    readskip : int, optional
+        The number of runs to skip at the start of the list
+    nprocs : int, optional
+        The number of processes to read the files with.  Default is 1.
+    cachedir : str, optional
+        If given, the checked data is saved here after the first read, and loaded (memory mapped) from
+        here on later calls with the same files and tclen, without reading any text files.
+    debug : bool
+
+    Returns
+    -------
+    x, y, names[, bad]
+        The input and target data (timepoints x runs), the names of the runs used, and the bad points
+    """
+    print('readindata called with usebadpts, startskip, endskip, readlim, readskip, targetfrag, inputfrag =',
+          usebadpts, startskip, endskip, readlim, readskip, targetfrag, inputfrag)
+    if readskip is None:
+        readskip = 0
+    s = len(matchedfilelist[readskip:])
+    if readlim is not None:
+        if s > readlim:
+            print('trimming read list to', readlim, 'from', s)
+            s = readlim
+    filelist = matchedfilelist[readskip:readskip + s]
+
+    if cachedir is not None:
+        cachename = datacachename(cachedir, filelist, tclen, targetfrag=targetfrag, inputfrag=inputfrag,
+                                  usebadpts=usebadpts)
+    if (cachedir is not None) and os.path.isfile(cachename + '.npy') and os.path.isfile(cachename + '.json'):
+        # the cached arrays are copy on write, so the caller can normalize them in place
+        print('loading checked data from', cachename)
+        thearrays = np.load(cachename + '.npy', mmap_mode='c')
+        thecacheinfo = tide_io.readdictfromjson(cachename + '.json')
+        names = thecacheinfo['names']
+        nanfiles = thecacheinfo['nanfiles']
+        shortfiles = thecacheinfo['shortfiles']
+        strangemagfiles = thecacheinfo['strangemagfiles']
+        count = len(names)
+        x1 = thearrays[0]
+        y1 = thearrays[1]
+        if usebadpts:
+            bad1 = thearrays[2]
+    else:
+        # allocate target arrays
+        print('allocating arrays')
+        numarrays = 3 if usebadpts else 2
+        if nprocs > 1:
+            alldata, alldata_shared, dummy = tide_multiproc.allocshared((numarrays, tclen, s), np.float64)
+        else:
+            alldata = np.zeros((numarrays, tclen, s), dtype=np.float64)
+        state = {'filelist': filelist,
+                 'tclen': tclen,
+                 'targetfrag': targetfrag,
+                 'inputfrag': inputfrag,
+                 'usebadpts': usebadpts,
+                 'debug': debug,
+                 'x1': alldata[0],
+                 'y1': alldata[1],
+                 'bad1': alldata[2] if usebadpts else None}
+
+        # now read the data in
+        print('checking data')
+        if nprocs > 1:
+            tokens = tide_multiproc.run_blockfunc(_readrunblock, state, (s,), None, nprocs=nprocs, rangesize=10)
+        else:
+            tokens = [_readrunblock(np.arange(s), state)]
+        results = [None] * s
+        for thetoken in tokens:
+            for theresult in thetoken[1]:
+                results[theresult[0]] = theresult
+
+        # keep the runs that passed, in order
+        names = []
+        nanfiles = []
+        shortfiles = []
+        strangemagfiles = []
+        for i, passed, thenanfiles, theshortfiles, thestrangemagfiles in results:
+            for thefile in thenanfiles:
+                print('NaN found in file', thefile, '- discarding')
+            for thefile in thestrangemagfiles:
+                print('file', thefile, 'has an extreme standard deviation - discarding')
+            for thefile in theshortfiles:
+                print('file', thefile, 'is short - discarding')
+            nanfiles += thenanfiles
+            shortfiles += theshortfiles
+            strangemagfiles += thestrangemagfiles
+            if passed:
+                names.append(filelist[i])
+        count = len(names)
+        thearrays = alldata[:, :, [passed for i, passed, dummy, dummy, dummy in results]]
+        del alldata
+        if cachedir is not None:
+            # write to names unique to this process first, so a partially written cache is never used
+            print('saving checked data to', cachename)
+            tempname = cachename + '.' + str(os.getpid()) + '.partial'
+            np.save(tempname + '.npy', thearrays)
+            tide_io.writedicttojson({'names': names,
+                                     'nanfiles': nanfiles,
+                                     'shortfiles': shortfiles,
+                                     'strangemagfiles': strangemagfiles}, tempname + '.json')
+            os.replace(tempname + '.npy', cachename + '.npy')
+            os.replace(tempname + '.json', cachename + '.json')
+        x1 = thearrays[0]
+        y1 = thearrays[1]
+        if usebadpts:
+            bad1 = thearrays[2]
+
+    print(count, 'runs pass file length check')
+    if len(nanfiles) > 0:
+        print('files with NaNs:')
+        for thefile in nanfiles:
+            print('\t', thefile)
+    if len(shortfiles) > 0:
+        print('short files:')
+        for thefile in shortfiles:
+            print('\t', thefile)
+    if len(strangemagfiles) > 0:
+        print('files with extreme standard deviations:')
+        for thefile in strangemagfiles:
+            print('\t', thefile)
+
+    if usebadpts:
+        return x1[startskip:-endskip, :count], y1[startskip:-endskip, :count], names[:count], bad1[startskip:-endskip,
+                                                                                              :count]
+    else:
+        return x1[startskip:-endskip, :count], y1[startskip:-endskip, :count], names[:count]
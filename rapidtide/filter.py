@@ -85,7 +85,7 @@ def disablenumba():
 def padvec(inputdata, padlen=20, cyclic=False):
     r"""Returns a padded copy of the input data; padlen points of
     reflected data are prepended and appended to the input data to reduce
-    end effects when the data is then filtered.
+    end effects when the data is then filtered.  Multidimensional data is padded along the last axis.
 
     Parameters
     ----------
@@ -109,16 +109,17 @@ def padvec(inputdata, padlen=20, cyclic=False):
     """
     if padlen > 0:
         if cyclic:
-            return np.concatenate((inputdata[-padlen:], inputdata, inputdata[0:padlen]))
+            return np.concatenate((inputdata[..., -padlen:], inputdata, inputdata[..., 0:padlen]), axis=-1)
         else:
-            return np.concatenate((inputdata[::-1][-padlen:], inputdata, inputdata[::-1][0:padlen]))
+            return np.concatenate((inputdata[..., ::-1][..., -padlen:], inputdata, inputdata[..., ::-1][..., 0:padlen]),
+                                  axis=-1)
     else:
         return inputdata
 
 
 def unpadvec(inputdata, padlen=20):
     r"""Returns a input data with the end pads removed (see padvec);
-    padlen points of reflected data are removed from each end of the array.
+    padlen points of reflected data are removed from each end of the array (along the last axis).
 
     Parameters
     ----------
@@ -137,7 +138,7 @@ def unpadvec(inputdata, padlen=20):
 
     """
     if padlen > 0:
-        return inputdata[padlen:-padlen]
+        return inputdata[..., padlen:-padlen]
     else:
         return inputdata
 
@@ -221,7 +222,7 @@ def dolpfiltfilt(Fs, upperpass, inputdata, order, padlen=20, cyclic=False, debug
     if upperpass > Fs / 2.0:
         upperpass = Fs / 2.0
     if debug:
-        print('dolpfiltfilt - Fs, upperpass, len(inputdata), order:', Fs, upperpass, len(inputdata), order)
+        print('dolpfiltfilt - Fs, upperpass, len(inputdata), order:', Fs, upperpass, np.shape(inputdata)[-1], order)
     [b, a] = signal.butter(order, 2.0 * upperpass / Fs)
     return unpadvec(signal.filtfilt(b, a, padvec(inputdata, padlen=padlen, cyclic=cyclic)).real, padlen=padlen).astype(np.float64)
 
@@ -269,7 +270,7 @@ def dohpfiltfilt(Fs, lowerpass, inputdata, order, padlen=20, cyclic=False, debug
     if lowerpass < 0.0:
         lowerpass = 0.0
     if debug:
-        print('dohpfiltfilt - Fs, lowerpass, len(inputdata), order:', Fs, lowerpass, len(inputdata), order)
+        print('dohpfiltfilt - Fs, lowerpass, len(inputdata), order:', Fs, lowerpass, np.shape(inputdata)[-1], order)
     [b, a] = signal.butter(order, 2.0 * lowerpass / Fs, 'highpass')
     return unpadvec(signal.filtfilt(b, a, padvec(inputdata, padlen=padlen, cyclic=cyclic)).real, padlen=padlen)
 
@@ -324,7 +325,7 @@ def dobpfiltfilt(Fs, lowerpass, upperpass, inputdata, order, padlen=20, cyclic=F
         lowerpass = 0.0
     if debug:
         print('dobpfiltfilt - Fs, lowerpass, upperpass, len(inputdata), order:',
-              Fs, lowerpass, upperpass, len(inputdata), order)
+              Fs, lowerpass, upperpass, np.shape(inputdata)[-1], order)
     [b, a] = signal.butter(order, [2.0 * lowerpass / Fs, 2.0 * upperpass / Fs],
                            'bandpass')
     return unpadvec(signal.filtfilt(b, a, padvec(inputdata, padlen=padlen, cyclic=cyclic)).real, padlen=padlen)
@@ -380,10 +381,10 @@ def getlpfftfunc(Fs, upperpass, inputdata, debug=False):
     transferfunc : 1D float array
         The transfer function
     """
-    transferfunc = np.ones(np.shape(inputdata), dtype=np.float64)
+    transferfunc = np.ones(np.shape(inputdata)[-1], dtype=np.float64)
     cutoffbin = int((upperpass / Fs) * np.shape(transferfunc)[0])
     if debug:
-        print('getlpfftfunc - Fs, upperpass, len(inputdata):', Fs, upperpass, np.shape(inputdata)[0])
+        print('getlpfftfunc - Fs, upperpass, len(inputdata):', Fs, upperpass, np.shape(inputdata)[-1])
     transferfunc[cutoffbin:-cutoffbin] = 0.0
     return transferfunc
 
@@ -554,14 +555,14 @@ def getlptrapfftfunc(Fs, upperpass, upperstop, inputdata, debug=False):
     transferfunc : 1D float array
         The transfer function
     """
-    transferfunc = np.ones(np.shape(inputdata), dtype='float64')
+    transferfunc = np.ones(np.shape(inputdata)[-1], dtype='float64')
     passbin = int((upperpass / Fs) * np.shape(transferfunc)[0])
     cutoffbin = int((upperstop / Fs) * np.shape(transferfunc)[0])
     transitionlength = cutoffbin - passbin
     if debug:
         print('getlptrapfftfunc - Fs, upperpass, upperstop:', Fs, upperpass, upperstop)
         print('getlptrapfftfunc - passbin, transitionlength, cutoffbin, len(inputdata):',
-              passbin, transitionlength, cutoffbin, len(inputdata))
+              passbin, transitionlength, cutoffbin, np.shape(inputdata)[-1])
     if transitionlength > 0:
         transitionvector = np.arange(1.0 * transitionlength) / transitionlength
         transferfunc[passbin:cutoffbin] = 1.0 - transitionvector
@@ -737,6 +738,38 @@ def wiener_deconvolution(signal, kernel, lambd):
     return deconvolved
 
 
+def wiener_deconvolution_batch(signals, kernel, lambd):
+    r"""Wiener deconvolve a block of signals at once, in the FFT domain.
+
+    Gives the same result as calling wiener_deconvolution on each row of signals.
+
+    Parameters
+    ----------
+    signals: 2D numpy array
+        The signals to deconvolve, one per row
+    kernel: 1D or 2D numpy array
+        The convolution kernel.  If 1D, the same kernel is used for every signal; otherwise
+        there is one kernel per row.
+    lambd: float
+        The SNR in the fourier domain
+
+    Returns
+    -------
+    deconvolved: 2D numpy array
+        The deconvolved signals
+    """
+    signals = np.atleast_2d(signals)
+    thelen = signals.shape[1]
+    padshape = list(np.shape(kernel))
+    padshape[-1] = thelen
+    paddedkernel = np.zeros(padshape, dtype=np.float64)
+    paddedkernel[..., :np.shape(kernel)[-1]] = kernel
+    H = np.fft.rfft(paddedkernel, axis=-1)
+    thefilter = np.conj(H) / (np.real(H * np.conj(H)) + lambd ** 2)
+    deconvolved = np.fft.irfft(np.fft.rfft(signals, axis=1) * thefilter, n=thelen, axis=1)
+    return np.roll(deconvolved, int(thelen // 2), axis=1)
+
+
 def pspec(inputdata):
     r"""Calculate the power spectrum of an input signal
 
@@ -1311,17 +1344,17 @@ class noncausalfilter:
         ----------
         Fs : float
             Sample frequency
-        data : 1D float array
-            The data to filter
+        data : 1D or 2D float array
+            The data to filter.  2D data is a set of timecourses, one per row, each filtered along the last axis.
 
         Returns
         -------
-        filtereddata : 1D float array
+        filtereddata : 1D or 2D float array
             The filtered data
         """
         # do some bounds checking
         nyquistlimit = 0.5 * Fs
-        lowestfreq = 2.0 * Fs / np.shape(data)[0]
+        lowestfreq = 2.0 * Fs / np.shape(data)[-1]
 
         # first see if entire range is out of bounds
         if self.lowerpass >= nyquistlimit:
@@ -1372,7 +1405,7 @@ class noncausalfilter:
                 sys.exit()
 
         if self.padtime < 0.0:
-            padlen = int(len(data) // 2)
+            padlen = int(np.shape(data)[-1] // 2)
         else:
             padlen = int(self.padtime * Fs)
         if self.debug:
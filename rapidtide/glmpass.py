@@ -46,6 +46,67 @@ def _procOneItemGLM(vox,
            rt_floatset(thefit[0, 1] / thefit[0, 0]), datatoremove, rt_floatset(thedata - datatoremove)
 
 
+def _sharedevqr(theevs):
+    # QR factorization of the design matrix (a constant and the regressor) for a regressor shared by every item
+    return np.linalg.qr(np.vstack((np.ones(len(theevs)), theevs)).T)
+
+
+def blockglm(theevs, thedata, evqr=None):
+    r"""Fit thedata[i, :] = meanvalue[i] + fitcoff[i] * theevs[i, :] for a block of items at once, in closed form.
+
+    Parameters
+    ----------
+    theevs : numpy array
+        The regressors, one row per item.  If 1D, the same regressor is used for every item, and one QR
+        factorization covers them all.
+    thedata : 2D numpy array
+        The data, one row per item
+    evqr : tuple, optional
+        For a 1D regressor, the QR factorization of its design matrix (a column of ones and the regressor), as
+        returned by np.linalg.qr.  Pass this when fitting many blocks with the same regressor, so it is only
+        factored once.  If None, it is computed here.
+
+    Returns
+    -------
+    meanvalue, rvalue, r2value, fitcoff, fitNorm : 1D numpy arrays
+        The intercept, R, R^2, slope, and slope / intercept of each fit
+    datatoremove, filtereddata : 2D numpy arrays
+        The fit regressor, and the data with the fit regressor removed
+    """
+    thedata = np.asarray(thedata, dtype=np.float64)
+    datamean = np.mean(thedata, axis=1)
+    if theevs.ndim == 1:
+        theevs = np.asarray(theevs, dtype=np.float64)
+        if evqr is None:
+            evqr = _sharedevqr(theevs)
+        q, r = evqr
+        thecoffs = np.linalg.solve(r, np.dot(q.T, thedata.T))
+        meanvals = thecoffs[0, :]
+        fitcoffs = thecoffs[1, :]
+        evcentered = theevs - np.mean(theevs)
+        sxx = np.dot(evcentered, evcentered)
+        sxy = np.dot(thedata - datamean[:, None], evcentered)
+        datatoremove = fitcoffs[:, None] * theevs[None, :]
+    else:
+        theevs = np.asarray(theevs, dtype=np.float64)
+        evmean = np.mean(theevs, axis=1)
+        evcentered = theevs - evmean[:, None]
+        sxx = np.sum(evcentered * evcentered, axis=1)
+        sxy = np.sum(evcentered * (thedata - datamean[:, None]), axis=1)
+
+        # a constant regressor has no unique fit - use the minimum norm solution, which is what lstsq gives
+        isconstant = (sxx == 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fitcoffs = np.where(isconstant, datamean * evmean / (1.0 + evmean * evmean), sxy / sxx)
+        meanvals = np.where(isconstant, datamean / (1.0 + evmean * evmean), datamean - fitcoffs * evmean)
+        datatoremove = fitcoffs[:, None] * theevs
+    syy = np.sum((thedata - datamean[:, None]) ** 2, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rvals = np.fabs(sxy) / np.sqrt(sxx * syy)
+        fitNorms = fitcoffs / meanvals
+    return meanvals, rvals, rvals * rvals, fitcoffs, fitNorms, datatoremove, thedata - datatoremove
+
+
 def glmpass(numprocitems,
             fmri_data,
             threshval,
@@ -63,8 +124,36 @@ def glmpass(numprocitems,
             showprogressbar=True,
             addedskip=0,
             mp_chunksize=1000,
+            batchsize=1000,
             rt_floatset=np.float64,
             rt_floattype='float64'):
+    """Fit and remove a regressor from every voxel (or timepoint) of fmri_data.
+
+    Parameters
+    ----------
+    numprocitems : int
+        Number of voxels (if procbyvoxel) or timepoints to process
+    fmri_data : 2D numpy array
+        The data, voxels x timepoints
+    threshval : float
+        Items whose mean (or standard deviation, if that's bigger) are not above threshval are skipped.  If None,
+        process all items.
+    theevs : numpy array
+        The regressors, the same shape as the items in fmri_data, so each item has its own regressor.  If 1D, the
+        same regressor is used for every item (this requires batchsize > 1).
+    meanvalue, rvalue, r2value, fitcoff, fitNorm : 1D numpy arrays
+        Output arrays for the intercept, R, R^2, slope, and slope / intercept of each fit
+    datatoremove, filtereddata : 2D numpy arrays
+        Output arrays for the fit regressor and the data with the fit regressor removed
+    batchsize : int
+        Number of items to fit at once, using closed form expressions for the slope, intercept and R of every
+        item in the block.  Set to 1 to fit items one at a time with mlregress.
+
+    Returns
+    -------
+    itemstotal : int
+        Number of items processed
+    """
     inputshape = np.shape(fmri_data)
     if threshval is None:
         themask = None
@@ -141,6 +230,44 @@ def glmpass(numprocitems,
                 itemstotal += 1
 
         del data_out
+    elif batchsize > 1:
+        if themask is None:
+            theitems = np.arange(numprocitems)
+        else:
+            theitems = np.where(np.asarray(themask)[:numprocitems] > 0)[0]
+        if theevs.ndim == 1:
+            theevs = np.asarray(theevs, dtype=np.float64)
+            evqr = _sharedevqr(theevs)
+        else:
+            evqr = None
+        for i in range(0, len(theitems), batchsize):
+            if showprogressbar:
+                tide_util.progressbar(min(i + batchsize, len(theitems)), len(theitems), label='Percent complete')
+            theblock = theitems[i:i + batchsize]
+            if procbyvoxel:
+                if theevs.ndim == 1:
+                    blockevs = theevs
+                else:
+                    blockevs = theevs[theblock, :]
+                theresults = blockglm(blockevs, fmri_data[theblock, addedskip:], evqr=evqr)
+                datatoremove[theblock, :] = theresults[5]
+                filtereddata[theblock, :] = theresults[6]
+            else:
+                if theevs.ndim == 1:
+                    blockevs = theevs
+                else:
+                    blockevs = theevs[:, theblock].T
+                theresults = blockglm(blockevs, fmri_data[:, addedskip + theblock].T, evqr=evqr)
+                datatoremove[:, theblock] = theresults[5].T
+                filtereddata[:, theblock] = theresults[6].T
+            meanvalue[theblock] = theresults[0]
+            rvalue[theblock] = theresults[1]
+            r2value[theblock] = theresults[2]
+            fitcoff[theblock] = theresults[3]
+            fitNorm[theblock] = theresults[4]
+        itemstotal = len(theitems)
+        if showprogressbar:
+            print()
     else:
         itemstotal = 0
         if procbyvoxel:
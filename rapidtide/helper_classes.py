@@ -25,6 +25,7 @@ import matplotlib.pyplot as pl
 
 import numpy as np
 import scipy as sp
+from scipy import fftpack
 import warnings
 import sys
 
@@ -152,6 +153,13 @@ class correlator:
     datavalid = False
     timeaxisvalid = False
     corrorigin = 0
+    fftlen = 0
+    prepreffft = None
+    lagrangeonly = False
+    lagrangemethod = None
+    lagrangefftlen = 0
+    lagrangereffft = None
+    lagrangecorr = False
 
     def __init__(self,
                  Fs=0.0,
@@ -163,7 +171,8 @@ class correlator:
                  usewindowfunc=True,
                  detrendorder=1,
                  windowfunc='hamming',
-                 corrweighting='none'):
+                 corrweighting='none',
+                 lagrangeonly=False):
         self.Fs = Fs
         self.corrorigin = corrorigin
         self.lagmininpts = lagmininpts
@@ -174,6 +183,7 @@ class correlator:
         self.detrendorder = detrendorder
         self.windowfunc = windowfunc
         self.corrweighting = corrweighting
+        self.lagrangeonly = lagrangeonly
         if self.reftc is not None:
             self.setreftc(self.reftc)
 
@@ -186,6 +196,14 @@ class correlator:
                                        windowfunc=self.windowfunc)
 
 
+    def preptcs(self, thetcs):
+        # prepare a (voxels x time) block of timecourses the same way, all at once
+        return tide_corr.corrnormalizerows(self.ncprefilter.apply(self.Fs, thetcs),
+                                           prewindow=self.usewindowfunc,
+                                           detrendorder=self.detrendorder,
+                                           windowfunc=self.windowfunc)
+
+
     def setreftc(self, reftc):
         self.reftc = reftc + 0.0
         self.prepreftc = self.preptc(self.reftc)
@@ -198,10 +216,65 @@ class correlator:
         self.timeaxisvalid = True
         self.datavalid = False
 
+        # cache the transform of the time reversed reference for block correlations
+        self.fftlen = fftpack.next_fast_len(self.corrlen)
+        self.prepreffft = np.fft.rfft(self.prepreftc[::-1], n=self.fftlen)
+        self._setuplagrange()
+
 
     def setlimits(self, lagmininpts, lagmaxinpts):
         self.lagmininpts = lagmininpts
         self.lagmaxinpts = lagmaxinpts
+        self._setuplagrange()
+
+
+    def setlagrangeonly(self, lagrangeonly):
+        self.lagrangeonly = lagrangeonly
+        self._setuplagrange()
+
+
+    def _setuplagrange(self):
+        # decide how to calculate just the lags within the limits, and precalculate what that method needs
+        self.lagrangemethod = None
+        if (not self.lagrangeonly) or (self.reftc is None) or (self.lagmininpts + self.lagmaxinpts < 1):
+            return
+        if self.corrweighting != 'none':
+            # the weighted correlations are normalized over the full correlation function
+            self.lagrangemethod = 'full'
+            return
+        tclen = len(self.reftc)
+        self.lagrangelags = np.arange(self.corrorigin - self.lagmininpts,
+                                      self.corrorigin + self.lagmaxinpts) - (tclen - 1)
+        maxabslag = np.max(np.fabs(self.lagrangelags)).astype(int)
+        self.lagrangefftlen = fftpack.next_fast_len(tclen + maxabslag)
+
+        # compare the approximate operation count of the direct sums with that of a pruned transform pair
+        directcost = len(self.lagrangelags) * tclen
+        fftcost = 5.0 * self.lagrangefftlen * np.log2(self.lagrangefftlen)
+        if directcost <= fftcost:
+            self.lagrangemethod = 'direct'
+        else:
+            self.lagrangemethod = 'fft'
+            self.lagrangereffft = np.conj(np.fft.rfft(self.prepreftc, n=self.lagrangefftlen))
+
+
+    def _lagrangecorrelate(self, preptesttcs):
+        # correlate a (voxels x time) block of prepared timecourses over the lag range only
+        if self.lagrangemethod == 'direct':
+            tclen = len(self.prepreftc)
+            thexcorrs = np.zeros((np.shape(preptesttcs)[0], len(self.lagrangelags)), dtype=np.float64)
+            for i in range(len(self.lagrangelags)):
+                thelag = self.lagrangelags[i]
+                if thelag >= 0:
+                    thexcorrs[:, i] = np.dot(preptesttcs[:, thelag:], self.prepreftc[:tclen - thelag])
+                else:
+                    thexcorrs[:, i] = np.dot(preptesttcs[:, :tclen + thelag], self.prepreftc[-thelag:])
+            return thexcorrs
+        else:
+            # circular correlation, with enough padding that no lag in the range wraps around
+            circcorrs = np.fft.irfft(np.fft.rfft(preptesttcs, n=self.lagrangefftlen, axis=1) * self.lagrangereffft,
+                                     n=self.lagrangefftlen, axis=1)
+            return circcorrs[:, self.lagrangelags % self.lagrangefftlen]
 
 
     def trim(self, vector):
@@ -210,6 +283,12 @@ class correlator:
 
     def getcorrelation(self, trim=True):
         if self.datavalid:
+            if self.lagrangecorr:
+                if trim:
+                    return self.thexcorr, self.trim(self.timeaxis), self.theglobalmax
+                else:
+                    print('only the lag range was calculated - cannot return full correlation')
+                    return None, self.timeaxis, None
             if trim:
                 return self.trim(self.thexcorr), self.trim(self.timeaxis), self.theglobalmax
             else:
@@ -233,7 +312,16 @@ class correlator:
         self.testtc = thetc
         self.preptesttc = self.preptc(self.testtc)
 
+        # if we only want the lag range, don't bother calculating the rest
+        if trim and (self.lagrangemethod == 'direct' or self.lagrangemethod == 'fft'):
+            self.thexcorr = self._lagrangecorrelate(self.preptesttc.reshape((1, -1)))[0, :]
+            self.theglobalmax = np.argmax(self.thexcorr) + self.corrorigin - self.lagmininpts
+            self.lagrangecorr = True
+            self.datavalid = True
+            return self.thexcorr, self.trim(self.timeaxis), self.theglobalmax
+
         # now actually do the correlation
+        self.lagrangecorr = False
         self.thexcorr = tide_corr.fastcorrelate(self.preptesttc, self.prepreftc, usefft=True, weighting=self.corrweighting)
         self.corrlen = len(self.thexcorr)
         self.corrorigin = self.corrlen // 2 + 1
@@ -248,6 +336,56 @@ class correlator:
             return self.thexcorr, self.timeaxis, self.theglobalmax
 
 
+    def run_batch(self, thetcs, trim=True):
+        r"""Correlate a block of timecourses against the reference in one pass.
+
+        Parameters
+        ----------
+        thetcs : 2D float array
+            The timecourses to correlate, arranged as (voxels x time)
+        trim : boolean, optional
+            If True, only return the part of the correlation functions within the lag limits.  Default is True.
+
+        Returns
+        -------
+        thexcorrs : 2D float array
+            The correlation function for each timecourse, arranged as (voxels x lags)
+        thetimeaxis : 1D float array
+            The lag time of each point in the correlation functions
+        theglobalmaxes : 1D int array
+            The index of the maximum of each (untrimmed) correlation function.  If only the lag range
+            was calculated, this is the maximum within the lag range.
+        """
+        if np.shape(thetcs)[1] != len(self.reftc):
+            print('timecourses are of different sizes - exiting')
+            sys.exit()
+
+        preptesttcs = self.preptcs(np.asarray(thetcs, dtype=np.float64))
+
+        # if we only want the lag range, don't bother calculating the rest
+        if trim and (self.lagrangemethod == 'direct' or self.lagrangemethod == 'fft'):
+            thexcorrs = self._lagrangecorrelate(preptesttcs)
+            return thexcorrs, self.trim(self.timeaxis), \
+                   np.argmax(thexcorrs, axis=1) + self.corrorigin - self.lagmininpts
+
+        # now do the correlations - the weighted forms need per timecourse normalization, so do those one at a time
+        if self.corrweighting == 'none':
+            thexcorrs = np.fft.irfft(np.fft.rfft(preptesttcs, n=self.fftlen, axis=1) * self.prepreffft,
+                                     n=self.fftlen, axis=1)[:, :self.corrlen]
+        else:
+            thexcorrs = np.zeros((np.shape(thetcs)[0], self.corrlen), dtype=np.float64)
+            for i in range(np.shape(thetcs)[0]):
+                thexcorrs[i, :] = tide_corr.fastcorrelate(preptesttcs[i, :], self.prepreftc, usefft=True,
+                                                          weighting=self.corrweighting)
+        theglobalmaxes = np.argmax(thexcorrs, axis=1)
+
+        if trim:
+            return thexcorrs[:, self.corrorigin - self.lagmininpts:self.corrorigin + self.lagmaxinpts], \
+                   self.trim(self.timeaxis), theglobalmaxes
+        else:
+            return thexcorrs, self.timeaxis, theglobalmaxes
+
+
 class correlation_fitter:
     corrtimeaxis = None
     FML_BADAMPLOW = np.uint16(0x01)
@@ -318,6 +456,9 @@ class correlation_fitter:
         fit(corrfunc):
             Fit the correlation function given in corrfunc and return the location of the peak in seconds, the maximum
             correlation value, the peak width
+        fit_batch(corrarray, maxguesses=None):
+            Fit every correlation function in the (voxels x lags) array corrarray at once.  Returns the same values
+            as fit, as arrays.
         setrange(lagmin, lagmax):
             Specify the search range for lag peaks, in seconds
         """
@@ -647,6 +788,229 @@ class correlation_fitter:
         return maxindex, maxlag, flipfac * maxval, maxsigma, maskval, failreason, peakstart, peakend
 
 
+    def _gaussrefine_batch(self, X, data, window, p0, maxiter=100, xtol=1.49012e-08):
+        # Levenberg-Marquardt refinement of a gaussian fit to many peaks at once, using the analytic jacobian.
+        # data and window are (voxels x lags); only the points where window is True contribute to each fit.
+        params = p0 + 0.0
+        thelambda = np.full(np.shape(params)[0], 1e-3)
+        active = np.ones(np.shape(params)[0], dtype=bool)
+
+        def residsandjacobian(theparams, thedata, thewindow):
+            offsets = X[None, :] - theparams[:, 1][:, None]
+            invsigsq = 1.0 / np.square(theparams[:, 2])[:, None]
+            expterm = np.exp(-np.square(offsets) * invsigsq / 2.0)
+            fitvals = theparams[:, 0][:, None] * expterm
+            resids = np.where(thewindow, thedata - fitvals, 0.0)
+            jacobian = np.zeros((np.shape(theparams)[0], len(X), 3), dtype=np.float64)
+            jacobian[:, :, 0] = expterm
+            jacobian[:, :, 1] = fitvals * offsets * invsigsq
+            jacobian[:, :, 2] = fitvals * np.square(offsets) * invsigsq / theparams[:, 2][:, None]
+            jacobian *= thewindow[:, :, None]
+            return resids, jacobian
+
+        with np.errstate(all='ignore'):
+            resids, jacobian = residsandjacobian(params, data, window)
+            cost = np.sum(np.square(resids), axis=1)
+            for theiter in range(maxiter):
+                idx = np.where(active)[0]
+                if len(idx) == 0:
+                    break
+                JTJ = np.einsum('vki,vkj->vij', jacobian[idx], jacobian[idx])
+                JTr = np.einsum('vki,vk->vi', jacobian[idx], resids[idx])
+                damping = thelambda[idx][:, None] * (np.diagonal(JTJ, axis1=1, axis2=2) + 1e-12)
+                A = JTJ + damping[:, :, None] * np.eye(3)[None, :, :]
+                bad = ~np.isfinite(A).all(axis=(1, 2))
+                A[bad] = np.eye(3)
+                delta = np.linalg.solve(A, JTr[:, :, None])[:, :, 0]
+                delta[bad] = 0.0
+                trialparams = params[idx] + delta
+                trialresids, trialjacobian = residsandjacobian(trialparams, data[idx], window[idx])
+                trialcost = np.sum(np.square(trialresids), axis=1)
+                improved = np.isfinite(trialcost) & (trialcost < cost[idx])
+
+                # take the steps that helped, and adjust the damping either way
+                goodidx = idx[improved]
+                params[goodidx] = trialparams[improved]
+                resids[goodidx] = trialresids[improved]
+                jacobian[goodidx] = trialjacobian[improved]
+                cost[goodidx] = trialcost[improved]
+                thelambda[goodidx] /= 10.0
+                thelambda[idx[~improved]] *= 10.0
+
+                # stop fitting peaks that have converged or can't make progress
+                converged = np.all(np.fabs(delta) <= xtol * (np.fabs(trialparams) + xtol), axis=1)
+                stuck = (thelambda[idx] > 1e16) | bad
+                active[idx[converged | stuck]] = False
+
+        # the equivalent of a failed leastsq call
+        failed = ~np.isfinite(params).all(axis=1)
+        params[failed, :] = 0.0
+        return params
+
+
+    def fit_batch(self, corrarray, maxguesses=None):
+        r"""Fit many correlation functions at once.
+
+        Parameters
+        ----------
+        corrarray : 2D float array
+            The correlation functions to fit, arranged as (voxels x lags)
+        maxguesses : 1D float array, optional
+            Per voxel initial lag guesses, used instead of maxguess when useguess is set.
+
+        Returns
+        -------
+        maxindex, maxlag, maxval, maxsigma, maskval, failreason, peakstart, peakend : 1D arrays
+            The same values as fit returns, one entry per voxel.
+        """
+        if self.corrtimeaxis is None:
+            print("Correlation time axis is not defined - exiting")
+            sys.exit()
+        if len(self.corrtimeaxis) != np.shape(corrarray)[1]:
+            print('Correlation time axis and values do not match in length (',
+                  len(self.corrtimeaxis),
+                  '!=',
+                  np.shape(corrarray)[1],
+                  '- exiting')
+            sys.exit()
+        numvox, corrlen = np.shape(corrarray)
+        voxels = np.arange(numvox)
+        lagindices = np.arange(corrlen)[None, :]
+        failreason = np.zeros(numvox, dtype=np.uint16)
+        maskval = np.ones(numvox, dtype=np.uint16)
+        binwidth = self.corrtimeaxis[1] - self.corrtimeaxis[0]
+
+        # find the maximum value and its location, staying off the ends
+        flipfac = np.ones(numvox, dtype=np.float64)
+        if self.useguess:
+            if maxguesses is None:
+                maxguesses = np.full(numvox, self.maxguess)
+            limvals = np.clip(maxguesses, self.corrtimeaxis[0], self.corrtimeaxis[-1])
+            maxindex = np.round((limvals - self.corrtimeaxis[0]) / binwidth, 0).astype(int)
+            corrfuncs = np.asarray(corrarray, dtype=np.float64)
+        else:
+            maxindex = np.argmax(corrarray[:, 1:-1], axis=1) + 1
+            if self.bipolar:
+                minindex = np.argmax(np.fabs(corrarray[:, 1:-1]), axis=1) + 1
+                useminimum = np.fabs(corrarray[voxels, minindex]) > np.fabs(corrarray[voxels, maxindex])
+                maxindex = np.where(useminimum, minindex, maxindex)
+                flipfac[useminimum] = -1.0
+            corrfuncs = np.asarray(corrarray, dtype=np.float64) * flipfac[:, None]
+        maxlag_init = np.float64(self.corrtimeaxis[maxindex])
+        maxval_init = corrfuncs[voxels, maxindex]
+
+        # then calculate the width of the peaks - these are the same edge searches as in fit
+        thegrad = np.gradient(corrfuncs, axis=1)
+        peakpoints = corrfuncs > self.searchfrac * maxval_init[:, None]
+        peakpoints[:, 0] = False
+        peakpoints[:, -1] = False
+        peakstart = np.maximum(1, maxindex - 1)
+        peakend = np.minimum(corrlen - 2, maxindex + 1)
+        stopend = (lagindices > peakend[:, None]) & ~((thegrad <= 0.0) & peakpoints)
+        peakend = np.argmax(stopend, axis=1) - 1
+        stopstart = (lagindices < peakstart[:, None]) & ~((thegrad >= 0.0) & peakpoints)
+        peakstart = corrlen - np.argmax(stopstart[:, ::-1], axis=1)
+
+        # deal with flat peak tops
+        flatend = np.zeros((numvox, corrlen), dtype=bool)
+        flatend[:, 1:] = corrfuncs[:, 1:] == corrfuncs[:, :-1]
+        stopend = (lagindices >= peakend[:, None]) & ~((lagindices < corrlen - 3) & flatend)
+        peakend = np.argmax(stopend, axis=1)
+        flatstart = np.zeros((numvox, corrlen), dtype=bool)
+        flatstart[:, :-1] = corrfuncs[:, :-1] == corrfuncs[:, 1:]
+        stopstart = (lagindices <= peakstart[:, None]) & ~((lagindices > 2) & flatstart)
+        peakstart = corrlen - 1 - np.argmax(stopstart[:, ::-1], axis=1)
+
+        maxsigma_init = ((peakend - peakstart + 1) * binwidth / (2.0 * np.sqrt(-np.log(self.searchfrac)))) / np.sqrt(
+            2.0)
+
+        # now check the values for errors
+        if self.hardlimit:
+            rangeextension = 0.0
+        else:
+            rangeextension = (self.lagmax - self.lagmin) * 0.75
+        lowlag = maxlag_init < (self.lagmin - rangeextension - binwidth)
+        highlag = maxlag_init > (self.lagmax + rangeextension + binwidth)
+        failreason[lowlag | highlag] |= (self.FML_INITFAIL | self.FML_BADLAG)
+        maxlag_init[lowlag] = self.lagmin - rangeextension - binwidth
+        maxlag_init[highlag] = self.lagmax + rangeextension + binwidth
+        widthhigh = maxsigma_init > self.absmaxsigma
+        failreason[widthhigh] |= (self.FML_INITFAIL | self.FML_BADWIDTHHIGH)
+        maxsigma_init[widthhigh] = self.absmaxsigma
+        badwindow = (peakend - peakstart) < 2
+        failreason[badwindow] |= (self.FML_INITFAIL | self.FML_BADSEARCHWINDOW)
+        maxsigma_init[badwindow] = ((2 + 1) * binwidth / (2.0 * np.sqrt(-np.log(self.searchfrac)))) / np.sqrt(2.0)
+        if self.enforcethresh:
+            failreason[~((self.lthreshval <= maxval_init) & (maxval_init <= self.uthreshval))] |= \
+                (self.FML_INITFAIL | self.FML_BADAMPLOW)
+        ampnegative = maxval_init < 0.0
+        failreason[ampnegative] |= (self.FML_INITFAIL | self.FML_BADAMPLOW)
+        maxval_init[ampnegative] = 0.0
+        amphigh = maxval_init > 1.0
+        failreason[amphigh] |= (self.FML_INITFAIL | self.FML_BADAMPHIGH)
+        maxval_init[amphigh] = 1.0
+
+        # refine if necessary
+        if self.refine:
+            window = (lagindices >= peakstart[:, None]) & (lagindices <= peakend[:, None])
+            X = self.corrtimeaxis
+            if self.fastgauss:
+                # do a non-iterative fit over the top of the peak
+                windoweddata = np.where(window, corrfuncs, 0.0)
+                with np.errstate(all='ignore'):
+                    maxlag = np.sum(X[None, :] * windoweddata, axis=1) / np.sum(windoweddata, axis=1)
+                    maxsigma = np.sqrt(np.fabs(np.sum(np.square(X[None, :] - maxlag[:, None]) * windoweddata, axis=1)
+                                               / np.sum(windoweddata, axis=1)))
+                maxval = np.max(np.where(window, corrfuncs, -np.inf), axis=1)
+            else:
+                # do a least squares fit over the top of each peak
+                p0 = np.stack((maxval_init, maxlag_init, maxsigma_init), axis=1)
+                plsq = self._gaussrefine_batch(X, corrfuncs, window, p0)
+
+                # leastsq refuses to fit 3 parameters to fewer than 3 points, which fit treats as a failed fit
+                plsq[np.sum(window, axis=1) < 3, :] = 0.0
+                maxval = plsq[:, 0]
+                maxlag = np.fmod(plsq[:, 1], self.lagmod)
+                maxsigma = plsq[:, 2]
+
+            # check for errors in fit
+            failreason = np.zeros(numvox, dtype=np.uint16)
+            if self.bipolar:
+                lowestcorrcoeff = -1.0
+            else:
+                lowestcorrcoeff = 0.0
+            amplow = maxval < lowestcorrcoeff
+            failreason[amplow] |= (self.FML_FITFAIL + self.FML_BADAMPLOW)
+            maxval[amplow] = lowestcorrcoeff
+            amphigh = np.fabs(maxval) > 1.0
+            failreason[amphigh] |= (self.FML_FITFAIL | self.FML_BADAMPHIGH)
+            maxval[amphigh] = np.sign(maxval[amphigh])
+            lowlag = self.lagmin > maxlag
+            highlag = maxlag > self.lagmax
+            failreason[lowlag | highlag] |= (self.FML_FITFAIL + self.FML_BADLAG)
+            maxlag[lowlag] = self.lagmin
+            maxlag[highlag] = self.lagmax
+            widthhigh = maxsigma > self.absmaxsigma
+            failreason[widthhigh] |= (self.FML_FITFAIL + self.FML_BADWIDTHHIGH)
+            maxsigma[widthhigh] = self.absmaxsigma
+            widthlow = maxsigma < self.absminsigma
+            failreason[widthlow] |= (self.FML_FITFAIL + self.FML_BADWIDTHLOW)
+            maxsigma[widthlow] = self.absminsigma
+            fitfail = amplow | amphigh | lowlag | highlag | widthhigh | widthlow
+            if self.zerooutbadfit:
+                maxval[fitfail] = 0.0
+                maxlag[fitfail] = 0.0
+                maxsigma[fitfail] = 0.0
+            maskval[fitfail] = 0
+        else:
+            maxval = maxval_init
+            maxlag = np.fmod(maxlag_init, self.lagmod)
+            maxsigma = maxsigma_init
+            maskval[failreason > 0] = 0
+
+        return maxindex, maxlag, flipfac * maxval, maxsigma, maskval, failreason, peakstart, peakend
+
+
 class freqtrack:
     freqs = None
     times = None
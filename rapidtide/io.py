@@ -21,9 +21,16 @@
 #
 from __future__ import print_function, division
 
+import atexit
+import hashlib
 import numpy as np
 import sys
 import os
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import json
 import copy
@@ -31,6 +38,11 @@ import copy
 # ---------------------------------------- Global constants -------------------------------------------
 MAXLINES = 10000000
 
+# nifti writing options - None means use the nibabel default compression level
+nifticompresslevel = None
+niftiwritethreads = 1
+niftibyteswritten = 0
+
 # ----------------------------------------- Conditional imports ---------------------------------------
 try:
     import nibabel as nib
@@ -41,13 +53,31 @@ except ImportError:
 
 # ---------------------------------------- NIFTI file manipulation ---------------------------
 if nibabelexists:
-    def readfromnifti(inputfile):
+    def _niftifilename(inputfile):
+        # find the file, adding the standard extensions if they are missing
+        if os.path.isfile(inputfile):
+            return inputfile
+        elif os.path.isfile(inputfile + '.nii.gz'):
+            return inputfile + '.nii.gz'
+        elif os.path.isfile(inputfile + '.nii'):
+            return inputfile + '.nii'
+        else:
+            print('nifti file', inputfile, 'does not exist')
+            sys.exit()
+
+
+    def readfromnifti(inputfile, mmap=False, dtype=None):
         r"""Open a nifti file and read in the various important parts
 
         Parameters
         ----------
         inputfile : str
             The name of the nifti file.
+        mmap : bool, optional
+            If True, return the data without converting it to float64.  Uncompressed, unscaled files are
+            memory mapped (copy on write), so nothing is read until it is used.  Default is False.
+        dtype : numpy dtype, optional
+            If set, convert the data to this type.  Default is float64, or the type on disk if mmap is True.
 
         Returns
         -------
@@ -58,23 +88,83 @@ if nibabelexists:
         thesizes : float array
 
         """
-        if os.path.isfile(inputfile):
-            inputfilename = inputfile
-        elif os.path.isfile(inputfile + '.nii.gz'):
-            inputfilename = inputfile + '.nii.gz'
-        elif os.path.isfile(inputfile + '.nii'):
-            inputfilename = inputfile + '.nii'
+        inputfilename = _niftifilename(inputfile)
+        if mmap:
+            nim = nib.load(inputfilename, mmap=True)
+            nim_data = np.asanyarray(nim.dataobj)
+            if dtype is not None:
+                nim_data = nim_data.astype(dtype, copy=False)
         else:
-            print('nifti file', inputfile, 'does not exist')
-            sys.exit()
-        nim = nib.load(inputfilename)
-        nim_data = nim.get_fdata()
+            nim = nib.load(inputfilename)
+            if dtype is None:
+                nim_data = nim.get_fdata()
+            elif np.issubdtype(np.dtype(dtype), np.floating):
+                nim_data = nim.get_fdata(dtype=dtype)
+            else:
+                nim_data = np.asanyarray(nim.dataobj).astype(dtype)
         nim_hdr = nim.header.copy()
         thedims = nim_hdr['dim'].copy()
         thesizes = nim_hdr['pixdim'].copy()
         return nim, nim_data, nim_hdr, thedims, thesizes
 
 
+    def readniftivoxels(inputfile, validvoxels=None, startpoint=0, endpoint=None, dtype=None, slabsize=4):
+        r"""Read the timecourses of selected voxels from a 4D nifti file without loading the whole file
+
+        Parameters
+        ----------
+        inputfile : str
+            The name of the nifti file.
+        validvoxels : int array, optional
+            Indices of the voxels to read, in the flattened spatial dimensions.  Default is all voxels.
+        startpoint : int, optional
+            The first timepoint to read.  Default is 0.
+        endpoint : int, optional
+            The last timepoint to read (inclusive).  Default is the last timepoint in the file.
+        dtype : numpy dtype, optional
+            The type of the returned array.  Default is the type on disk (or float64 if the file is scaled).
+        slabsize : int, optional
+            The number of planes along the first axis to read at once.  Default is 4.
+
+        Returns
+        -------
+        thedata : 2D array
+            The selected voxels, with shape (number of voxels, number of timepoints)
+
+        """
+        inputfilename = _niftifilename(inputfile)
+        nim = nib.load(inputfilename, mmap=True)
+        theshape = nim.shape
+        if len(theshape) != 4:
+            print('readniftivoxels only supports 4D nifti files')
+            sys.exit()
+        numtimepoints = theshape[3]
+        if endpoint is None:
+            endpoint = numtimepoints - 1
+        numspatiallocs = int(theshape[0]) * int(theshape[1]) * int(theshape[2])
+        if validvoxels is None:
+            validvoxels = np.arange(numspatiallocs)
+        else:
+            validvoxels = np.asarray(validvoxels)
+        if inputfilename.endswith('.gz'):
+            # compressed files can't be sliced efficiently, so decompress once, keeping the type on disk
+            thesource = np.asanyarray(nim.dataobj)
+        else:
+            thesource = nim.dataobj
+        if dtype is None:
+            dtype = np.asarray(thesource[0:1, 0:1, 0:1, 0:1]).dtype
+        thedata = np.zeros((len(validvoxels), endpoint - startpoint + 1), dtype=dtype)
+        planesize = int(theshape[1]) * int(theshape[2])
+        for thestart in range(0, theshape[0], slabsize):
+            theend = min(thestart + slabsize, theshape[0])
+            thepos = np.where((validvoxels >= thestart * planesize) & (validvoxels < theend * planesize))[0]
+            if len(thepos) > 0:
+                theslab = np.asarray(thesource[thestart:theend, :, :, startpoint:endpoint + 1])
+                theslab = theslab.reshape(((theend - thestart) * planesize, endpoint - startpoint + 1))
+                thedata[thepos, :] = theslab[validvoxels[thepos] - thestart * planesize, :]
+        return thedata
+
+
     # dims are the array dimensions along each axis
     def parseniftidims(thedims):
         r"""Split the dims array into individual elements
@@ -109,9 +199,72 @@ if nibabelexists:
         return thesizes[1], thesizes[2], thesizes[3], thesizes[4]
 
 
+    def setniftiwriteoptions(compresslevel=None, nthreads=1):
+        r"""Set how savetonifti compresses its output
+
+        Parameters
+        ----------
+        compresslevel : int, optional
+            gzip compression level, from 0 to 9.  0 writes uncompressed .nii files.  Default is None (use the
+            nibabel default).
+        nthreads : int, optional
+            Number of threads to use for compression.  Default is 1.
+        """
+        global nifticompresslevel, niftiwritethreads
+        nifticompresslevel = compresslevel
+        niftiwritethreads = nthreads
+
+
+    def getniftibyteswritten(reset=False):
+        r"""Return the number of (uncompressed) data bytes savetonifti has written
+
+        Parameters
+        ----------
+        reset : bool, optional
+            Reset the count to zero after reading it.  Default is False.
+
+        Returns
+        -------
+        thecount : int
+        """
+        global niftibyteswritten
+        thecount = niftibyteswritten
+        if reset:
+            niftibyteswritten = 0
+        return thecount
+
+
+    def _writegzip(thebytes, thefilename, compresslevel, nthreads, blocksize=4194304):
+        # compress independent blocks in parallel (zlib releases the GIL) and join them into one gzip member.
+        # Every block but the last ends with a sync flush, so the raw deflate streams can simply be concatenated.
+        theview = memoryview(thebytes).cast('B')
+        numblocks = max(1, (len(theview) + blocksize - 1) // blocksize)
+
+        def compressblock(i):
+            thecompressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+            if i == numblocks - 1:
+                theflush = zlib.Z_FINISH
+            else:
+                theflush = zlib.Z_SYNC_FLUSH
+            return thecompressor.compress(theview[i * blocksize:(i + 1) * blocksize]) + thecompressor.flush(theflush)
+
+        if nthreads > 1:
+            with ThreadPoolExecutor(max_workers=nthreads) as theexecutor:
+                theblocks = list(theexecutor.map(compressblock, range(numblocks)))
+        else:
+            theblocks = [compressblock(i) for i in range(numblocks)]
+        with open(thefilename, 'wb') as thefile:
+            thefile.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, int(time.time()), 0, 255))
+            for theblock in theblocks:
+                thefile.write(theblock)
+            thefile.write(struct.pack('<II', zlib.crc32(theview) & 0xffffffff, len(theview) & 0xffffffff))
+
+
     def savetonifti(thearray, theheader, thename):
         r""" Save a data array out to a nifti file
 
+        Compression of .nii.gz files is set with setniftiwriteoptions.
+
         Parameters
         ----------
         thearray : array-like
@@ -127,6 +280,7 @@ if nibabelexists:
         -------
 
         """
+        global niftibyteswritten
         outputaffine = theheader.get_best_affine()
         qaffine, qcode = theheader.get_qform(coded=True)
         saffine, scode = theheader.get_sform(coded=True)
@@ -171,8 +325,124 @@ if nibabelexists:
             print('type', thedtype, 'is not legal')
             sys.exit()
 
-        output_nifti.to_filename(thename + suffix)
+        if suffix == '.nii.gz':
+            if nifticompresslevel == 0:
+                suffix = '.nii'
+                output_nifti.to_filename(thename + suffix)
+            elif (nifticompresslevel is None) and (niftiwritethreads <= 1):
+                output_nifti.to_filename(thename + suffix)
+            else:
+                if nifticompresslevel is None:
+                    thecompresslevel = nib.openers.Opener.default_compresslevel
+                else:
+                    thecompresslevel = nifticompresslevel
+                _writegzip(output_nifti.to_bytes(), thename + suffix, thecompresslevel, niftiwritethreads)
+        else:
+            output_nifti.to_filename(thename + suffix)
         output_nifti = None
+        niftibyteswritten += thearray.nbytes
+
+
+    class backgroundwriter:
+        def __init__(self, maxpendingbytes=1073741824):
+            r"""Write nifti files on a background thread, so computation can continue while they are saved
+
+            Arrays and headers are copied when they are submitted, so the caller is free to reuse them.
+
+            Parameters
+            ----------
+            maxpendingbytes : int, optional
+                The most memory that copies of unwritten arrays may use.  When a new array would exceed this,
+                savetonifti waits for earlier writes to finish.  Arrays bigger than this are never copied - they are
+                written in the calling thread once everything before them is done.  If 0, files are written
+                immediately, in the calling thread.  Default is 1GB.
+
+            Methods
+            -------
+            savetonifti(thearray, theheader, thename)
+                Queue a file to be written, with the same arguments as io.savetonifti.
+            flush()
+                Wait until everything queued has been written.
+            close()
+                Flush, then stop the background thread.
+            """
+            self.maxpendingbytes = maxpendingbytes
+            self.pendingbytes = 0
+            self.pending = []
+            self.writeerror = None
+            self.running = True
+            self.condition = threading.Condition()
+            self.thread = None
+            if self.maxpendingbytes > 0:
+                self.thread = threading.Thread(target=self._writeloop)
+                self.thread.daemon = True
+                self.thread.start()
+                atexit.register(self.close)
+
+        def _writeloop(self):
+            while True:
+                with self.condition:
+                    while self.running and (len(self.pending) == 0):
+                        self.condition.wait()
+                    if len(self.pending) == 0:
+                        break
+                    thearray, theheader, thename = self.pending[0]
+                try:
+                    savetonifti(thearray, theheader, thename)
+                except BaseException as e:
+                    # savetonifti exits on bad data, which must not kill the thread with the write still pending
+                    self.writeerror = 'could not write ' + thename + ': ' + repr(e)
+                finally:
+                    with self.condition:
+                        self.pending.pop(0)
+                        self.pendingbytes -= thearray.nbytes
+                        self.condition.notify_all()
+
+        def _checkerror(self):
+            if self.writeerror is not None:
+                # only report each error once, so the exit handler doesn't repeat it
+                theerror = self.writeerror
+                self.writeerror = None
+                print('error in background writer:', theerror)
+                sys.exit()
+
+        def savetonifti(self, thearray, theheader, thename):
+            self._checkerror()
+            if self.thread is None:
+                savetonifti(thearray, theheader, thename)
+                return
+            thenbytes = np.asarray(thearray).nbytes
+            if thenbytes > self.maxpendingbytes:
+                # a copy of this array alone would blow the memory budget - write it here, after the files ahead of it
+                self.flush()
+                savetonifti(thearray, theheader, thename)
+                return
+            with self.condition:
+                # wait for room
+                while self.pendingbytes + thenbytes > self.maxpendingbytes:
+                    self.condition.wait()
+                self.pending.append((np.array(thearray), copy.deepcopy(theheader), thename))
+                self.pendingbytes += thenbytes
+                self.condition.notify_all()
+
+        def flush(self):
+            if self.thread is not None:
+                with self.condition:
+                    while len(self.pending) > 0:
+                        self.condition.wait()
+            self._checkerror()
+
+        def close(self):
+            try:
+                self.flush()
+            finally:
+                if self.thread is not None:
+                    with self.condition:
+                        self.running = False
+                        self.condition.notify_all()
+                    self.thread.join()
+                    self.thread = None
+                    atexit.unregister(self.close)
 
 
     def checkifnifti(filename):
@@ -652,6 +922,122 @@ def writedicttojson(thedict, thefilename):
         fp.write(json.dumps(thisdict, sort_keys=True, indent=4, separators=(',', ':')).encode("utf-8"))
 
 
+def writecheckpoint(thedict, thefilename):
+    r"""Save a dictionary of arrays and scalars to a compressed binary checkpoint file
+
+    The file is written under a temporary name and then renamed, so an interrupted write never
+    leaves a truncated checkpoint behind.  Entries that are None are skipped.
+
+    Parameters
+    ----------
+    thedict : dict
+        The arrays and numerical scalars to save
+    thefilename : str
+        The name of the checkpoint file (with extension .npz)
+
+    """
+    thisdict = {}
+    for key in thedict:
+        if thedict[key] is not None:
+            thisdict[key] = np.asarray(thedict[key])
+    tempfilename = thefilename + '.partial.npz'
+    np.savez_compressed(tempfilename, **thisdict)
+    os.replace(tempfilename, thefilename)
+
+
+def readcheckpoint(inputfilename):
+    r"""Read a checkpoint file written by writecheckpoint
+
+    Parameters
+    ----------
+    inputfilename : str
+        The name of the checkpoint file (with extension .npz)
+
+    Returns
+    -------
+    thedict : dict
+        The saved entries.  Scalars are returned as 0 dimensional arrays.
+
+    """
+    thedict = {}
+    with np.load(inputfilename, allow_pickle=False) as thedata:
+        for key in thedata.files:
+            thedict[key] = thedata[key]
+    return thedict
+
+
+def cachekey(*theinputs):
+    r"""Make a key for a cache entry from everything that the cached result depends on
+
+    Parameters
+    ----------
+    theinputs : arrays, numbers, strings, or None
+        The values the cached result depends on.  Arrays are hashed by their type, shape, and contents.
+
+    Returns
+    -------
+    thekey : str
+        A hexadecimal hash of the inputs
+    """
+    thehash = hashlib.sha1()
+    for theinput in theinputs:
+        if isinstance(theinput, np.ndarray):
+            thehash.update(str((theinput.dtype.str, theinput.shape)).encode('utf-8'))
+            thehash.update(np.ascontiguousarray(theinput).tobytes())
+        else:
+            thehash.update(repr(theinput).encode('utf-8'))
+        thehash.update(b'|')
+    return thehash.hexdigest()
+
+
+def readfromcache(cachedir, theprefix, thekey):
+    r"""Read an array saved with writetocache
+
+    Parameters
+    ----------
+    cachedir : str
+        The cache directory
+    theprefix : str
+        The kind of data being cached (used in the file name)
+    thekey : str
+        The key made by cachekey
+
+    Returns
+    -------
+    thearray : array or None
+        The cached array, or None if there is no cache entry for this key
+    """
+    thefilename = os.path.join(cachedir, theprefix + '_' + thekey + '.npy')
+    if os.path.isfile(thefilename):
+        try:
+            return np.load(thefilename, allow_pickle=False)
+        except (IOError, ValueError):
+            print('could not read cache file', thefilename, '- ignoring')
+    return None
+
+
+def writetocache(cachedir, theprefix, thekey, thearray):
+    r"""Save an array to a cache directory
+
+    Parameters
+    ----------
+    cachedir : str
+        The cache directory (created if it does not exist)
+    theprefix : str
+        The kind of data being cached (used in the file name)
+    thekey : str
+        The key made by cachekey
+    thearray : array
+        The data to save
+    """
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir, exist_ok=True)
+    thefilename = os.path.join(cachedir, theprefix + '_' + thekey + '.npy')
+    tempfilename = thefilename + '.' + str(os.getpid()) + '.partial.npy'
+    np.save(tempfilename, np.asarray(thearray), allow_pickle=False)
+    os.replace(tempfilename, thefilename)
+
+
 def readdictfromjson(inputfilename):
     r"""Read key value pairs out of a json file
 
@@ -371,7 +371,7 @@ def corrnormalize(thedata, prewindow=True, detrendorder=1, windowfunc='hamming')
     """
     # detrend first
     if detrendorder > 0:
-        intervec = stdnormalize(tide_fit.detrend(thedata, order=detrendorder, demean=True))
+        intervec = stdnormalize(tide_fit.detrend_batch(thedata, order=detrendorder, demean=True)[0])
     else:
         intervec = stdnormalize(thedata)
 
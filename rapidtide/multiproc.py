@@ -32,12 +32,45 @@ try:
 except ImportError:
     import Queue as thrQueue
 
+import pickle
+import sys
+
+import numpy as np
+
 import rapidtide.util as tide_util
 
+# ctypes typecodes for the array types that can live in shared memory
+sharedtypecodes = {np.dtype('float64'): 'd',
+                   np.dtype('float32'): 'f',
+                   np.dtype('int16'): 'h',
+                   np.dtype('uint16'): 'H',
+                   np.dtype('int32'): 'i',
+                   np.dtype('int64'): 'q'}
+
+
 def maxcpus():
     return mp.cpu_count() - 1
 
 
+def numpy2shared(inarray, thetype):
+    thesize = inarray.size
+    theshape = inarray.shape
+    inarray_shared = mp.RawArray(sharedtypecodes[np.dtype(thetype)], inarray.reshape(thesize))
+    inarray = np.frombuffer(inarray_shared, dtype=thetype, count=thesize)
+    inarray.shape = theshape
+    return inarray, inarray_shared, theshape
+
+
+def allocshared(theshape, thetype):
+    thesize = int(1)
+    for element in theshape:
+        thesize *= int(element)
+    outarray_shared = mp.RawArray(sharedtypecodes[np.dtype(thetype)], thesize)
+    outarray = np.frombuffer(outarray_shared, dtype=thetype, count=thesize)
+    outarray.shape = theshape
+    return outarray, outarray_shared, theshape
+
+
 def _process_data(data_in, inQ, outQ, showprogressbar=True, reportstep=1000, chunksize=10000):
     # send pos/data to workers
     data_out = []
@@ -72,8 +105,8 @@ def _process_data(data_in, inQ, outQ, showprogressbar=True, reportstep=1000, chu
     numreturned = 0
     offset = numchunks * chunksize
 
-    # retrieve the remainder
-    while True:
+    # retrieve the remainder (if there is one - otherwise there is nothing to wait for)
+    while remainder > 0:
         ret = outQ.get()
         if ret is not None:
             data_out.append(ret)
@@ -124,6 +157,317 @@ def run_multiproc(consumerfunc, inputshape, maskarray, nprocs=1, procbyvoxel=Tru
 
     return data_out
 
+def _process_ranges(ranges, inQ, outQ, totalnum, showprogressbar=True):
+    # the ranges are just index arrays, so send them all at once
+    for therange in ranges:
+        inQ.put(therange)
+
+    # collect the completion tokens
+    tokens = []
+    numdone = 0
+    if showprogressbar:
+        tide_util.progressbar(0, totalnum, label="Percent complete")
+    for i in range(len(ranges)):
+        thetoken = outQ.get()
+        tokens.append(thetoken)
+        if showprogressbar and not isinstance(thetoken[0], str):
+            numdone += thetoken[0]
+            tide_util.progressbar(numdone, totalnum, label="Percent complete")
+    print()
+
+    return tokens
+
+
+def run_multiproc_ranges(consumerfunc, inputshape, maskarray, nprocs=1, procbyvoxel=True, showprogressbar=True,
+                         rangesize=1000):
+    """Run consumerfunc on blocks of consecutive indices, rather than one index at a time.
+
+    consumerfunc(inQ, outQ) is sent 1D arrays of (masked) indices.  It must write its results directly into
+    arrays that are in shared memory (see allocshared), and put a small completion token on outQ for each
+    block, whose first element is the number of indices processed.  None on inQ is the termination signal.
+
+    Parameters
+    ----------
+    consumerfunc
+    inputshape
+    maskarray
+    nprocs
+    procbyvoxel
+    showprogressbar
+    rangesize : int
+        Number of indices in each block
+
+    Returns
+    -------
+    tokens : list
+        The completion tokens returned by the workers, in the order they were returned.
+    """
+    # initialize the workers and the queues
+    n_workers = nprocs
+    inQ = mp.Queue()
+    outQ = mp.Queue()
+    workers = [mp.Process(target=consumerfunc, args=(inQ, outQ)) for i in range(n_workers)]
+    for i, w in enumerate(workers):
+        w.start()
+
+    if procbyvoxel:
+        indexaxis = 0
+        procunit = 'voxels'
+    else:
+        indexaxis = 1
+        procunit = 'timepoints'
+
+    # split the indices into blocks
+    if maskarray is None:
+        indices = np.arange(inputshape[indexaxis])
+    else:
+        indices = np.where(np.asarray(maskarray)[:inputshape[indexaxis]] > 0)[0]
+    ranges = [indices[i:i + rangesize] for i in range(0, len(indices), max(1, rangesize))]
+    print('processing', len(indices), procunit + ' in', len(ranges), 'blocks with', n_workers, 'processes')
+    tokens = _process_ranges(ranges, inQ, outQ, len(indices), showprogressbar=showprogressbar)
+
+    # shut down workers
+    for i in range(n_workers):
+        inQ.put(None)
+    for w in workers:
+        w.terminate()
+        w.join()
+
+    return tokens
+
+
+class sharedarrayhandle:
+    # a picklable reference to (a view of) an array that was registered with a workerpool before it started
+    def __init__(self, arraynum, offset, shape, strides, dtype):
+        self.arraynum = arraynum
+        self.offset = offset
+        self.shape = shape
+        self.strides = strides
+        self.dtype = dtype
+
+
+def _resolvestate(updates, sharedarrays):
+    resolved = {}
+    for key, value in updates.items():
+        if isinstance(value, sharedarrayhandle):
+            resolved[key] = np.ndarray(value.shape,
+                                       dtype=value.dtype,
+                                       buffer=sharedarrays[value.arraynum],
+                                       offset=value.offset,
+                                       strides=value.strides)
+        else:
+            resolved[key] = value
+    return resolved
+
+
+def _poolworker(ctrlQ, taskQ, outQ, sharedarrays):
+    state = {}
+    stateversion = 0
+    while True:
+        # get a new task
+        task = taskQ.get()
+
+        # this is the 'TERM' signal
+        if task is None:
+            break
+        thefunc, theversion, indices = task
+
+        # catch up on any state changes sent before this task
+        while stateversion < theversion:
+            updates, stateversion = ctrlQ.get()
+            updates = dict([(key, pickle.loads(value)) for key, value in updates.items()])
+            state.update(_resolvestate(updates, sharedarrays))
+
+        try:
+            outQ.put(thefunc(indices, state))
+        except Exception as e:
+            outQ.put(('error', str(e)))
+
+
+class workerpool:
+    def __init__(self, nprocs, sharedarrays=None, maxstatearraybytes=67108864):
+        r"""A set of worker processes that persists across processing stages.
+
+        The workers are started once, so arrays they need to read or write must be in shared memory (see
+        allocshared) and must be passed in sharedarrays here, before the workers start.  Anything else the
+        workers need is sent with setstate, which only transmits the values that are given to it.
+
+        Parameters
+        ----------
+        nprocs : int
+            The number of worker processes
+        sharedarrays : list of arrays, optional
+            The shared memory arrays the workers will inherit.  Views of these can be sent to the workers with
+            arrayhandle.
+        maxstatearraybytes : int, optional
+            The largest array that setstate will copy to the workers.  Anything bigger should be in shared
+            memory.  Default is 64MB.
+
+        Methods
+        -------
+        arrayhandle(thearray)
+            Return a reference to thearray that can be sent with setstate, or None if thearray is not
+            a view of one of the shared arrays.
+        setstate(**kwargs)
+            Update the named values in every worker's state dictionary.  Values whose pickled form has not
+            changed since they were last sent are skipped.
+        run(thefunc, inputshape, maskarray, procbyvoxel=True, showprogressbar=True, rangesize=1000)
+            Apply thefunc(indices, state) to blocks of (masked) indices and return the tokens it produces.
+        shutdown()
+            Stop the workers.
+        """
+        self.nprocs = nprocs
+        self.maxstatearraybytes = maxstatearraybytes
+        self.stateversion = 0
+        self.statebytes = {}
+        self.sharedarrays = []
+        self.sharedbounds = []
+        if sharedarrays is not None:
+            for thearray in sharedarrays:
+                if (thearray is not None) and thearray.flags['C_CONTIGUOUS']:
+                    self.sharedarrays.append(thearray.reshape(-1).view(np.uint8))
+                    self.sharedbounds.append(np.byte_bounds(thearray))
+        self.taskQ = mp.Queue()
+        self.outQ = mp.Queue()
+        self.ctrlQs = [mp.Queue() for i in range(self.nprocs)]
+        self.workers = [mp.Process(target=_poolworker, args=(self.ctrlQs[i], self.taskQ, self.outQ, self.sharedarrays))
+                        for i in range(self.nprocs)]
+        for w in self.workers:
+            w.daemon = True
+            w.start()
+        print('started a pool of', self.nprocs, 'worker processes')
+
+    def arrayhandle(self, thearray):
+        if thearray is None:
+            return None
+        lowbound, highbound = np.byte_bounds(thearray)
+        for i in range(len(self.sharedbounds)):
+            if (self.sharedbounds[i][0] <= lowbound) and (highbound <= self.sharedbounds[i][1]):
+                return sharedarrayhandle(i, lowbound - self.sharedbounds[i][0], thearray.shape, thearray.strides,
+                                         thearray.dtype)
+        return None
+
+    def setstate(self, **kwargs):
+        # only send the values that are different from what the workers already have.  Each value is pickled
+        # once, and the same bytes are compared with the last ones sent and then sent to every worker.
+        updates = {}
+        for key, value in kwargs.items():
+            if isinstance(value, np.ndarray) and (value.nbytes > self.maxstatearraybytes):
+                print('workerpool: state array', key, 'is', value.nbytes,
+                      'bytes and not in the shared arrays - it must be in shared memory')
+                self.shutdown()
+                sys.exit()
+            thebytes = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            if self.statebytes.get(key) != thebytes:
+                updates[key] = thebytes
+                self.statebytes[key] = thebytes
+        if len(updates) > 0:
+            self.stateversion += 1
+            for ctrlQ in self.ctrlQs:
+                ctrlQ.put((updates, self.stateversion))
+
+    def run(self, thefunc, inputshape, maskarray, procbyvoxel=True, showprogressbar=True, rangesize=1000):
+        if procbyvoxel:
+            indexaxis = 0
+            procunit = 'voxels'
+        else:
+            indexaxis = 1
+            procunit = 'timepoints'
+
+        # split the indices into blocks
+        if maskarray is None:
+            indices = np.arange(inputshape[indexaxis])
+        else:
+            indices = np.where(np.asarray(maskarray)[:inputshape[indexaxis]] > 0)[0]
+        ranges = [(thefunc, self.stateversion, indices[i:i + rangesize])
+                  for i in range(0, len(indices), max(1, rangesize))]
+        print('processing', len(indices), procunit + ' in', len(ranges), 'blocks with', self.nprocs,
+              'pooled processes')
+        tokens = _process_ranges(ranges, self.taskQ, self.outQ, len(indices), showprogressbar=showprogressbar)
+        for thetoken in tokens:
+            if thetoken[0] == 'error':
+                print('error in worker process:', thetoken[1])
+                self.shutdown()
+                sys.exit()
+        return tokens
+
+    def shutdown(self):
+        for i in range(self.nprocs):
+            self.taskQ.put(None)
+        for w in self.workers:
+            w.join()
+
+        # workers that never needed the last state updates leave them unread, so don't wait to flush them at exit
+        for ctrlQ in self.ctrlQs:
+            ctrlQ.cancel_join_thread()
+            ctrlQ.close()
+        print('stopped worker pool')
+
+
+def run_blockfunc(thefunc, state, inputshape, maskarray, nprocs=1, thepool=None, procbyvoxel=True,
+                  showprogressbar=True, rangesize=1000):
+    """Apply thefunc(indices, state) to blocks of indices in parallel, in a persistent pool if one is given.
+
+    thefunc must be a module level function that writes its results into the shared memory arrays in
+    the state dictionary and returns a small token whose first element is the number of indices processed.
+
+    Parameters
+    ----------
+    thefunc
+    state : dict
+        Everything thefunc needs.  When using a pool, arrays that are views of the pool's shared arrays are
+        sent as references; everything else is copied to the workers if it has changed.
+    inputshape
+    maskarray
+    nprocs
+    thepool : workerpool, optional
+    procbyvoxel
+    showprogressbar
+    rangesize
+
+    Returns
+    -------
+    tokens : list
+    """
+    if thepool is not None:
+        poolstate = {}
+        for key, value in state.items():
+            if isinstance(value, np.ndarray):
+                thehandle = thepool.arrayhandle(value)
+                if thehandle is not None:
+                    value = thehandle
+            poolstate[key] = value
+        thepool.setstate(**poolstate)
+        return thepool.run(thefunc, inputshape, maskarray, procbyvoxel=procbyvoxel,
+                           showprogressbar=showprogressbar, rangesize=rangesize)
+    else:
+        # define the consumer function here so it inherits the state
+        def block_consumer(inQ, outQ):
+            while True:
+                try:
+                    # get a new block
+                    val = inQ.get()
+
+                    # this is the 'TERM' signal
+                    if val is None:
+                        break
+
+                    # process the block and send back the token
+                    outQ.put(thefunc(val, state))
+
+                except Exception as e:
+                    # the parent waits for a token for every block, so report the failure rather than dying
+                    outQ.put(('error', str(e)))
+
+        tokens = run_multiproc_ranges(block_consumer, inputshape, maskarray, nprocs=nprocs, procbyvoxel=procbyvoxel,
+                                      showprogressbar=showprogressbar, rangesize=rangesize)
+        for thetoken in tokens:
+            if thetoken[0] == 'error':
+                print('error in worker process:', thetoken[1])
+                sys.exit()
+        return tokens
+
+
 def run_multithread(consumerfunc, inputshape, maskarray, nprocs=1, showprogressbar=True, chunksize=1000):
     # initialize the workers and the queues
     n_workers = nprocs
@@ -0,0 +1,583 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Inference for trained deep learning filter models in plain numpy.
+
+A model trained with rapidtide.dlfilter is exported (by exportmodel) to a single .npz file holding the layer
+configurations and weights.  npdlfilter reads that file and runs the forward pass layer by layer, so applying
+a filter does not require (or import) keras or tensorflow.
+"""
+
+from __future__ import print_function, division
+
+import json
+import os
+import sys
+
+import numpy as np
+from statsmodels.robust.scale import mad
+
+import rapidtide.io as tide_io
+
+npzmodelname = 'model.npz'
+
+
+# --------------------------- activations ------------------------------------------
+def _hard_sigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0.0, 1.0)
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def _elu(x):
+    return np.where(x > 0.0, x, np.expm1(np.minimum(x, 0.0)))
+
+
+def _selu(x):
+    return 1.0507009873554805 * np.where(x > 0.0, x, 1.6732632423543772 * np.expm1(np.minimum(x, 0.0)))
+
+
+activations = {'linear': lambda x: x,
+               'relu': lambda x: np.maximum(x, 0.0),
+               'tanh': np.tanh,
+               'sigmoid': _sigmoid,
+               'hard_sigmoid': _hard_sigmoid,
+               'elu': _elu,
+               'selu': _selu,
+               'softplus': lambda x: np.logaddexp(0.0, x),
+               'softsign': lambda x: x / (1.0 + np.abs(x)),
+               'exponential': np.exp}
+
+
+def getactivation(name):
+    if name is None:
+        return activations['linear']
+    try:
+        return activations[name]
+    except KeyError:
+        print('getactivation: unsupported activation', name)
+        sys.exit()
+
+
+# --------------------------- layers ------------------------------------------------
+def _samepadding(inputlen, effectivelen, stride=1):
+    # matches the tensorflow convention: any odd point of padding goes at the end
+    outputlen = (inputlen + stride - 1) // stride
+    padtotal = np.max([(outputlen - 1) * stride + effectivelen - inputlen, 0])
+    return padtotal // 2, padtotal - padtotal // 2
+
+
+def _padtime(x, padding, kernel_size, dilation_rate):
+    effectivelen = dilation_rate * (kernel_size - 1) + 1
+    if padding == 'same':
+        padbefore, padafter = _samepadding(x.shape[1], effectivelen)
+    elif padding == 'causal':
+        padbefore, padafter = effectivelen - 1, 0
+    elif padding == 'valid':
+        padbefore, padafter = 0, 0
+    else:
+        print('_padtime: unsupported padding', padding)
+        sys.exit()
+    if padbefore + padafter > 0:
+        x = np.pad(x, ((0, 0), (padbefore, padafter), (0, 0)), mode='constant')
+    return x, x.shape[1] - effectivelen + 1
+
+
+def conv1d(x, kernel, bias=None, dilation_rate=1, padding='same'):
+    r"""Keras style 1D convolution (really a correlation) of a batch of sequences.
+
+    Parameters
+    ----------
+    x : 3D array
+        The input, (batch x timepoints x input channels)
+    kernel : 3D array
+        The kernel, (kernel_size x input channels x filters)
+    bias : 1D array, optional
+        The per filter bias
+    dilation_rate : int, optional
+        The spacing between kernel taps.  Default is 1.
+    padding : str, optional
+        'same', 'causal' or 'valid'.  Default is 'same'.
+
+    Returns
+    -------
+    y : 3D array
+        The output, (batch x output timepoints x filters)
+    """
+    kernel_size = kernel.shape[0]
+    xpad, outlen = _padtime(x, padding, kernel_size, dilation_rate)
+    y = np.zeros((x.shape[0], outlen, kernel.shape[2]), dtype=np.float64)
+    for tap in range(kernel_size):
+        offset = tap * dilation_rate
+        y += np.dot(xpad[:, offset:offset + outlen, :], kernel[tap, :, :])
+    if bias is not None:
+        y += bias
+    return y
+
+
+def separableconv1d(x, depthwise_kernel, pointwise_kernel, bias=None, dilation_rate=1, padding='same'):
+    r"""Keras style depthwise separable 1D convolution of a batch of sequences.
+
+    Parameters
+    ----------
+    x : 3D array
+        The input, (batch x timepoints x input channels)
+    depthwise_kernel : 3D array
+        The per channel kernels, (kernel_size x input channels x depth multiplier)
+    pointwise_kernel : 3D array
+        The channel mixing matrix, (1 x input channels * depth multiplier x filters)
+    bias : 1D array, optional
+        The per filter bias
+    dilation_rate : int, optional
+        The spacing between kernel taps.  Default is 1.
+    padding : str, optional
+        'same', 'causal' or 'valid'.  Default is 'same'.
+
+    Returns
+    -------
+    y : 3D array
+        The output, (batch x output timepoints x filters)
+    """
+    kernel_size, numchannels, depth_multiplier = depthwise_kernel.shape
+    xpad, outlen = _padtime(x, padding, kernel_size, dilation_rate)
+    depthwise = np.zeros((x.shape[0], outlen, numchannels, depth_multiplier), dtype=np.float64)
+    for tap in range(kernel_size):
+        offset = tap * dilation_rate
+        depthwise += xpad[:, offset:offset + outlen, :, None] * depthwise_kernel[tap, :, :]
+    y = np.dot(depthwise.reshape((x.shape[0], outlen, numchannels * depth_multiplier)), pointwise_kernel[0, :, :])
+    if bias is not None:
+        y += bias
+    return y
+
+
+def dense(x, kernel, bias=None):
+    y = np.dot(x, kernel)
+    if bias is not None:
+        y += bias
+    return y
+
+
+def batchnorm(x, gamma, beta, moving_mean, moving_variance, epsilon=1e-3):
+    scale = 1.0 / np.sqrt(moving_variance + epsilon)
+    if gamma is not None:
+        scale = scale * gamma
+    offset = -moving_mean * scale
+    if beta is not None:
+        offset = offset + beta
+    return x * scale + offset
+
+
+def lstm(x, kernel, recurrent_kernel, bias=None, activation='tanh', recurrent_activation='hard_sigmoid',
+         return_sequences=True, go_backwards=False):
+    r"""Keras style LSTM over a batch of sequences.  Gates are ordered input, forget, cell, output.
+
+    Parameters
+    ----------
+    x : 3D array
+        The input, (batch x timepoints x input features)
+    kernel : 2D array
+        The input weights, (input features x 4 * units)
+    recurrent_kernel : 2D array
+        The recurrent weights, (units x 4 * units)
+    bias : 1D array, optional
+        The gate biases
+    activation : str, optional
+        The cell and output activation.  Default is 'tanh'.
+    recurrent_activation : str, optional
+        The gate activation.  Default is 'hard_sigmoid'.
+    return_sequences : bool, optional
+        Return the hidden state at every timepoint, rather than only the last.  Default is True.
+    go_backwards : bool, optional
+        Process the sequence in reverse (the returned sequence is in processing order, as in keras).
+
+    Returns
+    -------
+    y : 3D or 2D array
+        The hidden states, (batch x timepoints x units), or (batch x units) if return_sequences is False
+    """
+    theactivation = getactivation(activation)
+    therecurrentactivation = getactivation(recurrent_activation)
+    numunits = recurrent_kernel.shape[0]
+    if go_backwards:
+        x = x[:, ::-1, :]
+    numbatch, numtimepoints = x.shape[0], x.shape[1]
+
+    # the input contribution to every gate can be computed for all timepoints at once
+    xgates = np.dot(x, kernel)
+    if bias is not None:
+        xgates += bias
+
+    h = np.zeros((numbatch, numunits), dtype=np.float64)
+    c = np.zeros((numbatch, numunits), dtype=np.float64)
+    if return_sequences:
+        y = np.zeros((numbatch, numtimepoints, numunits), dtype=np.float64)
+    for t in range(numtimepoints):
+        z = xgates[:, t, :] + np.dot(h, recurrent_kernel)
+        i = therecurrentactivation(z[:, :numunits])
+        f = therecurrentactivation(z[:, numunits:2 * numunits])
+        c = f * c + i * theactivation(z[:, 2 * numunits:3 * numunits])
+        o = therecurrentactivation(z[:, 3 * numunits:])
+        h = o * theactivation(c)
+        if return_sequences:
+            y[:, t, :] = h
+    if return_sequences:
+        return y
+    else:
+        return h
+
+
+def maxpooling1d(x, pool_size=2, strides=None, padding='valid'):
+    if strides is None:
+        strides = pool_size
+    if padding == 'same':
+        padbefore, padafter = _samepadding(x.shape[1], pool_size, stride=strides)
+        x = np.pad(x, ((0, 0), (padbefore, padafter), (0, 0)), mode='constant', constant_values=-np.inf)
+    outlen = (x.shape[1] - pool_size) // strides + 1
+    y = x[:, 0:(outlen - 1) * strides + 1:strides, :]
+    for offset in range(1, pool_size):
+        y = np.maximum(y, x[:, offset:offset + (outlen - 1) * strides + 1:strides, :])
+    return y
+
+
+def upsampling1d(x, size=2):
+    return np.repeat(x, size, axis=1)
+
+
+# --------------------------- models ------------------------------------------------
+def _scalar(theval):
+    # keras stores many 1D parameters as one element lists
+    if isinstance(theval, (list, tuple)):
+        return theval[0]
+    return theval
+
+
+class nplayer:
+    """One layer of an exported keras model"""
+
+    def __init__(self, class_name, config, weights):
+        self.class_name = class_name
+        self.config = config
+        self.weights = [np.asarray(theweight, dtype=np.float64) for theweight in weights]
+        if self.class_name in ['Bidirectional', 'TimeDistributed']:
+            inner = self.config['layer']
+            if self.class_name == 'Bidirectional':
+                # the backward layer is a copy of the forward one that runs in the other direction
+                numinner = len(self.weights) // 2
+                backwardconfig = dict(inner['config'])
+                backwardconfig['go_backwards'] = not backwardconfig.get('go_backwards', False)
+                self.forward_layer = nplayer(inner['class_name'], inner['config'], self.weights[:numinner])
+                self.backward_layer = nplayer(inner['class_name'], backwardconfig, self.weights[numinner:])
+            else:
+                self.inner_layer = nplayer(inner['class_name'], inner['config'], self.weights)
+        elif self.class_name not in ['InputLayer', 'Dropout', 'Activation', 'Conv1D', 'SeparableConv1D', 'Dense',
+                                     'BatchNormalization', 'LSTM', 'MaxPooling1D', 'UpSampling1D']:
+            print('nplayer: unsupported layer type', self.class_name)
+            sys.exit()
+
+    def _withbias(self, numweights):
+        if self.config.get('use_bias', True):
+            return self.weights[numweights]
+        return None
+
+    def apply(self, x):
+        if self.class_name in ['InputLayer', 'Dropout']:
+            # dropout only acts during training
+            return x
+        elif self.class_name == 'Activation':
+            return getactivation(self.config['activation'])(x)
+        elif self.class_name == 'Conv1D':
+            if _scalar(self.config.get('strides', 1)) != 1:
+                print('nplayer: strided convolutions are not supported')
+                sys.exit()
+            y = conv1d(x, self.weights[0], bias=self._withbias(1),
+                       dilation_rate=_scalar(self.config.get('dilation_rate', 1)),
+                       padding=self.config.get('padding', 'valid'))
+            return getactivation(self.config.get('activation'))(y)
+        elif self.class_name == 'SeparableConv1D':
+            if _scalar(self.config.get('strides', 1)) != 1:
+                print('nplayer: strided convolutions are not supported')
+                sys.exit()
+            y = separableconv1d(x, self.weights[0], self.weights[1], bias=self._withbias(2),
+                                dilation_rate=_scalar(self.config.get('dilation_rate', 1)),
+                                padding=self.config.get('padding', 'valid'))
+            return getactivation(self.config.get('activation'))(y)
+        elif self.class_name == 'Dense':
+            y = dense(x, self.weights[0], bias=self._withbias(1))
+            return getactivation(self.config.get('activation'))(y)
+        elif self.class_name == 'BatchNormalization':
+            theweights = list(self.weights)
+            gamma = theweights.pop(0) if self.config.get('scale', True) else None
+            beta = theweights.pop(0) if self.config.get('center', True) else None
+            return batchnorm(x, gamma, beta, theweights[0], theweights[1],
+                             epsilon=self.config.get('epsilon', 1e-3))
+        elif self.class_name == 'LSTM':
+            return lstm(x, self.weights[0], self.weights[1], bias=self._withbias(2),
+                        activation=self.config.get('activation', 'tanh'),
+                        recurrent_activation=self.config.get('recurrent_activation', 'hard_sigmoid'),
+                        return_sequences=self.config.get('return_sequences', False),
+                        go_backwards=self.config.get('go_backwards', False))
+        elif self.class_name == 'Bidirectional':
+            forward = self.forward_layer.apply(x)
+            backward = self.backward_layer.apply(x)
+            if self.forward_layer.config.get('return_sequences', False):
+                backward = backward[:, ::-1, :]
+            merge_mode = self.config.get('merge_mode', 'concat')
+            if merge_mode == 'concat':
+                return np.concatenate((forward, backward), axis=-1)
+            elif merge_mode == 'sum':
+                return forward + backward
+            elif merge_mode == 'ave':
+                return (forward + backward) / 2.0
+            elif merge_mode == 'mul':
+                return forward * backward
+            else:
+                print('nplayer: unsupported merge mode', merge_mode)
+                sys.exit()
+        elif self.class_name == 'TimeDistributed':
+            # the only wrapped layer we support (Dense) already acts on the last axis alone
+            return self.inner_layer.apply(x)
+        elif self.class_name == 'MaxPooling1D':
+            return maxpooling1d(x, pool_size=_scalar(self.config.get('pool_size', 2)),
+                                strides=_scalar(self.config.get('strides', None)),
+                                padding=self.config.get('padding', 'valid'))
+        elif self.class_name == 'UpSampling1D':
+            return upsampling1d(x, size=_scalar(self.config.get('size', 2)))
+
+
+class npmodel:
+    """A sequential stack of nplayers, with a keras-like predict method"""
+
+    def __init__(self, layers):
+        self.layers = layers
+
+    def predict(self, x, batch_size=4096):
+        x = np.asarray(x, dtype=np.float64)
+        outputs = []
+        for start in range(0, x.shape[0], batch_size):
+            y = x[start:start + batch_size]
+            for thelayer in self.layers:
+                y = thelayer.apply(y)
+            outputs.append(y)
+        return np.concatenate(outputs, axis=0)
+
+    def summary(self):
+        for thelayer in self.layers:
+            print(thelayer.class_name, [theweight.shape for theweight in thelayer.weights])
+
+
+def exportmodel(model, filename):
+    r"""Save the layer configurations and weights of a trained sequential keras model to an npz file.
+
+    Only the model object is used, so this does not import keras itself.
+
+    Parameters
+    ----------
+    model : keras Sequential model
+        The trained model
+    filename : str
+        The name of the npz file to write
+    """
+    thelayers = []
+    theweights = {}
+    for layernum, thelayer in enumerate(model.layers):
+        layerweights = thelayer.get_weights()
+        thelayers.append({'class_name': thelayer.__class__.__name__,
+                          'config': thelayer.get_config(),
+                          'numweights': len(layerweights)})
+        for weightnum, theweight in enumerate(layerweights):
+            theweights['layer{:d}_weight{:d}'.format(layernum, weightnum)] = np.asarray(theweight)
+    np.savez(filename, layers=np.array(json.dumps(thelayers)), **theweights)
+
+
+def loadnpzmodel(filename):
+    r"""Read a model written by exportmodel.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the npz file
+
+    Returns
+    -------
+    themodel : npmodel
+        The model, ready for prediction
+    """
+    with np.load(filename, allow_pickle=False) as thedata:
+        thelayers = []
+        for layernum, thelayer in enumerate(json.loads(str(thedata['layers']))):
+            layerweights = [thedata['layer{:d}_weight{:d}'.format(layernum, weightnum)]
+                            for weightnum in range(thelayer['numweights'])]
+            thelayers.append(nplayer(thelayer['class_name'], thelayer['config'], layerweights))
+    return npmodel(thelayers)
+
+
+def npzmodelexists(modelpath, modelname):
+    return os.path.isfile(os.path.join(modelpath, modelname, npzmodelname))
+
+
+# --------------------------- filtering ---------------------------------------------
+def windowedview(thedata, window_size, numwindows):
+    r"""Return overlapping windows of a timecourse as a (numwindows x window_size) array, without copying.
+
+    Window i is thedata[i:i + window_size].  The result is a read-only view of thedata.
+
+    Parameters
+    ----------
+    thedata : 1D array
+        The timecourse
+    window_size : int
+        The length of each window
+    numwindows : int
+        The number of windows
+
+    Returns
+    -------
+    windows : 2D array
+        The windowed view
+    """
+    thedata = np.ascontiguousarray(thedata)
+    if numwindows + window_size - 1 > len(thedata):
+        print('windowedview: not enough points for', numwindows, 'windows of length', window_size)
+        sys.exit()
+    return np.lib.stride_tricks.as_strided(thedata,
+                                           shape=(numwindows, window_size),
+                                           strides=(thedata.strides[0], thedata.strides[0]),
+                                           writeable=False)
+
+
+def overlapadd(windowdata, N_pts):
+    r"""Sum overlapping windows back into a timecourse - the inverse of windowedview, without normalization.
+
+    Parameters
+    ----------
+    windowdata : 2D array
+        The (numwindows x window_size) windows.  Window i starts at point i.
+    N_pts : int
+        The length of the output timecourse
+
+    Returns
+    -------
+    thesum : 1D array
+        The sum of all the windows at each timepoint
+    """
+    numwindows, window_size = windowdata.shape
+    theindices = np.arange(numwindows)[:, None] + np.arange(window_size)[None, :]
+    return np.bincount(theindices.ravel(), weights=np.ravel(windowdata), minlength=N_pts)
+
+
+def applymodel(model, window_size, usebadpts, inputdata, badpts=None):
+    r"""Filter one or more timecourses with a trained model.
+
+    Parameters
+    ----------
+    model : object
+        The model - anything with a keras style predict method
+    window_size : int
+        The window length the model was trained on
+    usebadpts : bool
+        True if the model takes the bad point indicators as a second input channel
+    inputdata : 1D or 2D array
+        The timecourse to filter, or a (numtcs x timepoints) array of timecourses.  All the windows of
+        all the timecourses are passed to the model in a single predict call.
+    badpts : 1D or 2D array, optional
+        The bad point indicators, if the model uses them.  A 1D array is used for every timecourse.
+
+    Returns
+    -------
+    predicteddata : 1D or 2D array
+        The filtered timecourse(s), the same shape as inputdata
+
+    Notes
+    -----
+    For a single timecourse and a model without bad points, the windows are passed to predict as a view of the
+    (scaled) timecourse, so they take no extra memory.  Otherwise the windows of the different timecourses or
+    channels can't be laid out as one strided view, and the (windows x window_size x channels) array given to
+    predict is built in memory, window_size times the size of the input.
+    """
+    inputdata = np.asarray(inputdata)
+    if inputdata.ndim == 1:
+        if badpts is not None:
+            badpts = np.asarray(badpts).reshape((1, -1))
+        return applymodel(model, window_size, usebadpts, inputdata.reshape((1, -1)), badpts=badpts)[0, :]
+
+    numtcs, N_pts = inputdata.shape
+    numwindows = N_pts - window_size - 1
+    initscales = np.array([mad(inputdata[i, :]) for i in range(numtcs)])
+    scaleddata = inputdata / initscales[:, None]
+    if (numtcs == 1) and (not usebadpts):
+        # one channel of one timecourse - the windows go to the model without being copied
+        X = windowedview(scaleddata[0, :], window_size, numwindows)[:, :, None]
+    else:
+        if usebadpts:
+            X = np.zeros((numtcs, numwindows, window_size, 2))
+            if badpts is not None:
+                badpts = np.asarray(badpts) + np.zeros((numtcs, N_pts))
+        else:
+            X = np.zeros((numtcs, numwindows, window_size, 1))
+        for i in range(numtcs):
+            X[i, :, :, 0] = windowedview(scaleddata[i, :], window_size, numwindows)
+            if usebadpts and (badpts is not None):
+                X[i, :, :, 1] = windowedview(badpts[i, :], window_size, numwindows)
+        X = X.reshape((numtcs * numwindows, window_size, X.shape[-1]))
+
+    Y = model.predict(X)
+    Y = Y.reshape((numtcs, numwindows, window_size, -1))
+
+    weightarray = np.zeros(N_pts, dtype=np.float64)
+    weightarray[:] = window_size
+    weightarray[0:window_size] = np.linspace(1.0, window_size, window_size, endpoint=False)
+    weightarray[-(window_size + 1):-1] = np.linspace(window_size, 1.0, window_size, endpoint=False)
+    predicteddata = np.zeros((numtcs, N_pts), dtype=np.float64)
+    for i in range(numtcs):
+        predicteddata[i, :] = initscales[i] * overlapadd(Y[i, :, :, 0], N_pts) / weightarray
+    return predicteddata
+
+
+class npdlfilter:
+    """Apply an exported deep learning filter without keras"""
+    model = None
+    modelpath = None
+    window_size = None
+    usebadpts = False
+    infodict = {}
+
+    def __init__(self, modelpath='.', verbose=False):
+        self.modelpath = modelpath
+        self.verbose = verbose
+        self.initialized = False
+        self.trained = False
+
+    def loadmodel(self, modelname, verbose=False):
+        print('loading', modelname)
+        self.model = loadnpzmodel(os.path.join(self.modelpath, modelname, npzmodelname))
+        if verbose:
+            self.model.summary()
+
+        # now load additional information
+        self.infodict = tide_io.readdictfromjson(os.path.join(self.modelpath, modelname, 'model_meta.json'))
+        self.window_size = self.infodict['window_size']
+        self.usebadpts = self.infodict['usebadpts']
+
+        # model is ready to use
+        self.initialized = True
+        self.trained = True
+
+    def apply(self, inputdata, badpts=None):
+        return applymodel(self.model, self.window_size, self.usebadpts, inputdata, badpts=badpts)
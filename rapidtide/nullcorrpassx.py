@@ -30,12 +30,20 @@ import rapidtide.multiproc as tide_multiproc
 import rapidtide.util as tide_util
 import rapidtide.miscmath as tide_math
 import rapidtide.filter as tide_filt
+import rapidtide.io as tide_io
+import rapidtide.stats as tide_stats
 
 import rapidtide.corrpassx as tide_corrpass
 import rapidtide.corrfitx as tide_corrfit
 import sys
 
 
+def _nullrng(theseed, theindex):
+    # each repetition (or block of repetitions) gets its own child stream of theseed, so the permutations are
+    # independent and don't depend on which process does the work
+    return np.random.default_rng(np.random.SeedSequence(theseed, spawn_key=(int(theindex),)))
+
+
 # note: rawtimecourse has been filtered, but NOT windowed
 def _procOneNullCorrelationx(normalizedreftc,
                              rawtcfft_r, rawtcfft_ang,
@@ -47,15 +55,19 @@ def _procOneNullCorrelationx(normalizedreftc,
                              fixeddelayvalue=0.0,
                              permutationmethod='shuffle',
                              disablethresholds=False,
+                             rng=None,
                              rt_floatset=np.float64,
                              rt_floattype='float64'):
 
+    if rng is None:
+        rng = np.random
+
     # make a shuffled copy of the regressors
     if permutationmethod == 'shuffle':
-        permutedtc = np.random.permutation(normalizedreftc)
+        permutedtc = rng.permutation(normalizedreftc)
     elif permutationmethod == 'phaserandom':
         #permutedtc = tide_filt.ifftfrompolar(rawtcfft_r, np.random.uniform(low=-np.pi, high=np.pi, size=len(rawtcfft_r)))
-        permutedtc = tide_filt.ifftfrompolar(rawtcfft_r, np.random.permutation(rawtcfft_ang))
+        permutedtc = tide_filt.ifftfrompolar(rawtcfft_r, rng.permutation(rawtcfft_ang))
     else:
         print('illegal shuffling method')
         sys.exit()
@@ -82,6 +94,32 @@ def _procOneNullCorrelationx(normalizedreftc,
     return maxval
 
 
+def _procNullBlock(val, state):
+    # make a block of permuted regressors, correlate them all at once, and fit all the peaks together
+    normalizedreftc = state['normalizedreftc']
+    numreps = len(val)
+    therng = _nullrng(state['seed'], val[0])
+    if state['permutationmethod'] == 'shuffle':
+        theorder = np.argsort(therng.random((numreps, len(normalizedreftc))), axis=1)
+        permutedtcs = normalizedreftc[theorder]
+    elif state['permutationmethod'] == 'phaserandom':
+        rawtcfft_ang = state['rawtcfft_ang']
+        theorder = np.argsort(therng.random((numreps, len(rawtcfft_ang))), axis=1)
+        permutedtcs = np.fft.ifft(state['rawtcfft_r'][None, :] * np.exp(1j * rawtcfft_ang[theorder]), axis=1).real
+    else:
+        print('illegal shuffling method')
+        sys.exit()
+
+    # crosscorrelate with original
+    thexcorrs, thexcorr_x, dummy = state['thecorrelator'].run_batch(permutedtcs)
+
+    # fit the correlations
+    thefitter = state['thefitter']
+    thefitter.setcorrtimeaxis(thexcorr_x)
+    maxindex, maxlag, maxval, maxsigma, maskval, failreason, peakstart, peakend = thefitter.fit_batch(thexcorrs)
+    return numreps, val, maxval
+
+
 def getNullDistributionDatax(rawtimecourse,
                              Fs,
                              thecorrelator,
@@ -94,6 +132,15 @@ def getNullDistributionDatax(rawtimecourse,
                              showprogressbar=True,
                              chunksize=1000,
                              permutationmethod='shuffle',
+                             batchsize=1000,
+                             thepool=None,
+                             cachedir=None,
+                             sigtolerance=None,
+                             sigpercentiles=(0.95, 0.99, 0.995, 0.999),
+                             minsigreps=1000,
+                             twotail=False,
+                             nozero=False,
+                             seed=None,
                              rt_floatset=np.float64,
                              rt_floattype='float64'):
     r"""Calculate a set of null correlations to determine the distribution of correlation values.  This can
@@ -123,6 +170,38 @@ def getNullDistributionDatax(rawtimecourse,
     posbins: int
         The upper edge of the search range for correlation peaks, in number of bins above corrorigin
 
+    batchsize: int
+        Number of permutations to generate, correlate, and fit at once.  If greater than 1, each block of
+        permuted regressors is correlated with one batched FFT and fit with the vectorized peak fitter.
+        Set to 1 to do one permutation at a time.
+
+    thepool: workerpool, optional
+        A persistent pool of worker processes to use for the batched calculation instead of starting new ones.
+
+    cachedir: str, optional
+        If set, look for a previously calculated distribution with the same regressor, filter, lag range,
+        fit settings, number of repetitions and permutation method in this directory, and save the
+        distribution there if there isn't one.
+
+    sigtolerance: float, optional
+        If set, treat numestreps as a maximum.  Permutations are done in rounds of at least minsigreps, and the
+        calculation stops once the bootstrap confidence intervals on all of the sigpercentiles thresholds are
+        narrower than +/- sigtolerance.  Requires batchsize > 1.
+
+    sigpercentiles: tuple of floats
+        The percentiles to check for convergence.
+
+    minsigreps: int
+        The number of permutations between convergence checks.
+
+    twotail, nozero: bool
+        Passed to stats.bootstrappercentiles when checking convergence.
+
+    seed: int, optional
+        Seed for the permutations.  Every repetition (or block of repetitions, if batchsize > 1) uses its own
+        random stream spawned from this seed, so the result is the same for any value of nprocs.  If not set,
+        the seed is drawn from numpy's global random state.
+
     """
 
     inputshape = np.asarray([numestreps])
@@ -130,8 +209,90 @@ def getNullDistributionDatax(rawtimecourse,
                                                                                   prewindow=False,
                                                                                   detrendorder=thecorrelator.detrendorder)
                                                       )
+    if cachedir is not None:
+        thefitter_settings = [getattr(thefitter, thename, None) for thename in
+                              ['lagmin', 'lagmax', 'absmaxsigma', 'absminsigma', 'hardlimit', 'bipolar',
+                               'lthreshval', 'uthreshval', 'zerooutbadfit', 'refine', 'useguess', 'maxguess',
+                               'searchfrac', 'fastgauss', 'lagmod', 'enforcethresh']]
+        keyinputs = [normalizedreftc, thecorrelator.prepreftc, Fs,
+                     thecorrelator.lagmininpts, thecorrelator.lagmaxinpts,
+                     thecorrelator.corrweighting, thecorrelator.usewindowfunc,
+                     thecorrelator.windowfunc, thecorrelator.detrendorder,
+                     thecorrelator.ncprefilter.gettype(), thecorrelator.ncprefilter.getfreqs(),
+                     thefitter_settings, numestreps, permutationmethod,
+                     sigtolerance, sigpercentiles, minsigreps, twotail, nozero]
+        if seed is not None:
+            # a seeded distribution can only be reused for the same seed, and the same blocking of the streams
+            keyinputs += [int(seed), batchsize]
+        thekey = tide_io.cachekey(*keyinputs)
+        corrlist = tide_io.readfromcache(cachedir, 'nulldist', thekey)
+        if corrlist is not None:
+            print('using cached null distribution', thekey)
+            return corrlist.astype(rt_floattype)
+
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+
     rawtcfft_r, rawtcfft_ang = tide_filt.polarfft(normalizedreftc)
-    if nprocs > 1:
+    if batchsize > 1:
+        state = {'normalizedreftc': normalizedreftc,
+                 'rawtcfft_r': rawtcfft_r,
+                 'rawtcfft_ang': rawtcfft_ang,
+                 'thecorrelator': thecorrelator,
+                 'thefitter': thefitter,
+                 'permutationmethod': permutationmethod,
+                 'seed': seed}
+        corrlist = np.zeros((numestreps), dtype=rt_floattype)
+        if sigtolerance is None:
+            roundsize = numestreps
+        else:
+            # rounds are a whole number of blocks per process, so the blocks (and their random streams) are the
+            # same as in a fixed length run
+            blocksperround = batchsize * max(nprocs, 1)
+            roundsize = int(np.ceil(minsigreps / blocksperround)) * blocksperround
+        numdone = 0
+        while numdone < numestreps:
+            roundend = min(numdone + roundsize, numestreps)
+            if nprocs > 1:
+                if roundsize < numestreps:
+                    roundmask = np.zeros((numestreps), dtype=np.int8)
+                    roundmask[numdone:roundend] = 1
+                else:
+                    roundmask = None
+                tokens = tide_multiproc.run_blockfunc(_procNullBlock, state,
+                                                      inputshape, roundmask,
+                                                      nprocs=nprocs,
+                                                      thepool=thepool,
+                                                      showprogressbar=showprogressbar,
+                                                      rangesize=batchsize)
+                for thetoken in tokens:
+                    corrlist[thetoken[1]] = thetoken[2]
+            else:
+                for i in range(numdone, roundend, batchsize):
+                    thetoken = _procNullBlock(np.arange(i, min(i + batchsize, roundend)), state)
+                    corrlist[thetoken[1]] = thetoken[2]
+
+                    # progress
+                    if showprogressbar:
+                        tide_util.progressbar(min(i + batchsize, roundend), numestreps, label='Percent complete')
+
+                # jump to line after progress bar
+                print()
+            numdone = roundend
+
+            # see if the thresholds have settled down
+            if (sigtolerance is not None) and (numdone < numestreps):
+                pcts, halfwidths = tide_stats.bootstrappercentiles(corrlist[:numdone], sigpercentiles,
+                                                                   twotail=twotail, nozero=nozero)
+                print('after', numdone, 'repetitions, thresholds are', pcts, '+/-', halfwidths)
+                if np.max(halfwidths) < sigtolerance:
+                    print('thresholds converged - stopping')
+                    corrlist = corrlist[:numdone]
+                    break
+    elif nprocs > 1:
+        if sigtolerance is not None:
+            print('sigtolerance requires batchsize > 1 - doing all', numestreps, 'repetitions')
+
         # define the consumer function here so it inherits most of the arguments
         def nullCorrelation_consumer(inQ, outQ):
             while True:
@@ -144,17 +305,18 @@ def getNullDistributionDatax(rawtimecourse,
                         break
 
                     # process and send the data
-                    outQ.put(_procOneNullCorrelationx(normalizedreftc,
-                                                      rawtcfft_r, rawtcfft_ang,
-                                                      Fs,
-                                                      thecorrelator,
-                                                      thefitter,
-                                                      despeckle_thresh=despeckle_thresh,
-                                                      fixdelay=fixdelay,
-                                                      fixeddelayvalue=fixeddelayvalue,
-                                                      permutationmethod=permutationmethod,
-                                                      rt_floatset=rt_floatset,
-                                                      rt_floattype=rt_floattype))
+                    outQ.put([val, _procOneNullCorrelationx(normalizedreftc,
+                                                            rawtcfft_r, rawtcfft_ang,
+                                                            Fs,
+                                                            thecorrelator,
+                                                            thefitter,
+                                                            despeckle_thresh=despeckle_thresh,
+                                                            fixdelay=fixdelay,
+                                                            fixeddelayvalue=fixeddelayvalue,
+                                                            permutationmethod=permutationmethod,
+                                                            rng=_nullrng(seed, val),
+                                                            rt_floatset=rt_floatset,
+                                                            rt_floattype=rt_floattype)])
 
                 except Exception as e:
                     print("error!", e)
@@ -167,22 +329,17 @@ def getNullDistributionDatax(rawtimecourse,
                                                 chunksize=chunksize)
 
         # unpack the data
-        corrlist = np.asarray(data_out, dtype=rt_floattype)
+        corrlist = np.zeros((numestreps), dtype=rt_floattype)
+        for theresult in data_out:
+            corrlist[theresult[0]] = theresult[1]
     else:
+        if sigtolerance is not None:
+            print('sigtolerance requires batchsize > 1 - doing all', numestreps, 'repetitions')
         corrlist = np.zeros((numestreps), dtype=rt_floattype)
 
         for i in range(0, numestreps):
-            # make a shuffled copy of the regressors
-            if permutationmethod == 'shuffle':
-                permutedtc = np.random.permutation(normalizedreftc)
-            elif permutationmethod == 'phaserandom':
-                # permutedtc = tide_filt.ifftfrompolar(rawtcfft_r, np.random.uniform(low=-np.pi, high=np.pi, size=len(rawtcfft_r)))
-                permutedtc = tide_filt.ifftfrompolar(rawtcfft_r, np.random.permutation(rawtcfft_ang))
-            else:
-                print('illegal shuffling method')
-                sys.exit()
-
-            # crosscorrelate with original, fit, and return the maximum value, and add it to the list
+            # shuffle the regressor, crosscorrelate with original, fit, and return the maximum value, and add it
+            # to the list
             thexcorr = _procOneNullCorrelationx(normalizedreftc,
                                                 rawtcfft_r, rawtcfft_ang,
                                                 Fs,
@@ -192,6 +349,7 @@ def getNullDistributionDatax(rawtimecourse,
                                                 fixdelay=fixdelay,
                                                 fixeddelayvalue=fixeddelayvalue,
                                                 permutationmethod=permutationmethod,
+                                                rng=_nullrng(seed, i),
                                                 rt_floatset=rt_floatset,
                                                 rt_floattype=rt_floattype)
             corrlist[i] = thexcorr
@@ -206,4 +364,6 @@ def getNullDistributionDatax(rawtimecourse,
     # return the distribution data
     numnonzero = len(np.where(corrlist != 0.0)[0])
     print(numnonzero, 'non-zero correlations out of', len(corrlist), '(', 100.0 * numnonzero / len(corrlist), '%)')
+    if cachedir is not None:
+        tide_io.writetocache(cachedir, 'nulldist', thekey, corrlist)
     return corrlist
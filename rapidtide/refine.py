@@ -37,7 +37,7 @@ import rapidtide.multiproc as tide_multiproc
 import rapidtide.resample as tide_resample
 import rapidtide.stats as tide_stats
 
-from sklearn.decomposition import FastICA, PCA
+from sklearn.decomposition import FastICA, PCA, IncrementalPCA
 import numpy as np
 from scipy.stats.stats import pearsonr
 from scipy.signal import welch
@@ -106,6 +106,156 @@ def _procOneVoxelTimeShift(vox,
         return vox, outtc, outweights, None
 
 
+def _procVoxelsTimeShift(fmritcs,
+                         lagstrengths,
+                         R2vals,
+                         lagtimes,
+                         padtrs,
+                         fmritr,
+                         theprefilter,
+                         fmrifreq,
+                         refineprenorm='mean',
+                         lagmaxthresh=5.0,
+                         refineweighting='R',
+                         detrendorder=1,
+                         offsettime=0.0,
+                         filterbeforePCA=False,
+                         rt_floatset=np.float64,
+                         rt_floattype='float64'
+                         ):
+    # the same as _procOneVoxelTimeShift (without the psd), for a (voxels x time) block at once
+    numvoxels = fmritcs.shape[0]
+    if refineprenorm == 'mean':
+        thedivisors = np.mean(fmritcs, axis=1)
+    elif refineprenorm == 'var':
+        thedivisors = np.var(fmritcs, axis=1)
+    elif refineprenorm == 'std':
+        thedivisors = np.std(fmritcs, axis=1)
+    elif refineprenorm == 'invlag':
+        thedivisors = np.where(lagtimes < lagmaxthresh, lagmaxthresh - lagtimes, 0.0)
+    else:
+        thedivisors = np.ones(numvoxels, dtype=rt_floattype)
+    normfacs = np.zeros(numvoxels, dtype=rt_floattype)
+    normfacs[thedivisors != 0.0] = 1.0 / thedivisors[thedivisors != 0.0]
+
+    if refineweighting == 'R':
+        theweights = lagstrengths
+    elif refineweighting == 'R2':
+        theweights = R2vals
+    else:
+        theweights = np.ones(numvoxels, dtype=rt_floattype)
+    normtcs = fmritcs * normfacs[:, None] * theweights[:, None]
+    if detrendorder > 0:
+        normtcs = tide_fit.detrend_batch(normtcs, order=detrendorder, demean=True)
+    shifttrs = -(-offsettime + lagtimes) / fmritr  # lagtime is in seconds
+    shiftedtcs, weights = tide_resample.timeshift_batch(normtcs, shifttrs, padtrs)
+    if filterbeforePCA:
+        for i in range(numvoxels):
+            shiftedtcs[i, :] = theprefilter.apply(fmrifreq, shiftedtcs[i, :])
+            weights[i, :] = theprefilter.apply(fmrifreq, weights[i, :])
+    return shiftedtcs, weights
+
+
+def _timeshiftblock(val, state):
+    # timeshift a block of voxels, writing the results straight into the (shared) output arrays in state
+    shiftedtcs, weights = _procVoxelsTimeShift(state['fmridata'][val, :],
+                                               state['lagstrengths'][val],
+                                               state['R2'][val],
+                                               state['lagtimes'][val],
+                                               state['padtrs'],
+                                               state['fmritr'],
+                                               state['theprefilter'],
+                                               state['fmrifreq'],
+                                               refineprenorm=state['refineprenorm'],
+                                               lagmaxthresh=state['lagmaxthresh'],
+                                               refineweighting=state['refineweighting'],
+                                               detrendorder=state['detrendorder'],
+                                               offsettime=state['offsettime'],
+                                               filterbeforePCA=state['filterbeforePCA'],
+                                               rt_floatset=state['rt_floatset'],
+                                               rt_floattype=state['rt_floattype'])
+    state['shiftedtcs'][val, :] = shiftedtcs
+    state['weights'][val, :] = weights
+    return (len(val),)
+
+
+def _blockindices(theindices, blocksize):
+    return [theindices[i:i + blocksize] for i in range(0, len(theindices), max(1, blocksize))]
+
+
+def _blocksum(thedata, theindices, blocksize=10000):
+    # sum the selected rows of thedata a block at a time
+    thesum = np.zeros(thedata.shape[1], dtype=np.float64)
+    for theblock in _blockindices(theindices, blocksize):
+        thesum += np.sum(thedata[theblock, :], axis=0)
+    return thesum
+
+
+def streamedpca(thedata, theindices, ncomponents=1, solver='randomized', blocksize=10000, oversamples=10, numiters=4):
+    """Find the leading principal components of the rows of thedata selected by theindices, reading a block of
+    rows at a time, so the selected rows are never all copied into memory at once.
+
+    Parameters
+    ----------
+    thedata : 2D numpy array
+        Samples (e.g. voxels) x features (e.g. timepoints).  Can be in shared memory.
+    theindices : 1D numpy array of ints
+        The rows to use
+    ncomponents : int
+        The number of components to find
+    solver : {'randomized', 'incremental'}
+        'randomized' finds the components with a randomized eigendecomposition of the covariance matrix, which
+        takes 2 + numiters passes through the data.  'incremental' uses sklearn's IncrementalPCA, fit one block
+        at a time, which takes one pass.
+    blocksize : int
+        Number of rows to read at once
+    oversamples : int
+        Extra dimensions to use in the randomized range finder
+    numiters : int
+        Number of power iterations for the randomized solver
+
+    Returns
+    -------
+    components : 2D numpy array
+        ncomponents x features, in order of decreasing variance, as in sklearn's PCA.components_
+    themean : 1D numpy array
+        The mean of the selected rows
+    """
+    theblocks = _blockindices(theindices, blocksize)
+    if solver == 'incremental':
+        # every block passed to IncrementalPCA needs at least ncomponents rows
+        if (len(theblocks) > 1) and (len(theblocks[-1]) < ncomponents):
+            theblocks[-2] = np.concatenate((theblocks[-2], theblocks[-1]))
+            theblocks = theblocks[:-1]
+        thefit = IncrementalPCA(n_components=ncomponents)
+        for theblock in theblocks:
+            thefit.partial_fit(thedata[theblock, :])
+        return thefit.components_, thefit.mean_
+    elif solver == 'randomized':
+        themean = _blocksum(thedata, theindices, blocksize=blocksize) / len(theindices)
+
+        def covmult(thevecs):
+            # multiply thevecs by the (unnormalized) covariance matrix of the selected rows
+            theproduct = np.zeros_like(thevecs)
+            for theblock in theblocks:
+                centered = thedata[theblock, :] - themean
+                theproduct += np.dot(centered.T, np.dot(centered, thevecs))
+            return theproduct
+
+        # find an orthonormal basis for the leading subspace, then solve the small eigenproblem within it
+        thedims = min(ncomponents + oversamples, thedata.shape[1])
+        therandomstate = np.random.RandomState(0)
+        Q = np.linalg.qr(covmult(therandomstate.normal(size=(thedata.shape[1], thedims))))[0]
+        for i in range(numiters):
+            Q = np.linalg.qr(covmult(Q))[0]
+        evals, evecs = np.linalg.eigh(np.dot(Q.T, covmult(Q)))
+        theorder = np.argsort(evals)[::-1][:ncomponents]
+        return np.dot(Q, evecs[:, theorder]).T, themean
+    else:
+        print('illegal pca solver', solver)
+        sys.exit()
+
+
 def refineregressor(fmridata,
                     fmritr,
                     shiftedtcs,
@@ -121,7 +271,8 @@ def refineregressor(fmridata,
                     includemask=None,
                     excludemask=None,
                     rt_floatset=np.float64,
-                    rt_floattype='float64'):
+                    rt_floattype='float64',
+                    thepool=None):
     """
 
     Parameters
@@ -158,6 +309,8 @@ def refineregressor(fmridata,
         Function to coerce variable types
     rt_floattype : {'float32', 'float64'}
         Data type for internal variables
+    thepool : workerpool, optional
+        A persistent pool of worker processes to use instead of starting new ones.
 
     Returns
     -------
@@ -218,7 +371,44 @@ def refineregressor(fmridata,
     reportstep = 1000
 
     # timeshift the valid voxels
-    if optiondict['nprocs'] > 1:
+    if (not optiondict['psdfilter']) and ((optiondict['nprocs'] == 1) or optiondict['sharedmem']):
+        # do the voxels in blocks, with one FFT per block
+        state = {'fmridata': fmridata,
+                 'shiftedtcs': shiftedtcs,
+                 'weights': weights,
+                 'lagstrengths': lagstrengths,
+                 'R2': R2,
+                 'lagtimes': lagtimes,
+                 'padtrs': padtrs,
+                 'fmritr': fmritr,
+                 'theprefilter': theprefilter,
+                 'fmrifreq': optiondict['fmrifreq'],
+                 'refineprenorm': optiondict['refineprenorm'],
+                 'lagmaxthresh': optiondict['lagmaxthresh'],
+                 'refineweighting': optiondict['refineweighting'],
+                 'detrendorder': optiondict['detrendorder'],
+                 'offsettime': optiondict['offsettime'],
+                 'filterbeforePCA': optiondict['filterbeforePCA'],
+                 'rt_floatset': rt_floatset,
+                 'rt_floattype': rt_floattype}
+        psdlist = []
+        if optiondict['nprocs'] > 1:
+            tokens = tide_multiproc.run_blockfunc(_timeshiftblock, state,
+                                                  inputshape, shiftmask,
+                                                  nprocs=optiondict['nprocs'],
+                                                  thepool=thepool,
+                                                  showprogressbar=True,
+                                                  rangesize=optiondict['corrbatchsize'])
+        else:
+            shiftvoxels = np.where(shiftmask > 0)[0]
+            batchsize = max(1, optiondict['corrbatchsize'])
+            for i in range(0, len(shiftvoxels), batchsize):
+                _timeshiftblock(shiftvoxels[i:i + batchsize], state)
+                if optiondict['showprogressbar']:
+                    tide_util.progressbar(min(i + batchsize, len(shiftvoxels)), len(shiftvoxels),
+                                          label='Percent complete (timeshifting)')
+            print()
+    elif optiondict['nprocs'] > 1:
         # define the consumer function here so it inherits most of the arguments
         def timeshift_consumer(inQ, outQ):
             while True:
@@ -310,10 +500,15 @@ def refineregressor(fmridata,
 
     # now generate the refined timecourse(s)
     validlist = np.where(refinemask > 0)[0]
-    refinevoxels = shiftedtcs[validlist]
-    refineweights = weights[validlist]
-    weightsum = np.sum(refineweights, axis=0) / volumetotal
-    averagedata = np.sum(refinevoxels, axis=0) / volumetotal
+    if optiondict['pcasolver'] == 'full':
+        refinevoxels = shiftedtcs[validlist]
+        refineweights = weights[validlist]
+        weightsum = np.sum(refineweights, axis=0) / volumetotal
+        averagedata = np.sum(refinevoxels, axis=0) / volumetotal
+    else:
+        # don't copy the refine voxels - just read them from shiftedtcs in blocks
+        weightsum = _blocksum(weights, validlist) / volumetotal
+        averagedata = _blocksum(shiftedtcs, validlist) / volumetotal
     if optiondict['shiftall']:
         invalidlist = np.where((1 - ampmask) > 0)[0]
         discardvoxels = shiftedtcs[invalidlist]
@@ -361,9 +556,20 @@ def refineregressor(fmridata,
 
     if optiondict['refinetype'] == 'ica':
         print('performing ica refinement')
-        thefit = FastICA(n_components=icacomponents).fit(refinevoxels)  # Reconstruct signals
-        print('Using first of ', len(thefit.components_), ' components')
-        icadata = thefit.components_[0]
+        if optiondict['pcasolver'] == 'full':
+            thefit = FastICA(n_components=icacomponents).fit(refinevoxels)  # Reconstruct signals
+            print('Using first of ', len(thefit.components_), ' components')
+            icadata = thefit.components_[0]
+        else:
+            # reduce the data to its leading principal components, then do the ICA in that (small) space
+            pcacomps, pcamean = streamedpca(shiftedtcs, validlist, ncomponents=icacomponents,
+                                            solver=optiondict['pcasolver'])
+            thescores = np.zeros((len(validlist), icacomponents), dtype=np.float64)
+            for theblock in _blockindices(np.arange(len(validlist)), 10000):
+                thescores[theblock, :] = np.dot(shiftedtcs[validlist[theblock], :] - pcamean, pcacomps.T)
+            thefit = FastICA(n_components=icacomponents).fit(thescores)
+            print('Using first of ', len(thefit.components_), ' components')
+            icadata = np.dot(thefit.components_, pcacomps)[0]
         filteredavg = tide_math.corrnormalize(theprefilter.apply(optiondict['fmrifreq'], averagedata), prewindow=True, detrendorder=optiondict['detrendorder'])
         filteredica = tide_math.corrnormalize(theprefilter.apply(optiondict['fmrifreq'], icadata), prewindow=True, detrendorder=optiondict['detrendorder'])
         thepxcorr = pearsonr(filteredavg, filteredica)[0]
@@ -374,9 +580,14 @@ def refineregressor(fmridata,
             outputdata = -1.0 * icadata
     elif optiondict['refinetype'] == 'pca':
         print('performing pca refinement')
-        thefit = PCA(n_components=pcacomponents).fit(refinevoxels)
-        print('Using first of ', len(thefit.components_), ' components')
-        pcadata = thefit.components_[0]
+        if optiondict['pcasolver'] == 'full':
+            thefit = PCA(n_components=pcacomponents).fit(refinevoxels)
+            print('Using first of ', len(thefit.components_), ' components')
+            pcadata = thefit.components_[0]
+        else:
+            # only the first component is used, so that's all we need to find
+            pcacomps, pcamean = streamedpca(shiftedtcs, validlist, ncomponents=1, solver=optiondict['pcasolver'])
+            pcadata = pcacomps[0]
         filteredavg = tide_math.corrnormalize(theprefilter.apply(optiondict['fmrifreq'], averagedata), prewindow=True, detrendorder=optiondict['detrendorder'])
         filteredpca = tide_math.corrnormalize(theprefilter.apply(optiondict['fmrifreq'], pcadata), prewindow=True, detrendorder=optiondict['detrendorder'])
         thepxcorr = pearsonr(filteredavg, filteredpca)[0]
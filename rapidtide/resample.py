@@ -25,7 +25,7 @@ import time
 
 import numpy as np
 import scipy as sp
-from scipy import fftpack, signal
+from scipy import fftpack, signal, sparse
 import pylab as pl
 import sys
 import bisect
@@ -255,6 +255,47 @@ def congrid(xaxis, loc, val, width, kernel='kaiser', cyclic=True, debug=False):
         return val * yvals, yvals, indices
 
 
+def congridmatrix(xaxis, locs, width, kernel='kaiser', cyclic=True, debug=False):
+    """
+    Build the sparse matrix that convolution grids a set of samples on to xaxis.
+
+    Row i holds the kernel weights that congrid would give to a sample at locs[i], so gridding the
+    values of every sample for a set of voxels is one matrix product:
+    np.dot(gridmatrix.T, vals.T).T, where vals is (numvoxels x len(locs)).
+
+    Parameters
+    ----------
+    xaxis: array-like
+        The target axis for resampling
+    locs: array-like
+        The locations, in x-axis units, of the samples to be gridded
+    width: float
+        The width of the gridding kernel in target bins
+    kernel: {'old', 'gauss', 'kaiser'}, optional
+        The type of convolution gridding kernel.  Default is 'kaiser'.
+    cyclic: bool, optional
+        When True, gridding wraps around the endpoints of xaxis.  Default is True.
+    debug: bool, optional
+        When True, output additional information about the gridding process
+
+    Returns
+    -------
+    gridmatrix: sparse csr matrix
+        The (len(locs) x len(xaxis)) gridding matrix.  Column sums are the gridding weights.
+    """
+    rows = []
+    cols = []
+    weights = []
+    for i, loc in enumerate(locs):
+        thevals, theweights, theindices = congrid(xaxis, loc, 1.0, width, kernel=kernel, cyclic=cyclic, debug=debug)
+        rows.append(np.full(len(theindices), i, dtype=np.int64))
+        cols.append(np.asarray(theindices, dtype=np.int64))
+        weights.append(theweights)
+    # duplicate entries are summed, just as they would be by accumulating the congrid results one at a time
+    return sparse.coo_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(len(locs), len(xaxis))).tocsr()
+
+
 class fastresampler:
     def __init__(self, timeaxis, timecourse, padvalue=30.0, upsampleratio=100, doplot=False, debug=False,
                  method='univariate'):
@@ -383,6 +424,66 @@ def doresample(orig_x, orig_y, new_x, method='cubic', padlen=0, antialias=False)
         return None
 
 
+def resamplematrix(orig_x, new_x, method='cubic', padlen=0, antialias=False, threshfrac=1e-12):
+    """
+    Make a sparse matrix that performs the same resampling as doresample.  All of the doresample methods
+    (including the padding and antialiasing) are linear in the data, so the matrix is built by resampling
+    each unit impulse, and the (rapidly decaying) spline weights below threshfrac of the largest weight
+    are dropped.
+
+    Parameters
+    ----------
+    orig_x
+    new_x
+    method
+    padlen
+    antialias
+    threshfrac
+
+    Returns
+    -------
+    theresampmatrix : sparse CSR matrix
+        A (len(new_x) x len(orig_x)) matrix that maps a timecourse on orig_x onto new_x
+
+    """
+    theresampmatrix = np.zeros((len(new_x), len(orig_x)), dtype=np.float64)
+    impulse = np.zeros(len(orig_x), dtype=np.float64)
+    for i in range(len(orig_x)):
+        impulse[i] = 1.0
+        theresampmatrix[:, i] = doresample(orig_x, impulse, new_x, method=method, padlen=padlen,
+                                           antialias=antialias)
+        impulse[i] = 0.0
+    theresampmatrix[np.fabs(theresampmatrix) < threshfrac * np.max(np.fabs(theresampmatrix))] = 0.0
+    return sparse.csr_matrix(theresampmatrix)
+
+
+def batchresample(orig_x, orig_ys, new_x, method='cubic', padlen=0, antialias=False, theresampmatrix=None):
+    """
+    Resample a set of timecourses, arranged as (timecourses x time), from one spacing to another in one
+    operation.  Equivalent to calling doresample on every row.
+
+    Parameters
+    ----------
+    orig_x
+    orig_ys
+    new_x
+    method
+    padlen
+    antialias
+    theresampmatrix : sparse matrix, optional
+        A precomputed matrix from resamplematrix, to reuse across calls with the same axes
+
+    Returns
+    -------
+    new_ys : 2D array
+        The resampled timecourses, arranged as (timecourses x len(new_x))
+
+    """
+    if theresampmatrix is None:
+        theresampmatrix = resamplematrix(orig_x, new_x, method=method, padlen=padlen, antialias=antialias)
+    return np.asarray((theresampmatrix @ np.asarray(orig_ys).T).T)
+
+
 def arbresample(inputdata, init_freq, final_freq,
                 intermed_freq=0.0,
                 method='univariate',
@@ -707,3 +808,61 @@ def timeshift(inputtc, shifttrs, padtrs, doplot=False, debug=False):
 
     return [shifted_y[padtrs:padtrs + thelen], shifted_weights[padtrs:padtrs + thelen], shifted_y,
              shifted_weights]
+
+
+def timeshift_batch(inputtcs, shifttrs, padtrs):
+    """Time shift every row of a (timecourses x time) array by its own amount, with the same
+    reflection padding and Fourier phase ramp as timeshift, but with one real FFT pair for the whole block.
+
+    Parameters
+    ----------
+    inputtcs : 2D numpy array
+        The timecourses, one per row
+    shifttrs : 1D numpy array
+        The shift for each row, in points
+    padtrs : int
+        Number of points of reflected data to pad onto each end
+
+    Returns
+    -------
+    shiftedtcs : 2D numpy array
+        The shifted timecourses (without the padding)
+    shiftedweights : 2D numpy array
+        The shifted weight vectors (without the padding)
+    """
+    inputtcs = np.atleast_2d(inputtcs)
+    shifttrs = np.asarray(shifttrs, dtype='float').reshape(-1)
+    thelen = inputtcs.shape[1]
+    thepaddedlen = thelen + 2 * padtrs
+
+    # pad the data by reflecting it around the ends to eliminate discontinuities
+    preshifted_y = np.zeros((inputtcs.shape[0], thepaddedlen), dtype='float')
+    preshifted_y[:, padtrs:padtrs + thelen] = inputtcs
+    if padtrs > 0:
+        revtcs = inputtcs[:, ::-1]
+        preshifted_y[:, 0:padtrs] = revtcs[:, -padtrs:]
+        preshifted_y[:, padtrs + thelen:] = revtcs[:, 0:padtrs]
+
+    # the phase ramps.  For odd lengths, timeshift's modulation vector has an extra constant phase of
+    # pi * shift / length, which shows up as a cos(pi * shift / length) scale factor once the real part is taken.
+    thefreqs = np.fft.rfftfreq(thepaddedlen)
+    if thepaddedlen % 2 == 1:
+        thescales = np.cos(np.pi * shifttrs / thepaddedlen)
+    else:
+        thescales = np.ones_like(shifttrs)
+
+    uniqueshifts, theinverse = np.unique(shifttrs, return_inverse=True)
+    modvecs = np.exp(-2.0j * np.pi * uniqueshifts[:, None] * thefreqs[None, :])
+
+    # process the data
+    shifted_y = np.fft.irfft(np.fft.rfft(preshifted_y, axis=1) * modvecs[theinverse], n=thepaddedlen, axis=1)
+    shifted_y = shifted_y[:, padtrs:padtrs + thelen] * thescales[:, None]
+
+    # the weight vector is the same for every row, so only transform it once, and only shift it once per
+    # distinct shift
+    weights = np.zeros(thepaddedlen, dtype='float')
+    weights[padtrs:padtrs + thelen] = 1.0
+    shifted_weights = np.fft.irfft(np.fft.rfft(weights)[None, :] * modvecs, n=thepaddedlen, axis=1)
+    shifted_weights = shifted_weights[:, padtrs:padtrs + thelen][theinverse] * thescales[:, None]
+
+    return shifted_y, shifted_weights
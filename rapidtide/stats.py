@@ -115,7 +115,7 @@ def printthresholds(pcts, thepercentiles, labeltext):
         print('\tp <', "{:.3f}".format(1.0 - thepercentiles[i]), ': ', pcts[i])
 
 
-def fitjsbpdf(thehist, histlen, thedata, displayplots=False, nozero=False):
+def fitjsbpdf(thehist, histlen, thedata, displayplots=False, nozero=False, cachedir=None):
     """
 
     Parameters
@@ -125,6 +125,8 @@ def fitjsbpdf(thehist, histlen, thedata, displayplots=False, nozero=False):
     thedata
     displayplots
     nozero
+    cachedir : str, optional
+        If set, reuse a Johnson SB fit to the same data saved in this directory, or save this one there.
 
     Returns
     -------
@@ -139,7 +141,14 @@ def fitjsbpdf(thehist, histlen, thedata, displayplots=False, nozero=False):
     thestore[1, 0] = 0.0
 
     # fit the johnsonSB function
-    params = johnsonsb.fit(thedata[np.where(thedata > 0.0)])
+    params = None
+    if cachedir is not None:
+        thekey = tide_io.cachekey(np.asarray(thedata, dtype=np.float64), histlen, nozero)
+        params = tide_io.readfromcache(cachedir, 'jsbfit', thekey)
+    if params is None:
+        params = johnsonsb.fit(thedata[np.where(thedata > 0.0)])
+        if cachedir is not None:
+            tide_io.writetocache(cachedir, 'jsbfit', thekey, np.asarray(params))
     #print('Johnson SB fit parameters for pdf:', params)
 
     # restore the zero term if needed
@@ -185,7 +194,7 @@ def getjohnsonppf(percentile, params, zeroterm):
 
 
 def sigFromDistributionData(vallist, histlen, thepercentiles, displayplots=False, twotail=False, nozero=False,
-                            dosighistfit=True):
+                            dosighistfit=True, cachedir=None):
     """
 
     Parameters
@@ -197,6 +206,8 @@ def sigFromDistributionData(vallist, histlen, thepercentiles, displayplots=False
     twotail
     nozero
     dosighistfit
+    cachedir : str, optional
+        Directory for caching the Johnson SB fit (see fitjsbpdf)
 
     Returns
     -------
@@ -208,7 +219,8 @@ def sigFromDistributionData(vallist, histlen, thepercentiles, displayplots=False
         return None, 0, 0
     thehistogram = makehistogram(np.abs(vallist), histlen, therange=[0.0, 1.0])
     if dosighistfit:
-        histfit = fitjsbpdf(thehistogram, histlen, vallist, displayplots=displayplots, nozero=nozero)
+        histfit = fitjsbpdf(thehistogram, histlen, vallist, displayplots=displayplots, nozero=nozero,
+                            cachedir=cachedir)
     if twotail:
         thepercentiles = 1.0 - (1.0 - thepercentiles) / 2.0
         print('thepercentiles adapted for two tailed distribution:', thepercentiles)
@@ -220,6 +232,48 @@ def sigFromDistributionData(vallist, histlen, thepercentiles, displayplots=False
         return pcts_data, 0, 0
 
 
+def bootstrappercentiles(vallist, thepercentiles, numboot=200, confidence=0.95, twotail=False, nozero=False):
+    """Estimate percentiles of a distribution along with bootstrap confidence intervals on the estimates.
+
+    Parameters
+    ----------
+    vallist : 1D numpy array
+        The samples from the distribution
+    thepercentiles : array-like
+        The percentiles to estimate, as fractions (e.g. 0.95)
+    numboot : int
+        Number of bootstrap resamplings
+    confidence : float
+        Width of the confidence interval
+    twotail : bool
+        Adapt the percentiles for a two tailed distribution, as in sigFromDistributionData
+    nozero : bool
+        Ignore zero values
+
+    Returns
+    -------
+    pcts : 1D numpy array
+        The percentile estimates
+    halfwidths : 1D numpy array
+        Half the width of the confidence interval on each estimate
+    """
+    thepercentiles = np.asarray(thepercentiles, dtype=np.float64)
+    if twotail:
+        thepercentiles = 1.0 - (1.0 - thepercentiles) / 2.0
+    vallist = np.asarray(vallist)
+    if nozero:
+        vallist = vallist[np.where(vallist != 0.0)]
+    pcts = np.percentile(vallist, 100.0 * thepercentiles)
+
+    # use a private random stream so this doesn't change the global one
+    therandomstate = np.random.RandomState(len(vallist))
+    theresamples = vallist[therandomstate.randint(0, len(vallist), size=(numboot, len(vallist)))]
+    bootpcts = np.percentile(theresamples, 100.0 * thepercentiles, axis=1)
+    lower = np.percentile(bootpcts, 50.0 * (1.0 - confidence), axis=1)
+    upper = np.percentile(bootpcts, 50.0 * (1.0 + confidence), axis=1)
+    return pcts, (upper - lower) / 2.0
+
+
 def rfromp(fitfile, thepercentiles, numbins=1000):
     """
 
@@ -19,7 +19,8 @@ from __future__ import print_function, division
 import numpy as np
 import pylab as plt
 
-from rapidtide.correlate import aliasedcorrelate, aliasedcorrelator
+from rapidtide.correlate import aliasedcorrelate, aliasedcorrelator, corrnormalizerows
+from rapidtide.miscmath import corrnormalize
 
 
 def test_aliasedcorrelate(display=False):
@@ -64,8 +65,37 @@ def test_aliasedcorrelate(display=False):
     #np.testing.assert_almost_equal(fastcorrelate_result, stdcorrelate_result, aethresh)
 
 
+def test_aliasedcorrelator_batch(debug=False):
+    np.random.seed(12345)
+    Fs_hi = 10.0
+    Fs_lo = 1.0
+    inlenhi = 1000
+    inlenlo = 100
+    numsignals = 12
+    width = 2.5
+    timerange = np.linspace(0.0, width, num=51) - width / 2.0
+    sighi = np.random.randn(inlenhi)
+    siglos = np.random.randn(numsignals, inlenlo)
+
+    # normalizing a block of rows matches normalizing them one at a time
+    normrows = corrnormalizerows(siglos)
+    for i in range(numsignals):
+        np.testing.assert_allclose(normrows[i, :], corrnormalize(siglos[i, :]), atol=1e-12)
+
+    # and so does correlating them
+    thecorrelator = aliasedcorrelator(sighi, Fs_hi, Fs_lo, timerange, padvalue=width)
+    for extraoffset in [0.0, -0.37]:
+        corrfuncs = thecorrelator.applybatch(siglos, extraoffset)
+        assert corrfuncs.shape == (numsignals, len(timerange))
+        for i in range(numsignals):
+            if debug:
+                print(extraoffset, i, np.max(np.fabs(corrfuncs[i, :] - thecorrelator.apply(siglos[i, :], extraoffset))))
+            np.testing.assert_allclose(corrfuncs[i, :], thecorrelator.apply(siglos[i, :], extraoffset), atol=1e-12)
+
+
 def main():
     test_aliasedcorrelate(display=True)
+    test_aliasedcorrelator_batch(debug=True)
 
 
 if __name__ == '__main__':
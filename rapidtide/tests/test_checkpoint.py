@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import os
+
+import numpy as np
+
+import rapidtide.io as tide_io
+import rapidtide.multiproc as tide_multiproc
+from rapidtide.tests.utils import get_test_temp_path, create_dir
+
+
+def test_checkpoint(debug=False):
+    # create outputdir if it doesn't exist
+    create_dir(get_test_temp_path())
+    thename = os.path.join(get_test_temp_path(), 'checkpointtest_passcheckpoint.npz')
+    if os.path.isfile(thename):
+        os.remove(thename)
+
+    np.random.seed(12345)
+    numvoxels = 100
+    lagtimes, lagtimes_shared, dummy = tide_multiproc.allocshared((numvoxels,), np.float64)
+    lagtimes[:] = np.random.randn(numvoxels)
+    optiondict = {'offsettime': 1.5, 'lagmod': 1000.0, 'despeckle_thresh': 5, 'acsidelobe': True,
+                  'notsaved': 'value'}
+
+    # save a checkpoint the way rapidtide2x does at the end of each pass
+    thecheckpoint = {'thepass': 2,
+                     'validvoxels': np.arange(0, numvoxels, 2),
+                     'lagtimes': lagtimes,
+                     'refinemask': None}
+    for key in ['offsettime', 'lagmod', 'despeckle_thresh', 'acsidelobe']:
+        thecheckpoint['option_' + key] = optiondict[key]
+    tide_io.writecheckpoint(thecheckpoint, thename)
+    assert os.path.isfile(thename)
+    assert not os.path.isfile(thename + '.partial.npz')
+    savedlagtimes = lagtimes + 0.0
+
+    # an interrupted write must leave the previous checkpoint untouched
+    savez_compressed = np.savez_compressed
+
+    def interruptedsave(filename, **kwargs):
+        with open(filename, 'wb') as thefile:
+            thefile.write(b'truncated')
+        raise KeyboardInterrupt
+
+    np.savez_compressed = interruptedsave
+    try:
+        tide_io.writecheckpoint({'thepass': 3, 'lagtimes': lagtimes * 0.0}, thename)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        np.savez_compressed = savez_compressed
+
+    # now restore it in place, as --resume does
+    lagtimes[:] = 0.0
+    newoptiondict = {'offsettime': 0.0, 'lagmod': 0.0, 'despeckle_thresh': 0, 'acsidelobe': False,
+                     'notsaved': 'value'}
+    restored = tide_io.readcheckpoint(thename)
+    if debug:
+        print(sorted(restored.keys()))
+    assert 'refinemask' not in restored
+    assert int(restored['thepass']) == 2
+    np.testing.assert_array_equal(restored['validvoxels'], np.arange(0, numvoxels, 2))
+    lagtimes[:] = restored['lagtimes']
+    for key in restored:
+        if key.startswith('option_'):
+            newoptiondict[key[len('option_'):]] = restored[key].item()
+    assert newoptiondict == optiondict
+    for key in ['offsettime', 'lagmod', 'despeckle_thresh', 'acsidelobe']:
+        assert type(newoptiondict[key]) == type(optiondict[key])
+
+    # the restored values are in the original shared memory, where the worker processes can see them
+    np.testing.assert_array_equal(lagtimes, savedlagtimes)
+    sharedview = np.frombuffer(lagtimes_shared, dtype=np.float64, count=numvoxels)
+    np.testing.assert_array_equal(sharedview, savedlagtimes)
+    assert np.shares_memory(lagtimes, sharedview)
+    thepool = tide_multiproc.workerpool(1, sharedarrays=[lagtimes])
+    try:
+        assert thepool.arrayhandle(lagtimes) is not None
+    finally:
+        thepool.shutdown()
+
+
+def main():
+    test_checkpoint(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,7 @@ from __future__ import print_function, division
 import numpy as np
 import scipy as sp
 
-from rapidtide.resample import congrid
+from rapidtide.resample import congrid, congridmatrix
 from rapidtide.tests.utils import mse
 
 import matplotlib.pyplot as plt
@@ -134,8 +134,44 @@ def test_congrid(debug=False, display=False):
         for theline in outputlines:
             print(theline)
 
+
+
+def test_congridmatrix(debug=False):
+    np.random.seed(12345)
+    gridlen = 32
+    gridaxis = np.linspace(-np.pi, np.pi, num=gridlen, endpoint=False)
+    numsamples = 150
+    numvoxels = 10
+    locs = np.random.uniform(-np.pi, np.pi, numsamples)
+    locs[1] = locs[0]
+    vals = np.random.randn(numvoxels, numsamples)
+
+    for gridkernel in ['gauss', 'kaiser']:
+        for congridbins in [1.5, 2.0, 3.0]:
+            # accumulate the samples one at a time
+            weights = np.zeros((numvoxels, gridlen), dtype=float)
+            griddeddata = np.zeros((numvoxels, gridlen), dtype=float)
+            for t in range(numsamples):
+                thevals, theweights, theindices = congrid(gridaxis, locs[t], 1.0, congridbins, kernel=gridkernel,
+                                                          cyclic=True)
+                for i in range(len(theindices)):
+                    weights[:, theindices[i]] += theweights[i]
+                    griddeddata[:, theindices[i]] += theweights[i] * vals[:, t]
+
+            # and all at once
+            gridmatrix = congridmatrix(gridaxis, locs, congridbins, kernel=gridkernel, cyclic=True)
+            assert gridmatrix.shape == (numsamples, gridlen)
+            matweights = np.asarray(gridmatrix.sum(axis=0)).reshape((1, -1)) + np.zeros((numvoxels, 1))
+            matgridded = gridmatrix.T.dot(vals.T).T
+            if debug:
+                print(gridkernel, congridbins, np.max(np.fabs(matgridded - griddeddata)))
+            np.testing.assert_allclose(matweights, weights, rtol=1e-10, atol=1e-12)
+            np.testing.assert_allclose(matgridded, griddeddata, rtol=1e-10, atol=1e-12)
+
+
 def main():
     test_congrid(debug=True, display=True)
+    test_congridmatrix(debug=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import numpy as np
+
+import rapidtide.filter as tide_filt
+import rapidtide.helper_classes as tide_classes
+import rapidtide.corrpassx as tide_corrpass
+import rapidtide.multiproc as tide_multiproc
+
+import matplotlib.pyplot as plt
+
+
+def test_correlationpass(debug=False, display=False):
+    # make a set of shifted, noisy copies of a filtered random regressor
+    np.random.seed(12345)
+    timestep = 1.5
+    Fs = 1.0 / timestep
+    tclen = 300
+    numvoxels = 250
+    lfofilter = tide_filt.noncausalfilter(filtertype='lfo')
+    sourcedata = lfofilter.apply(Fs, np.random.randn(tclen + 40))
+    fmridata = np.zeros((numvoxels, tclen), dtype=np.float64)
+    for i in range(numvoxels):
+        shift = np.random.randint(-10, 10)
+        fmridata[i, :] = sourcedata[20 + shift:20 + shift + tclen] + 0.2 * np.random.randn(tclen)
+    referencetc = sourcedata[20:20 + tclen]
+    fmri_x = np.arange(0.0, tclen) * timestep
+
+    lagmininpts = 15
+    lagmaxinpts = 15
+    for weighting in ['none', 'PHAT']:
+        thecorrelator = tide_classes.correlator(Fs=Fs,
+                                                ncprefilter=lfofilter,
+                                                detrendorder=1,
+                                                windowfunc='hamming',
+                                                corrweighting=weighting)
+        thecorrelator.setreftc(referencetc)
+        thecorrelator.setlimits(lagmininpts, lagmaxinpts)
+
+        # check the block correlation against the single timecourse version
+        batchcorrs, batchaxis, batchmaxes = thecorrelator.run_batch(fmridata, trim=False)
+        for i in range(0, numvoxels, 25):
+            thexcorr, theaxis, themax = thecorrelator.run(fmridata[i, :], trim=False)
+            np.testing.assert_allclose(batchcorrs[i, :], thexcorr, atol=1e-10)
+            assert batchmaxes[i] == themax
+        np.testing.assert_allclose(batchaxis, theaxis)
+
+        # now check the full correlation pass in both modes
+        corrlen = lagmininpts + lagmaxinpts
+        results = []
+        for batchsize, nprocs in [(1, 1), (64, 1), (64, 2)]:
+            if nprocs > 1:
+                corrout, dummy, dummy = tide_multiproc.allocshared((numvoxels, corrlen), np.float64)
+                meanval, dummy, dummy = tide_multiproc.allocshared((numvoxels,), np.float64)
+            else:
+                corrout = np.zeros((numvoxels, corrlen), dtype=np.float64)
+                meanval = np.zeros((numvoxels), dtype=np.float64)
+            volumetotal, theglobalmaxlist, thecorrscale = tide_corrpass.correlationpass(fmridata,
+                                                                                         referencetc,
+                                                                                         thecorrelator,
+                                                                                         fmri_x,
+                                                                                         fmri_x,
+                                                                                         thecorrelator.corrorigin,
+                                                                                         lagmininpts,
+                                                                                         lagmaxinpts,
+                                                                                         corrout,
+                                                                                         meanval,
+                                                                                         oversampfactor=1,
+                                                                                         nprocs=nprocs,
+                                                                                         showprogressbar=debug,
+                                                                                         batchsize=batchsize,
+                                                                                         usesharedmem=(nprocs > 1))
+            assert volumetotal == numvoxels
+            results.append([corrout, meanval, np.asarray(theglobalmaxlist), thecorrscale])
+        for theresult in results[1:]:
+            np.testing.assert_allclose(results[0][0], theresult[0], atol=1e-10)
+            np.testing.assert_allclose(results[0][1], theresult[1], atol=1e-10)
+            np.testing.assert_array_equal(results[0][2], theresult[2])
+            np.testing.assert_allclose(results[0][3], theresult[3])
+
+        # run through a persistent pool, twice, changing the reference in between
+        sharedfmridata, dummy, dummy = tide_multiproc.numpy2shared(fmridata, np.float64)
+        corrout, dummy, dummy = tide_multiproc.allocshared((numvoxels, corrlen), np.float64)
+        meanval, dummy, dummy = tide_multiproc.allocshared((numvoxels,), np.float64)
+        thepool = tide_multiproc.workerpool(2, sharedarrays=[sharedfmridata, corrout, meanval])
+        for thereference in [fmridata[0, :], referencetc]:
+            thecorrelator.setreftc(thereference)
+            volumetotal, theglobalmaxlist, thecorrscale = tide_corrpass.correlationpass(sharedfmridata,
+                                                                                         thereference,
+                                                                                         thecorrelator,
+                                                                                         fmri_x,
+                                                                                         fmri_x,
+                                                                                         thecorrelator.corrorigin,
+                                                                                         lagmininpts,
+                                                                                         lagmaxinpts,
+                                                                                         corrout,
+                                                                                         meanval,
+                                                                                         oversampfactor=1,
+                                                                                         nprocs=2,
+                                                                                         showprogressbar=debug,
+                                                                                         batchsize=64,
+                                                                                         usesharedmem=True,
+                                                                                         thepool=thepool)
+            assert volumetotal == numvoxels
+        thepool.shutdown()
+        np.testing.assert_allclose(results[0][0], corrout, atol=1e-10)
+        np.testing.assert_allclose(results[0][1], meanval, atol=1e-10)
+        np.testing.assert_array_equal(results[0][2], np.asarray(theglobalmaxlist))
+
+        if display:
+            plt.figure()
+            plt.imshow(results[1][0], aspect='auto')
+            plt.show()
+
+        # the lag range only modes should match the trimmed full correlation
+        for rangemin, rangemax, expectedmethod in [(3, 3, 'direct'), (150, 150, 'fft')]:
+            thecorrelator.setlimits(rangemin, rangemax)
+            fullcorrs, fullaxis, fullmaxes = thecorrelator.run_batch(fmridata)
+            thecorrelator.setlagrangeonly(True)
+            if weighting == 'none':
+                assert thecorrelator.lagrangemethod == expectedmethod
+            else:
+                assert thecorrelator.lagrangemethod == 'full'
+            rangecorrs, rangeaxis, rangemaxes = thecorrelator.run_batch(fmridata)
+            np.testing.assert_allclose(rangecorrs, fullcorrs, atol=1e-10)
+            np.testing.assert_allclose(rangeaxis, fullaxis)
+            thexcorr, theaxis, themax = thecorrelator.run(fmridata[0, :])
+            np.testing.assert_allclose(thexcorr, fullcorrs[0, :], atol=1e-10)
+            thecorrelator.setlagrangeonly(False)
+
+
+def main():
+    test_correlationpass(debug=True, display=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import numpy as np
+
+import rapidtide.filter as tide_filt
+import rapidtide.helper_classes as tide_classes
+import rapidtide.corrfitx as tide_corrfit
+import rapidtide.resample as tide_resample
+import rapidtide.multiproc as tide_multiproc
+
+import matplotlib.pyplot as plt
+
+
+def test_corrfit(debug=False, display=False):
+    # make some correlation functions from shifted, noisy copies of a filtered random regressor
+    np.random.seed(12345)
+    timestep = 0.5
+    Fs = 1.0 / timestep
+    tclen = 400
+    numvoxels = 300
+    lfofilter = tide_filt.noncausalfilter(filtertype='lfo')
+    sourcedata = lfofilter.apply(Fs, np.random.randn(tclen + 100))
+    fmridata = np.zeros((numvoxels, tclen), dtype=np.float64)
+    for i in range(numvoxels):
+        shift = np.random.randint(-30, 30)
+        fmridata[i, :] = sourcedata[50 + shift:50 + shift + tclen] + 0.3 * np.random.randn(tclen)
+    referencetc = sourcedata[50:50 + tclen]
+    timeaxis = np.arange(0.0, tclen) * timestep
+
+    thecorrelator = tide_classes.correlator(Fs=Fs, ncprefilter=lfofilter)
+    thecorrelator.setreftc(referencetc)
+    thecorrelator.setlimits(60, 60)
+    corrout, corrscale, dummy = thecorrelator.run_batch(fmridata)
+
+    # check the batch fitter against the single voxel fitter
+    thefitter = tide_classes.correlation_fitter(corrtimeaxis=corrscale,
+                                                lagmin=-25.0,
+                                                lagmax=25.0,
+                                                absmaxsigma=100.0,
+                                                lthreshval=0.05,
+                                                refine=True)
+    batchresults = thefitter.fit_batch(corrout)
+    for i in range(numvoxels):
+        singleresults = thefitter.fit(corrout[i, :] + 0.0)
+        if debug:
+            print(i, singleresults, [theresult[i] for theresult in batchresults])
+        for j in [0, 4, 5, 6, 7]:
+            assert singleresults[j] == batchresults[j][i]
+        np.testing.assert_allclose(singleresults[1:4], [batchresults[j][i] for j in range(1, 4)], atol=1e-5)
+
+    # now check the fit pass in both modes, including a despeckle style refit from initial lags
+    lagtcgenerator = tide_resample.fastresampler(timeaxis, referencetc, padvalue=30.0)
+    initiallags = np.where(np.random.rand(numvoxels) > 0.5, batchresults[1] + 0.5, -1000000.0)
+    for theinitiallags in [None, initiallags]:
+        results = []
+        for batchsize, nprocs in [(1, 1), (64, 1), (64, 2)]:
+            if nprocs > 1:
+                lagtc, dummy, dummy = tide_multiproc.allocshared((numvoxels, tclen), np.float64)
+                lagmask, dummy, dummy = tide_multiproc.allocshared((numvoxels,), np.uint16)
+                failimage, dummy, dummy = tide_multiproc.allocshared((numvoxels,), np.uint16)
+                lagtimes, dummy, dummy = tide_multiproc.allocshared((numvoxels,), np.float64)
+                lagstrengths, dummy, dummy = tide_multiproc.allocshared((numvoxels,), np.float64)
+                lagsigma, dummy, dummy = tide_multiproc.allocshared((numvoxels,), np.float64)
+                gaussout, dummy, dummy = tide_multiproc.allocshared(np.shape(corrout), np.float64)
+                windowout, dummy, dummy = tide_multiproc.allocshared(np.shape(corrout), np.float64)
+                R2, dummy, dummy = tide_multiproc.allocshared((numvoxels,), np.float64)
+            else:
+                lagtc = np.zeros((numvoxels, tclen), dtype=np.float64)
+                lagmask = np.zeros(numvoxels, dtype=np.uint16)
+                failimage = np.zeros(numvoxels, dtype=np.uint16)
+                lagtimes = np.zeros(numvoxels, dtype=np.float64)
+                lagstrengths = np.zeros(numvoxels, dtype=np.float64)
+                lagsigma = np.zeros(numvoxels, dtype=np.float64)
+                gaussout = np.zeros(np.shape(corrout), dtype=np.float64)
+                windowout = np.zeros(np.shape(corrout), dtype=np.float64)
+                R2 = np.zeros(numvoxels, dtype=np.float64)
+            volumetotal = tide_corrfit.fitcorrx(lagtcgenerator, timeaxis, lagtc, corrscale, thefitter, corrout,
+                                                lagmask, failimage, lagtimes, lagstrengths, lagsigma,
+                                                gaussout, windowout, R2,
+                                                nprocs=nprocs,
+                                                showprogressbar=debug,
+                                                batchsize=batchsize,
+                                                usesharedmem=(nprocs > 1),
+                                                initiallags=theinitiallags)
+            results.append([volumetotal, lagtc, lagmask, lagtimes, lagstrengths, lagsigma, gaussout, windowout, R2])
+        for theresult in results[1:]:
+            assert results[0][0] == theresult[0]
+            np.testing.assert_array_equal(results[0][2], theresult[2])
+            for j in [1, 3, 4, 5, 6, 7, 8]:
+                np.testing.assert_allclose(results[0][j], theresult[j], atol=1e-4)
+
+    if display:
+        plt.figure()
+        plt.plot(results[0][3], results[1][3], 'o')
+        plt.show()
+
+
+def main():
+    test_corrfit(debug=True, display=True)
+
+
+if __name__ == '__main__':
+    main()
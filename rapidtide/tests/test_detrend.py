@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import numpy as np
+
+from rapidtide.fit import detrend, detrend_batch
+
+
+def test_detrend_batch(debug=False):
+    np.random.seed(12345)
+    numtcs = 25
+    for tclen in [100, 301]:
+        timeaxis = np.linspace(0.0, 10.0, tclen)
+        timecourses = 100.0 + np.random.randn(numtcs, tclen) + \
+                      np.random.randn(numtcs, 1) * timeaxis[None, :] + \
+                      np.random.randn(numtcs, 1) * timeaxis[None, :] ** 2
+        for order in [0, 1, 3]:
+            for demean in [False, True]:
+                # use a small chunk size so the blocks don't divide the rows evenly
+                detrended = detrend_batch(timecourses, order=order, demean=demean, chunksize=7)
+                assert detrended.shape == timecourses.shape
+                for i in range(numtcs):
+                    thetarget = detrend(timecourses[i, :], order=order, demean=demean)
+                    if debug:
+                        print(tclen, order, demean, i, np.max(np.fabs(detrended[i, :] - thetarget)))
+                    np.testing.assert_allclose(detrended[i, :], thetarget, rtol=1e-10, atol=1e-10)
+
+
+def main():
+    test_detrend_batch(debug=True)
+
+
+if __name__ == '__main__':
+    main()
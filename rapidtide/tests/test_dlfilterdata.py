@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+from __future__ import print_function, division
+
+import os
+
+import numpy as np
+
+import rapidtide.dlfilterdata as tide_dlfiltdata
+from rapidtide.tests.utils import get_test_temp_path, create_dir
+
+
+def test_readindata(debug=False):
+    thedir = os.path.join(get_test_temp_path(), 'dlfilterdata')
+    cachedir = os.path.join(thedir, 'cache')
+    create_dir(thedir)
+    create_dir(cachedir)
+    for thefile in os.listdir(cachedir):
+        os.remove(os.path.join(cachedir, thefile))
+
+    # make some paired runs, including ones with a NaN, a short input, and an extreme standard deviation
+    np.random.seed(12345)
+    tclen = 200
+    numruns = 8
+    for i in range(numruns):
+        targetdata = np.random.randn(tclen)
+        inputdata = np.random.randn(tclen)
+        if i == 1:
+            targetdata[10] = np.nan
+        if i == 3:
+            inputdata = inputdata[:150]
+        if i == 6:
+            inputdata *= 100.0
+        np.savetxt(os.path.join(thedir, 'run' + str(i) + '_xyz_sliceres.txt'), targetdata)
+        np.savetxt(os.path.join(thedir, 'run' + str(i) + '_abc_sliceres.txt'), inputdata)
+        np.savetxt(os.path.join(thedir, 'run' + str(i) + '_xyz_sliceres_badpts.txt'),
+                   (np.random.rand(tclen) > 0.9).astype(np.float64))
+        np.savetxt(os.path.join(thedir, 'run' + str(i) + '_abc_sliceres_badpts.txt'),
+                   (np.random.rand(tclen) > 0.9).astype(np.float64))
+    matchedfilelist, thetclen = tide_dlfiltdata.getmatchedfiles(os.path.join(thedir, '*_xyz_sliceres.txt'),
+                                                                usebadpts=True)
+    assert len(matchedfilelist) == numruns
+    assert thetclen == tclen
+    goodruns = [0, 2, 4, 5, 7]
+
+    for usebadpts in [False, True]:
+        # serial and parallel reads match
+        results = []
+        for nprocs in [1, 2]:
+            results.append(tide_dlfiltdata.readindata(matchedfilelist, tclen, usebadpts=usebadpts,
+                                                      startskip=10, endskip=10, nprocs=nprocs))
+        for thearray in [0, 1] + ([3] if usebadpts else []):
+            np.testing.assert_array_equal(results[0][thearray], results[1][thearray])
+        assert results[0][2] == results[1][2]
+        assert results[0][2] == [matchedfilelist[i] for i in goodruns]
+        assert results[0][0].shape == (tclen - 20, len(goodruns))
+        np.testing.assert_allclose(results[0][1][:, 0],
+                                   np.loadtxt(matchedfilelist[0])[10:-10])
+
+        # the first cached read saves the checked data, the second only loads it
+        cachename = tide_dlfiltdata.datacachename(cachedir, matchedfilelist, tclen, usebadpts=usebadpts)
+        assert not os.path.isfile(cachename + '.npy')
+        cachedresults = []
+        for i in range(2):
+            cachedresults.append(tide_dlfiltdata.readindata(matchedfilelist, tclen, usebadpts=usebadpts,
+                                                            startskip=10, endskip=10, nprocs=2,
+                                                            cachedir=cachedir))
+            assert os.path.isfile(cachename + '.npy') and os.path.isfile(cachename + '.json')
+        assert isinstance(cachedresults[1][0], np.memmap)
+        assert not isinstance(cachedresults[0][0], np.memmap)
+        for theresult in cachedresults:
+            for thearray in [0, 1] + ([3] if usebadpts else []):
+                np.testing.assert_array_equal(theresult[thearray], results[0][thearray])
+            assert theresult[2] == results[0][2]
+
+        # the rejection lists survive the round trip, and no temporary files are left behind
+        thecacheinfo = tide_dlfiltdata.tide_io.readdictfromjson(cachename + '.json')
+        if debug:
+            print(thecacheinfo)
+        assert thecacheinfo['nanfiles'] == [matchedfilelist[1]]
+        assert thecacheinfo['shortfiles'] == [tide_dlfiltdata.targettoinput(matchedfilelist[3])]
+        # a NaN also makes the standard deviation fail its check
+        assert thecacheinfo['strangemagfiles'] == [matchedfilelist[1],
+                                                   tide_dlfiltdata.targettoinput(matchedfilelist[6])]
+        assert len([thefile for thefile in os.listdir(cachedir) if 'partial' in thefile]) == 0
+
+        # normalizing the data in place, as prep does, leaves the cache alone
+        cachedresults[1][1][:, :] = 0.0
+        reloaded = tide_dlfiltdata.readindata(matchedfilelist, tclen, usebadpts=usebadpts,
+                                              startskip=10, endskip=10, cachedir=cachedir)
+        np.testing.assert_array_equal(reloaded[1], results[0][1])
+
+
+def main():
+    test_readindata(debug=True)
+
+
+if __name__ == '__main__':
+    main()
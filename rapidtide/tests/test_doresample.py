@@ -17,7 +17,7 @@
 import numpy as np
 import pylab as plt
 
-from rapidtide.resample import doresample, fastresampler
+from rapidtide.resample import doresample, fastresampler, batchresample, resamplematrix
 from rapidtide.tests.utils import mse
 
 
@@ -79,8 +79,28 @@ def test_fastresampler(debug=False):
         plt.show()
 
 
+def test_batchresample(debug=False):
+    tr = 0.72
+    testlen = 300
+    oversampfactor = 4
+    np.random.seed(12345)
+    timeaxis = np.arange(0.0, 1.0 * testlen) * tr
+    newtimeaxis = np.arange(0.0, oversampfactor * testlen - (oversampfactor - 1)) * tr / oversampfactor
+    timecoursesin = np.random.randn(20, testlen)
+
+    for method in ['univariate', 'cubic', 'quadratic']:
+        theresampmatrix = resamplematrix(timeaxis, newtimeaxis, method=method)
+        batchout = batchresample(timeaxis, timecoursesin, newtimeaxis, theresampmatrix=theresampmatrix)
+        for i in range(timecoursesin.shape[0]):
+            singleout = doresample(timeaxis, timecoursesin[i, :], newtimeaxis, method=method)
+            if debug:
+                print(method, i, np.max(np.fabs(batchout[i, :] - singleout)))
+            np.testing.assert_allclose(batchout[i, :], singleout, atol=1e-8)
+
+
 def main():
     test_fastresampler(debug=True)
+    test_batchresample(debug=True)
 
 
 if __name__ == '__main__':
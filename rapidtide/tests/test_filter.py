@@ -181,8 +181,29 @@ def test_filterprops(display=False):
                      display=display)
 
 
+def test_filterblock(debug=False):
+    # filtering a block of timecourses at once must match filtering them one at a time
+    np.random.seed(12345)
+    Fs = 1.0 / 0.72
+    thedata = np.random.randn(6, 417)
+    for filtertype in ['vlf', 'lfo', 'resp', 'cardiac', 'lfo_stop', 'arb', 'arb_stop', 'ringstop', 'none']:
+        for usebutterworth, usetrapfftfilt in [(False, True), (False, False), (True, False)]:
+            for padtime in [30.0, -1.0]:
+                thefilter = noncausalfilter(filtertype=filtertype, usebutterworth=usebutterworth,
+                                            usetrapfftfilt=usetrapfftfilt, padtime=padtime)
+                blockfiltered = thefilter.apply(Fs, thedata)
+                assert blockfiltered.shape == thedata.shape
+                for i in range(thedata.shape[0]):
+                    rowfiltered = thefilter.apply(Fs, thedata[i, :])
+                    if debug:
+                        print(filtertype, usebutterworth, usetrapfftfilt, padtime, i,
+                              np.max(np.fabs(blockfiltered[i, :] - rowfiltered)))
+                    np.testing.assert_allclose(blockfiltered[i, :], rowfiltered, rtol=1e-10, atol=1e-10)
+
+
 def main():
     test_filterprops(display=True)
+    test_filterblock(debug=True)
 
 
 if __name__ == '__main__':
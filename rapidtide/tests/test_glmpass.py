@@ -169,7 +169,45 @@ def test_glmpass(debug=True, display=False):
     if debug:
         print('proc by time, single proc, no mask:', mse(datatoremove, targetarray))
     assert mse(datatoremove, targetarray) < 1e-3
-    
+
+    # fitting items one at a time gives the same answers as fitting them in blocks
+    for procbyvoxel, numitems, theevs in [(True, xsize, twaveforms), (False, tsize, xwaveforms)]:
+        results = []
+        for batchsize in [1, 64]:
+            theoutputs = [np.zeros(numitems, dtype=np.float64) for i in range(5)] + \
+                         [0.0 * testarray, 0.0 * testarray]
+            tide_glmpass.glmpass(numitems, testarray, threshval, theevs,
+                                 *theoutputs,
+                                 showprogressbar=False,
+                                 procbyvoxel=procbyvoxel,
+                                 batchsize=batchsize
+                                 )
+            results.append(theoutputs)
+        for oneatatime, batched in zip(results[0], results[1]):
+            np.testing.assert_allclose(batched, oneatatime, rtol=1e-8, atol=1e-8)
+
+    # a single regressor shared by every voxel
+    theoutputs = [np.zeros(xsize, dtype=np.float64) for i in range(5)] + [0.0 * testarray, 0.0 * testarray]
+    tide_glmpass.glmpass(xsize, testarray, threshval, twaveforms[0, :],
+                         *theoutputs,
+                         showprogressbar=False,
+                         procbyvoxel=True
+                         )
+    if debug:
+        print('shared regressor:', mse(theoutputs[5], targetarray))
+    assert mse(theoutputs[5], targetarray) < 1e-3
+
+    # the factorization of the shared regressor is reused across blocks
+    smallblockoutputs = [np.zeros(xsize, dtype=np.float64) for i in range(5)] + [0.0 * testarray, 0.0 * testarray]
+    tide_glmpass.glmpass(xsize, testarray, threshval, twaveforms[0, :],
+                         *smallblockoutputs,
+                         showprogressbar=False,
+                         procbyvoxel=True,
+                         batchsize=7
+                         )
+    for smallblocks, oneblock in zip(smallblockoutputs, theoutputs):
+        np.testing.assert_allclose(smallblocks, oneblock, rtol=1e-10, atol=1e-10)
+
 
 def main():
     test_glmpass(debug=True, display=True)
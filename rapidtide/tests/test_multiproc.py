@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+from __future__ import print_function, division
+
+import numpy as np
+
+import rapidtide.multiproc as tide_multiproc
+
+
+def _squareblock(indices, state):
+    if np.any(state['thedata'][indices] < 0.0):
+        raise ValueError('negative value in block starting at ' + str(indices[0]))
+    state['theresult'][indices] = state['thedata'][indices] ** 2
+    return len(indices), indices[0]
+
+
+def test_run_blockfunc(debug=False):
+    numitems = 1000
+    thedata, thedata_shared, dummy = tide_multiproc.allocshared((numitems,), np.float64)
+    theresult, theresult_shared, dummy = tide_multiproc.allocshared((numitems,), np.float64)
+    thedata[:] = np.arange(numitems)
+    state = {'thedata': thedata, 'theresult': theresult}
+
+    # every block is processed and reported, with or without a persistent pool
+    for usepool in [False, True]:
+        theresult[:] = 0.0
+        if usepool:
+            thepool = tide_multiproc.workerpool(2, sharedarrays=[thedata, theresult])
+        else:
+            thepool = None
+        tokens = tide_multiproc.run_blockfunc(_squareblock, state, (numitems,), None, nprocs=2, thepool=thepool,
+                                              showprogressbar=False, rangesize=100)
+        if thepool is not None:
+            thepool.shutdown()
+        assert sum([thetoken[0] for thetoken in tokens]) == numitems
+        np.testing.assert_array_equal(theresult, thedata ** 2)
+
+    # a failing block makes the caller exit, rather than wait forever for its token
+    thedata[550] = -1.0
+    exited = False
+    try:
+        tide_multiproc.run_blockfunc(_squareblock, state, (numitems,), None, nprocs=2,
+                                     showprogressbar=False, rangesize=100)
+    except SystemExit:
+        exited = True
+    if debug:
+        print('exited on worker error:', exited)
+    assert exited
+
+
+def _reportstate(indices, state):
+    return len(indices), state['thescale'], float(np.sum(state['thevector']))
+
+
+def test_workerpool_setstate(debug=False):
+    thepool = tide_multiproc.workerpool(2, maxstatearraybytes=1000)
+    thevector = np.ones(10)
+    try:
+        # values are only sent when they change, including in place changes
+        for thescale in [1.0, 1.0, 2.0]:
+            thepool.setstate(thescale=thescale, thevector=thevector)
+            if debug:
+                print('state version', thepool.stateversion)
+            tokens = thepool.run(_reportstate, (20,), None, showprogressbar=False, rangesize=5)
+            for thetoken in tokens:
+                assert thetoken[1] == thescale
+                assert thetoken[2] == np.sum(thevector)
+        assert thepool.stateversion == 2
+        thevector[3] = 5.0
+        thepool.setstate(thescale=2.0, thevector=thevector)
+        assert thepool.stateversion == 3
+        tokens = thepool.run(_reportstate, (20,), None, showprogressbar=False, rangesize=5)
+        assert all([thetoken[2] == 14.0 for thetoken in tokens])
+
+        # large arrays have to be in shared memory
+        exited = False
+        try:
+            thepool.setstate(thevector=np.ones(1000))
+        except SystemExit:
+            exited = True
+        assert exited
+    finally:
+        if thepool.workers[0].is_alive():
+            thepool.shutdown()
+
+
+def main():
+    test_run_blockfunc(debug=True)
+    test_workerpool_setstate(debug=True)
+
+
+if __name__ == '__main__':
+    main()
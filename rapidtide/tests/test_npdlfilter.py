@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import os
+
+import numpy as np
+from statsmodels.robust.scale import mad
+
+import rapidtide.io as tide_io
+import rapidtide.npdlfilter as tide_npdlfilt
+from rapidtide.tests.utils import get_test_temp_path
+
+
+def slowconv(x, kernel, bias, dilation_rate):
+    # 'same' padding, with the extra point of padding for even length kernels at the end
+    numbatch, numtimepoints, numchannels = x.shape
+    kernel_size, dummy, numfilters = kernel.shape
+    padbefore = (dilation_rate * (kernel_size - 1)) // 2
+    y = np.zeros((numbatch, numtimepoints, numfilters))
+    for n in range(numbatch):
+        for t in range(numtimepoints):
+            for tap in range(kernel_size):
+                src = t - padbefore + tap * dilation_rate
+                if 0 <= src < numtimepoints:
+                    y[n, t, :] += np.sum(x[n, src, :][:, None] * kernel[tap, :, :], axis=0)
+    return y + bias
+
+
+def slowlstm(x, kernel, recurrent_kernel, bias):
+    numunits = recurrent_kernel.shape[0]
+    y = np.zeros((x.shape[0], x.shape[1], numunits))
+    for n in range(x.shape[0]):
+        h = np.zeros(numunits)
+        c = np.zeros(numunits)
+        for t in range(x.shape[1]):
+            z = np.dot(x[n, t, :], kernel) + np.dot(h, recurrent_kernel) + bias
+            i = 1.0 / (1.0 + np.exp(-z[:numunits]))
+            f = 1.0 / (1.0 + np.exp(-z[numunits:2 * numunits]))
+            c = f * c + i * np.tanh(z[2 * numunits:3 * numunits])
+            o = 1.0 / (1.0 + np.exp(-z[3 * numunits:]))
+            h = o * np.tanh(c)
+            y[n, t, :] = h
+    return y
+
+
+def slowapply(model, window_size, usebadpts, inputdata, badpts=None):
+    # filter one timecourse a window at a time
+    initscale = mad(inputdata)
+    scaleddata = inputdata / initscale
+    predicteddata = scaleddata * 0.0
+    weightarray = scaleddata * 0.0
+    N_pts = len(scaleddata)
+    if usebadpts:
+        if badpts is None:
+            badpts = scaleddata * 0.0
+        X = np.zeros(((N_pts - window_size - 1), window_size, 2))
+        for i in range(X.shape[0]):
+            X[i, :, 0] = scaleddata[i:i + window_size]
+            X[i, :, 1] = badpts[i:i + window_size]
+    else:
+        X = np.zeros(((N_pts - window_size - 1), window_size, 1))
+        for i in range(X.shape[0]):
+            X[i, :, 0] = scaleddata[i:i + window_size]
+
+    Y = model.predict(X)
+    for i in range(X.shape[0]):
+        predicteddata[i:i + window_size] += Y[i, :, 0]
+
+    weightarray[:] = window_size
+    weightarray[0:window_size] = np.linspace(1.0, window_size, window_size, endpoint=False)
+    weightarray[-(window_size + 1):-1] = np.linspace(window_size, 1.0, window_size, endpoint=False)
+    return initscale * predicteddata / weightarray
+
+
+class stubmodel:
+    # a fixed nonlinear map from each window to an output window that depends on the position in the window, the
+    # window as a whole, and the bad points
+    def __init__(self, window_size):
+        self.positionweights = np.linspace(0.5, 1.5, window_size)
+        self.inputs = []
+
+    def predict(self, x, batch_size=None):
+        self.inputs.append(x)
+        y = self.positionweights[None, :, None] * x[:, :, :1] + 0.2 * np.mean(x[:, :, :1], axis=1)[:, None, :]
+        if x.shape[2] > 1:
+            y += 0.5 * x[:, :, 1:2]
+        return np.tanh(y)
+
+
+class fakelayer:
+    # just enough of a keras layer for exportmodel
+    def __init__(self, class_name, config, weights):
+        self.__class__ = type(class_name, (fakelayer,), {})
+        self.config = config
+        self.weights = weights
+
+    def get_config(self):
+        return self.config
+
+    def get_weights(self):
+        return self.weights
+
+
+class fakemodel:
+    def __init__(self, layers):
+        self.layers = layers
+
+
+def test_layers(debug=False):
+    np.random.seed(12345)
+    x = np.random.randn(3, 40, 2)
+
+    # convolutions, including dilated and even length kernels
+    for kernel_size in [4, 5]:
+        for dilation_rate in [1, 3]:
+            kernel = np.random.randn(kernel_size, 2, 6)
+            bias = np.random.randn(6)
+            fast = tide_npdlfilt.conv1d(x, kernel, bias=bias, dilation_rate=dilation_rate, padding='same')
+            slow = slowconv(x, kernel, bias, dilation_rate)
+            if debug:
+                print('conv1d', kernel_size, dilation_rate, np.max(np.fabs(fast - slow)))
+            assert fast.shape == slow.shape
+            assert np.allclose(fast, slow)
+
+    # a separable convolution is a per channel convolution followed by a pointwise one
+    depthwise_kernel = np.random.randn(5, 2, 3)
+    pointwise_kernel = np.random.randn(1, 6, 4)
+    bias = np.random.randn(4)
+    fast = tide_npdlfilt.separableconv1d(x, depthwise_kernel, pointwise_kernel, bias=bias, dilation_rate=2)
+    fullkernel = np.zeros((5, 2, 6))
+    for channel in range(2):
+        fullkernel[:, channel, channel * 3:(channel + 1) * 3] = depthwise_kernel[:, channel, :]
+    slow = np.dot(slowconv(x, fullkernel, 0.0, 2), pointwise_kernel[0, :, :]) + bias
+    if debug:
+        print('separableconv1d', np.max(np.fabs(fast - slow)))
+    assert np.allclose(fast, slow)
+
+    # lstm, forwards and backwards
+    kernel = np.random.randn(2, 16) * 0.5
+    recurrent_kernel = np.random.randn(4, 16) * 0.5
+    bias = np.random.randn(16) * 0.5
+    fast = tide_npdlfilt.lstm(x, kernel, recurrent_kernel, bias=bias, recurrent_activation='sigmoid')
+    slow = slowlstm(x, kernel, recurrent_kernel, bias)
+    if debug:
+        print('lstm', np.max(np.fabs(fast - slow)))
+    assert np.allclose(fast, slow)
+    fast = tide_npdlfilt.lstm(x, kernel, recurrent_kernel, bias=bias, recurrent_activation='sigmoid',
+                              go_backwards=True)
+    assert np.allclose(fast, slowlstm(x[:, ::-1, :], kernel, recurrent_kernel, bias))
+
+    # pooling and upsampling
+    pooled = tide_npdlfilt.maxpooling1d(x[:, :39, :], pool_size=2, padding='same')
+    assert pooled.shape == (3, 20, 2)
+    assert np.allclose(pooled[:, :19, :], np.maximum(x[:, 0:38:2, :], x[:, 1:38:2, :]))
+    assert np.allclose(pooled[:, 19, :], x[:, 38, :])
+    assert np.allclose(tide_npdlfilt.upsampling1d(pooled)[:, ::2, :], pooled)
+
+
+def test_exportmodel(debug=False):
+    np.random.seed(12345)
+    window_size = 30
+    num_filters = 4
+    kernel_size = 5
+
+    # a small cnn, laid out the way dlfilter.cnn builds it
+    layers = []
+    theweights = []
+    for layer in range(3):
+        inputsize = 1 if layer == 0 else num_filters
+        outputsize = 1 if layer == 2 else num_filters
+        kernel = np.random.randn(kernel_size, inputsize, outputsize).astype(np.float32) * 0.3
+        bias = np.random.randn(outputsize).astype(np.float32) * 0.1
+        layers.append(fakelayer('Conv1D', {'padding': 'same', 'dilation_rate': [2 if layer == 1 else 1],
+                                           'strides': [1], 'activation': 'linear', 'use_bias': True},
+                                [kernel, bias]))
+        theweights.append((kernel, bias))
+        if layer < 2:
+            bnweights = [np.random.rand(outputsize) + 0.5, np.random.randn(outputsize) * 0.1,
+                         np.random.randn(outputsize) * 0.1, np.random.rand(outputsize) + 0.5]
+            layers.append(fakelayer('BatchNormalization', {'epsilon': 0.001, 'center': True, 'scale': True},
+                                    bnweights))
+            theweights.append(bnweights)
+            layers.append(fakelayer('Dropout', {'rate': 0.3}, []))
+            layers.append(fakelayer('Activation', {'activation': 'tanh'}, []))
+
+    modelpath = get_test_temp_path()
+    modelname = 'npdlfilter_testmodel'
+    try:
+        os.makedirs(os.path.join(modelpath, modelname))
+    except OSError:
+        pass
+    tide_npdlfilt.exportmodel(fakemodel(layers), os.path.join(modelpath, modelname, tide_npdlfilt.npzmodelname))
+    tide_io.writedicttojson({'window_size': window_size, 'usebadpts': False},
+                            os.path.join(modelpath, modelname, 'model_meta.json'))
+    assert tide_npdlfilt.npzmodelexists(modelpath, modelname)
+
+    thefilter = tide_npdlfilt.npdlfilter(modelpath=modelpath)
+    thefilter.loadmodel(modelname)
+    assert thefilter.window_size == window_size
+
+    # compare the loaded model to the same network written out by hand
+    x = np.random.randn(5, window_size, 1)
+    y = x
+    for layer in range(3):
+        kernel, bias = theweights[2 * layer]
+        y = slowconv(y, kernel.astype(np.float64), bias.astype(np.float64), 2 if layer == 1 else 1)
+        if layer < 2:
+            gamma, beta, mean, var = theweights[2 * layer + 1]
+            y = np.tanh(gamma * (y - mean) / np.sqrt(var + 0.001) + beta)
+    predicted = thefilter.model.predict(x, batch_size=2)
+    if debug:
+        print('exported cnn', np.max(np.fabs(predicted - y)))
+    assert np.allclose(predicted, y)
+
+    # filtering a timecourse uses the model on every window
+    tc = np.sin(np.linspace(0.0, 20.0, 200)) + 0.1 * np.random.randn(200)
+    filtered = thefilter.apply(tc)
+    assert filtered.shape == tc.shape
+    assert np.allclose(thefilter.apply(np.vstack((tc, 2.0 * tc)))[1, :], 2.0 * filtered)
+
+
+def test_windowedview(debug=False):
+    np.random.seed(12345)
+    thedata = np.random.randn(100)
+    window_size = 16
+    numwindows = 100 - window_size - 1
+
+    # the windows are a read only view of the data
+    thewindows = tide_npdlfilt.windowedview(thedata, window_size, numwindows)
+    assert thewindows.shape == (numwindows, window_size)
+    for i in range(numwindows):
+        np.testing.assert_array_equal(thewindows[i, :], thedata[i:i + window_size])
+    assert np.shares_memory(thewindows, thedata)
+    assert not thewindows.flags.writeable
+    try:
+        tide_npdlfilt.windowedview(thedata, window_size, 100 - window_size + 2)
+    except SystemExit:
+        pass
+    else:
+        assert False
+
+    # overlapadd sums the windows back into place
+    windowdata = np.random.randn(numwindows, window_size)
+    slowsum = np.zeros(100, dtype=np.float64)
+    for i in range(numwindows):
+        slowsum[i:i + window_size] += windowdata[i, :]
+    fastsum = tide_npdlfilt.overlapadd(windowdata, 100)
+    if debug:
+        print('overlapadd', np.max(np.fabs(fastsum - slowsum)))
+    np.testing.assert_allclose(fastsum, slowsum, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(tide_npdlfilt.overlapadd(thewindows, 100)[window_size:numwindows],
+                               window_size * thedata[window_size:numwindows])
+
+
+def test_applymodel(debug=False):
+    np.random.seed(12345)
+    window_size = 20
+    numtcs = 3
+    N_pts = 150
+    inputdata = np.random.randn(numtcs, N_pts) * np.array([1.0, 3.0, 0.2])[:, None]
+    badpts = (np.random.rand(numtcs, N_pts) > 0.9).astype(np.float64)
+
+    for usebadpts in [False, True]:
+        for thebadpts in ([None, badpts[0, :], badpts] if usebadpts else [None]):
+            themodel = stubmodel(window_size)
+
+            # a single timecourse
+            onebadpts = None if thebadpts is None else badpts[0, :]
+            fast = tide_npdlfilt.applymodel(themodel, window_size, usebadpts, inputdata[0, :], badpts=onebadpts)
+            slow = slowapply(themodel, window_size, usebadpts, inputdata[0, :], badpts=onebadpts)
+            if debug:
+                print('1D', usebadpts, np.shape(thebadpts), np.max(np.fabs(fast - slow)))
+            assert fast.shape == (N_pts,)
+            np.testing.assert_allclose(fast, slow, rtol=1e-12, atol=1e-12)
+
+            # without bad points, the windows of a single timecourse are passed to the model as a view
+            if not usebadpts:
+                assert themodel.inputs[0].shape == (N_pts - window_size - 1, window_size, 1)
+                assert themodel.inputs[0].strides[0] == themodel.inputs[0].itemsize
+
+            # all the timecourses at once, in one predict call
+            themodel.inputs = []
+            fast = tide_npdlfilt.applymodel(themodel, window_size, usebadpts, inputdata, badpts=thebadpts)
+            assert len(themodel.inputs) == 1
+            assert fast.shape == inputdata.shape
+            for i in range(numtcs):
+                if (thebadpts is None) or (thebadpts.ndim == 1):
+                    rowbadpts = thebadpts
+                else:
+                    rowbadpts = thebadpts[i, :]
+                slow = slowapply(themodel, window_size, usebadpts, inputdata[i, :], badpts=rowbadpts)
+                if debug:
+                    print('2D', usebadpts, np.shape(thebadpts), i, np.max(np.fabs(fast[i, :] - slow)))
+                np.testing.assert_allclose(fast[i, :], slow, rtol=1e-12, atol=1e-12)
+
+
+def main():
+    test_layers(debug=True)
+    test_exportmodel(debug=True)
+    test_windowedview(debug=True)
+    test_applymodel(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,7 @@ import rapidtide.stats as tide_stats
 import rapidtide.io as tide_io
 import rapidtide.nullcorrpass as tide_nullcorr
 import rapidtide.nullcorrpassx as tide_nullcorrx
+import rapidtide.helper_classes as tide_classes
 
 import matplotlib.pyplot as plt
 from rapidtide.tests.utils import get_test_data_path, get_test_target_path, get_test_temp_path, get_examples_path, get_rapidtide_root, get_scripts_path, create_dir
@@ -131,5 +132,216 @@ def test_nullcorr(debug=False, display=False):
             assert True
 
 
+def test_nullcorrbatch(debug=False, display=False):
+    # make a filtered random regressor
+    np.random.seed(12345)
+    timestep = 1.5
+    Fs = 1.0 / timestep
+    tclen = 300
+    lfofilter = tide_filt.noncausalfilter(filtertype='lfo')
+    sourcedata = lfofilter.apply(Fs, np.random.randn(tclen))
+
+    thecorrelator = tide_classes.correlator(Fs=Fs,
+                                            ncprefilter=lfofilter,
+                                            detrendorder=1,
+                                            windowfunc='hamming',
+                                            corrweighting='none')
+    thecorrelator.setreftc(sourcedata)
+    thecorrelator.setlimits(10, 10)
+    thefitter = tide_classes.correlation_fitter(lagmin=-15.0, lagmax=15.0, absmaxsigma=1000.0, absminsigma=0.25,
+                                                lthreshval=0.0, uthreshval=1.0, hardlimit=True, refine=True)
+
+    numestreps = 2000
+    for permutationmethod in ['shuffle', 'phaserandom']:
+        results = {}
+        for batchsize, nprocs in [(1, 1), (1, 2), (256, 1), (256, 2)]:
+            np.random.seed(54321)
+            corrlist = tide_nullcorrx.getNullDistributionDatax(sourcedata,
+                                                               Fs,
+                                                               thecorrelator,
+                                                               thefitter,
+                                                               numestreps=numestreps,
+                                                               nprocs=nprocs,
+                                                               showprogressbar=debug,
+                                                               permutationmethod=permutationmethod,
+                                                               batchsize=batchsize)
+            assert len(corrlist) == numestreps
+            results[(batchsize, nprocs)] = corrlist
+            if debug:
+                print(permutationmethod, batchsize, nprocs, np.mean(corrlist), np.percentile(corrlist, 95))
+
+        # neither calculation depends on the number of processes
+        np.testing.assert_array_equal(results[(1, 1)], results[(1, 2)])
+        np.testing.assert_array_equal(results[(256, 1)], results[(256, 2)])
+
+        # and the worker processes don't repeat each other's permutations
+        nonzerovals = results[(1, 2)][np.where(results[(1, 2)] != 0.0)]
+        assert len(np.unique(nonzerovals)) == len(nonzerovals)
+
+        # an explicit seed gives the same permutations whatever the global random state is
+        seededlists = []
+        for globalseed in [1, 2]:
+            np.random.seed(globalseed)
+            seededlists.append(tide_nullcorrx.getNullDistributionDatax(sourcedata,
+                                                                       Fs,
+                                                                       thecorrelator,
+                                                                       thefitter,
+                                                                       numestreps=numestreps,
+                                                                       showprogressbar=debug,
+                                                                       permutationmethod=permutationmethod,
+                                                                       batchsize=256,
+                                                                       seed=12345))
+        np.testing.assert_array_equal(seededlists[0], seededlists[1])
+
+        # and gives the same distribution as doing one permutation at a time
+        for thepct in [50, 95]:
+            assert np.fabs(np.percentile(results[(256, 1)], thepct) - np.percentile(results[(1, 1)], thepct)) < 0.03
+
+        if display:
+            plt.figure()
+            plt.hist([results[(1, 1)], results[(256, 1)]], bins=50)
+            plt.show()
+
+
+def test_nullcorrsequential(debug=False, display=False):
+    np.random.seed(12345)
+    timestep = 1.5
+    Fs = 1.0 / timestep
+    tclen = 300
+    lfofilter = tide_filt.noncausalfilter(filtertype='lfo')
+    sourcedata = lfofilter.apply(Fs, np.random.randn(tclen))
+
+    thecorrelator = tide_classes.correlator(Fs=Fs,
+                                            ncprefilter=lfofilter,
+                                            detrendorder=1,
+                                            windowfunc='hamming',
+                                            corrweighting='none')
+    thecorrelator.setreftc(sourcedata)
+    thecorrelator.setlimits(10, 10)
+    thefitter = tide_classes.correlation_fitter(lagmin=-15.0, lagmax=15.0, absmaxsigma=1000.0, absminsigma=0.25,
+                                                lthreshval=0.0, uthreshval=1.0, hardlimit=True, refine=True)
+
+    numestreps = 10000
+    thepercentiles = np.array([0.95, 0.99])
+    results = {}
+    for sigtolerance, nprocs in [(None, 1), (0.02, 1), (0.02, 2)]:
+        np.random.seed(54321)
+        results[(sigtolerance, nprocs)] = tide_nullcorrx.getNullDistributionDatax(sourcedata,
+                                                                                  Fs,
+                                                                                  thecorrelator,
+                                                                                  thefitter,
+                                                                                  numestreps=numestreps,
+                                                                                  nprocs=nprocs,
+                                                                                  showprogressbar=debug,
+                                                                                  batchsize=250,
+                                                                                  sigtolerance=sigtolerance,
+                                                                                  sigpercentiles=thepercentiles)
+        if debug:
+            print(sigtolerance, nprocs, len(results[(sigtolerance, nprocs)]))
+
+    # stopping early gives the first part of the full calculation, regardless of the number of processes
+    numdone = len(results[(0.02, 1)])
+    assert numdone < numestreps
+    np.testing.assert_array_equal(results[(0.02, 1)], results[(0.02, 2)])
+    np.testing.assert_array_equal(results[(0.02, 1)], results[(None, 1)][:numdone])
+
+    # and the thresholds agree with the full calculation to within the tolerance
+    fullpcts, fullhalfwidths = tide_stats.bootstrappercentiles(results[(None, 1)], thepercentiles)
+    pcts, halfwidths = tide_stats.bootstrappercentiles(results[(0.02, 1)], thepercentiles)
+    if debug:
+        print(fullpcts, fullhalfwidths, pcts, halfwidths)
+    assert np.max(halfwidths) < 0.02
+    assert np.max(np.fabs(pcts - fullpcts)) < 0.02
+
+
+def test_nullcorrcache(debug=False, display=False):
+    np.random.seed(12345)
+    timestep = 1.5
+    Fs = 1.0 / timestep
+    tclen = 300
+    lfofilter = tide_filt.noncausalfilter(filtertype='lfo')
+    sourcedata = lfofilter.apply(Fs, np.random.randn(tclen))
+
+    thecorrelator = tide_classes.correlator(Fs=Fs,
+                                            ncprefilter=lfofilter,
+                                            detrendorder=1,
+                                            windowfunc='hamming',
+                                            corrweighting='none')
+    thecorrelator.setreftc(sourcedata)
+    thecorrelator.setlimits(10, 10)
+    thefitter = tide_classes.correlation_fitter(lagmin=-15.0, lagmax=15.0, absmaxsigma=1000.0, absminsigma=0.25,
+                                                lthreshval=0.0, uthreshval=1.0, hardlimit=True, refine=True)
+
+    cachedir = os.path.join(get_test_temp_path(), 'nullcache')
+    if os.path.isdir(cachedir):
+        for thefile in os.listdir(cachedir):
+            os.remove(os.path.join(cachedir, thefile))
+
+    # the first call fills the cache, the second one reads from it
+    corrlists = []
+    for i in range(2):
+        corrlists.append(tide_nullcorrx.getNullDistributionDatax(sourcedata,
+                                                                 Fs,
+                                                                 thecorrelator,
+                                                                 thefitter,
+                                                                 numestreps=500,
+                                                                 showprogressbar=debug,
+                                                                 batchsize=256,
+                                                                 cachedir=cachedir))
+        assert len(os.listdir(cachedir)) == 1
+    np.testing.assert_array_equal(corrlists[0], corrlists[1])
+
+    # changing the permutation method is a cache miss
+    corrlist = tide_nullcorrx.getNullDistributionDatax(sourcedata,
+                                                       Fs,
+                                                       thecorrelator,
+                                                       thefitter,
+                                                       numestreps=500,
+                                                       showprogressbar=debug,
+                                                       permutationmethod='phaserandom',
+                                                       batchsize=256,
+                                                       cachedir=cachedir)
+    assert len(os.listdir(cachedir)) == 2
+
+    # the Johnson SB fit is cached too
+    thepercentiles = np.array([0.95, 0.99])
+    fitpcts = []
+    for i in range(2):
+        pcts, pcts_fit, sigfit = tide_stats.sigFromDistributionData(corrlists[0], 1000, thepercentiles,
+                                                                    cachedir=cachedir)
+        fitpcts.append(pcts_fit)
+        assert len(os.listdir(cachedir)) == 3
+    np.testing.assert_array_equal(fitpcts[0], fitpcts[1])
+    if debug:
+        print(pcts, fitpcts)
+
+    # a seeded distribution is only reused for the same seed
+    seededlists = {}
+    for theseed, numfiles in [(1, 4), (2, 5), (1, 5)]:
+        seededlists[theseed] = tide_nullcorrx.getNullDistributionDatax(sourcedata,
+                                                                       Fs,
+                                                                       thecorrelator,
+                                                                       thefitter,
+                                                                       numestreps=500,
+                                                                       showprogressbar=debug,
+                                                                       batchsize=256,
+                                                                       cachedir=cachedir,
+                                                                       seed=theseed)
+        assert len(os.listdir(cachedir)) == numfiles
+    uncachedlist = tide_nullcorrx.getNullDistributionDatax(sourcedata,
+                                                           Fs,
+                                                           thecorrelator,
+                                                           thefitter,
+                                                           numestreps=500,
+                                                           showprogressbar=debug,
+                                                           batchsize=256,
+                                                           seed=1)
+    np.testing.assert_array_equal(seededlists[1], uncachedlist)
+    assert not np.array_equal(seededlists[1], seededlists[2])
+
+
 if __name__ == '__main__':
     test_nullcorr(debug=True, display=True)
+    test_nullcorrbatch(debug=True, display=True)
+    test_nullcorrsequential(debug=True, display=True)
+    test_nullcorrcache(debug=True, display=True)
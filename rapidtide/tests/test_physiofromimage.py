@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+from __future__ import print_function, division
+
+import numpy as np
+
+import rapidtide.filter as tide_filt
+import rapidtide.io as tide_io
+import rapidtide.miscmath as tide_math
+import rapidtide.workflows.happy as happy
+
+
+def loopslicetc(normdata_byslice, mask_byslice, numslices, timepoints, slicetimes, tr, appflips_byslice,
+                madnorm=True, fliparteries=False, usemask=True, multiplicative=True):
+    # the slice averaging and interleaving, one slice and one timepoint at a time
+    numsteps, minstep, sliceoffsets = tide_io.sliceinfo(slicetimes, tr)
+    hirestc = np.zeros((timepoints * numsteps), dtype=np.float64)
+    cycleaverage = np.zeros((numsteps), dtype=np.float64)
+    sliceavs = np.zeros((numslices, timepoints), dtype=np.float64)
+    slicenorms = np.zeros((numslices), dtype=np.float64)
+    if fliparteries:
+        thismask_byslice = appflips_byslice.astype(np.int64) * mask_byslice
+    else:
+        thismask_byslice = mask_byslice
+    for theslice in range(numslices):
+        if usemask:
+            validvoxels = np.where(np.abs(thismask_byslice[:, theslice]) > 0)[0]
+        else:
+            validvoxels = np.where(thismask_byslice[:, theslice] >= 0)[0]
+        if len(validvoxels) > 0:
+            sliceavs[theslice, :] = np.mean(
+                normdata_byslice[validvoxels, theslice, :] * thismask_byslice[validvoxels, theslice, np.newaxis],
+                axis=0)
+            if madnorm:
+                sliceavs[theslice, :], slicenorms[theslice] = tide_math.madnormalize(sliceavs[theslice, :],
+                                                                                   returnnormfac=True)
+            else:
+                slicenorms[theslice] = 1.0
+            for t in range(timepoints):
+                hirestc[numsteps * t + sliceoffsets[theslice]] += sliceavs[theslice, t]
+    for i in range(numsteps):
+        cycleaverage[i] = np.mean(hirestc[i:-1:numsteps])
+    for t in range(len(hirestc)):
+        if multiplicative:
+            hirestc[t] /= (cycleaverage[t % numsteps] + 1.0)
+        else:
+            hirestc[t] -= cycleaverage[t % numsteps]
+    return hirestc, numsteps, cycleaverage, slicenorms
+
+
+def test_physiofromimage(debug=False):
+    np.random.seed(12345)
+    numvoxels = 50
+    numslices = 12
+    timepoints = 100
+    tr = 1.2
+
+    # multiband acquisition, so slices acquired at the same time have to add
+    slicetimes = np.tile(np.arange(numslices // 2) * tr / (numslices // 2), 2)
+    np.random.shuffle(slicetimes)
+    normdata_byslice = 0.1 * np.random.randn(numvoxels, numslices, timepoints)
+    mask_byslice = (np.random.rand(numvoxels, numslices) > 0.5).astype(np.float64)
+    mask_byslice[:, 3] = 0.0
+    appflips_byslice = np.where(np.random.rand(numvoxels, numslices) > 0.7, -1.0, 1.0)
+
+    cardprefilter = tide_filt.noncausalfilter()
+    cardprefilter.settype('cardiac')
+    respprefilter = tide_filt.noncausalfilter()
+    respprefilter.settype('resp')
+
+    for madnorm in [True, False]:
+        for multiplicative in [True, False]:
+            for usemask in [True, False]:
+                for fliparteries in [True, False]:
+                    hirescardtc, cardnormfac, hiresresptc, respnormfac, slicesamplerate, numsteps, \
+                        cycleaverage, slicenorms = happy.physiofromimage(normdata_byslice, mask_byslice, numslices,
+                                                                         timepoints, tr, slicetimes,
+                                                                         cardprefilter, respprefilter,
+                                                                         madnorm=madnorm,
+                                                                         fliparteries=fliparteries,
+                                                                         appflips_byslice=appflips_byslice + 0.0,
+                                                                         usemask=usemask,
+                                                                         multiplicative=multiplicative)
+                    hirestc, loopnumsteps, loopcycleaverage, loopslicenorms = loopslicetc(
+                        normdata_byslice, mask_byslice, numslices, timepoints, slicetimes, tr, appflips_byslice,
+                        madnorm=madnorm, fliparteries=fliparteries, usemask=usemask,
+                        multiplicative=multiplicative)
+                    if debug:
+                        print(madnorm, multiplicative, usemask, fliparteries,
+                              np.max(np.fabs(cycleaverage - loopcycleaverage)),
+                              np.max(np.fabs(slicenorms - loopslicenorms)))
+                    assert numsteps == loopnumsteps == numslices // 2
+                    assert slicesamplerate == numsteps / tr
+                    np.testing.assert_allclose(cycleaverage, loopcycleaverage, rtol=1e-10, atol=1e-12)
+                    np.testing.assert_allclose(slicenorms, loopslicenorms, rtol=1e-10, atol=1e-12)
+                    # without the mask, the slice with no masked voxels is still averaged
+                    if not madnorm:
+                        assert slicenorms[3] == (0.0 if usemask else 1.0)
+
+                    # the rest of the routine filters the interleaved timecourse
+                    filthirestc = tide_filt.harmonicnotchfilter(hirestc, slicesamplerate, 1.0 / tr, notchpct=1.5)
+                    loopcardtc, loopcardnormfac = tide_math.madnormalize(
+                        cardprefilter.apply(slicesamplerate, filthirestc), returnnormfac=True)
+                    looprespptc, looprespnormfac = tide_math.madnormalize(
+                        respprefilter.apply(slicesamplerate, filthirestc), returnnormfac=True)
+                    np.testing.assert_allclose(hirescardtc, -loopcardtc, rtol=1e-8, atol=1e-10)
+                    np.testing.assert_allclose(hiresresptc, -looprespptc, rtol=1e-8, atol=1e-10)
+                    np.testing.assert_allclose(cardnormfac, loopcardnormfac * np.mean(loopslicenorms), rtol=1e-10)
+                    np.testing.assert_allclose(respnormfac, looprespnormfac * np.mean(loopslicenorms), rtol=1e-10)
+
+
+def main():
+    test_physiofromimage(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import os
+
+import nibabel as nib
+import numpy as np
+
+import rapidtide.io as tide_io
+from rapidtide.tests.utils import get_test_temp_path, create_dir
+
+
+def test_readnifti(debug=False, display=False):
+    # create outputdir if it doesn't exist
+    create_dir(get_test_temp_path())
+
+    # make an int16 4D image
+    np.random.seed(12345)
+    xsize, ysize, numslices, timepoints = 7, 6, 5, 40
+    thedata = np.random.randint(-1000, 1000, size=(xsize, ysize, numslices, timepoints)).astype(np.int16)
+    theimage = nib.Nifti1Image(thedata, np.eye(4))
+    theimage.header.set_data_dtype(np.int16)
+    theimage.header.set_slope_inter(1.0, 0.0)
+    numspatiallocs = xsize * ysize * numslices
+    validvoxels = np.where(np.random.rand(numspatiallocs) > 0.4)[0]
+    validstart, validend = 3, 35
+    target = thedata.reshape((numspatiallocs, timepoints))[validvoxels, validstart:validend + 1]
+
+    for suffix in ['.nii', '.nii.gz']:
+        thefilename = os.path.join(get_test_temp_path(), 'readnifti_int16' + suffix)
+        nib.save(theimage, thefilename)
+
+        # the default reader still returns float64
+        nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(thefilename)
+        assert nim_data.dtype == np.float64
+        np.testing.assert_array_equal(nim_data, thedata)
+
+        # the mmap reader keeps the type on disk
+        nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(thefilename, mmap=True)
+        if debug:
+            print(suffix, type(nim_data), nim_data.dtype)
+        assert nim_data.dtype == np.int16
+        if suffix == '.nii':
+            assert isinstance(nim_data, np.memmap)
+        np.testing.assert_array_equal(nim_data, thedata)
+        nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(thefilename, mmap=True, dtype=np.float32)
+        assert nim_data.dtype == np.float32
+        np.testing.assert_array_equal(nim_data, thedata)
+
+        # read only the valid voxels and timepoints
+        for slabsize in [1, 3, 100]:
+            validdata = tide_io.readniftivoxels(thefilename, validvoxels=validvoxels, startpoint=validstart,
+                                                endpoint=validend, slabsize=slabsize)
+            assert validdata.dtype == np.int16
+            np.testing.assert_array_equal(validdata, target)
+        validdata = tide_io.readniftivoxels(thefilename, validvoxels=validvoxels, startpoint=validstart,
+                                            endpoint=validend, dtype=np.float64)
+        assert validdata.dtype == np.float64
+        np.testing.assert_array_equal(validdata, target)
+        alldata = tide_io.readniftivoxels(thefilename)
+        np.testing.assert_array_equal(alldata, thedata.reshape((numspatiallocs, timepoints)))
+
+
+def main():
+    test_readnifti(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import print_function, division
+
+import numpy as np
+from sklearn.decomposition import PCA
+
+from rapidtide.refine import streamedpca
+
+
+def test_streamedpca(debug=False):
+    # make some voxels that share a common timecourse with different amplitudes, plus noise
+    np.random.seed(12345)
+    numvoxels = 5000
+    tclen = 300
+    sourcetc = np.sin(np.linspace(0.0, 20.0 * np.pi, tclen))
+    secondtc = np.cos(np.linspace(0.0, 7.0 * np.pi, tclen))
+    thedata = np.random.uniform(0.5, 2.0, (numvoxels, 1)) * sourcetc[None, :] \
+              + np.random.uniform(-0.5, 0.5, (numvoxels, 1)) * secondtc[None, :] \
+              + 0.5 * np.random.randn(numvoxels, tclen)
+    theindices = np.sort(np.random.permutation(numvoxels)[:3000])
+
+    thefit = PCA(n_components=2, svd_solver='full').fit(thedata[theindices, :])
+    for solver in ['randomized', 'incremental']:
+        components, themean = streamedpca(thedata, theindices, ncomponents=2, solver=solver, blocksize=700)
+        assert components.shape == (2, tclen)
+        np.testing.assert_allclose(themean, thefit.mean_, atol=1e-10)
+
+        # components are only defined up to a sign
+        for i in range(2):
+            thecorr = np.fabs(np.dot(components[i, :], thefit.components_[i, :]))
+            if debug:
+                print(solver, i, thecorr)
+            assert thecorr > 0.999
+
+
+def main():
+    test_streamedpca(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,7 +20,7 @@ from __future__ import print_function, division
 import numpy as np
 import pylab as plt
 
-from rapidtide.resample import timeshift
+from rapidtide.resample import timeshift, timeshift_batch
 from rapidtide.filter import dolpfiltfilt
 from rapidtide.tests.utils import mse
 
@@ -86,8 +86,32 @@ def test_timeshift(debug=False):
         plt.show()
 
 
+def test_timeshift_batch(debug=False):
+    np.random.seed(12345)
+    numtcs = 20
+    padtrs = 30
+    for testlen in [200, 201]:
+        timecourses = np.random.randn(numtcs, testlen)
+        shifts = np.random.uniform(-20.0, 20.0, numtcs)
+        shifts[1] = shifts[0]
+        shifts[2] = 0.0
+        shiftedtcs, shiftedweights = timeshift_batch(timecourses, shifts, padtrs)
+        assert shiftedtcs.shape == (numtcs, testlen)
+        assert shiftedweights.shape == (numtcs, testlen)
+
+        # every row matches the single timecourse version
+        for i in range(numtcs):
+            tcshifted, weights, alltc, allweights = timeshift(timecourses[i, :], shifts[i], padtrs)
+            if debug:
+                print(testlen, i, np.max(np.fabs(tcshifted - shiftedtcs[i, :])),
+                      np.max(np.fabs(weights - shiftedweights[i, :])))
+            np.testing.assert_allclose(shiftedtcs[i, :], tcshifted, atol=1e-10)
+            np.testing.assert_allclose(shiftedweights[i, :], weights, atol=1e-10)
+
+
 def main():
     test_timeshift(debug=True)
+    test_timeshift_batch(debug=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import numpy as np
+
+import rapidtide.fit as tide_fit
+from rapidtide.filter import wiener_deconvolution, wiener_deconvolution_batch
+from rapidtide.wiener import wienerpass
+
+
+def test_wiener_deconvolution_batch(debug=False):
+    np.random.seed(12345)
+    numtcs = 10
+    for tclen in [200, 201]:
+        signals = np.random.randn(numtcs, tclen)
+        sharedkernel = np.random.randn(tclen)
+        kernels = np.random.randn(numtcs, 40)
+
+        # a shared kernel, and one kernel per signal, both match the single signal version
+        batched_shared = wiener_deconvolution_batch(signals, sharedkernel, 0.5)
+        batched_each = wiener_deconvolution_batch(signals, kernels, 0.5)
+        for i in range(numtcs):
+            if debug:
+                print(tclen, i, np.max(np.fabs(batched_shared[i, :] - wiener_deconvolution(signals[i, :], sharedkernel, 0.5))))
+            np.testing.assert_allclose(batched_shared[i, :], wiener_deconvolution(signals[i, :], sharedkernel, 0.5),
+                                       atol=1e-10)
+            np.testing.assert_allclose(batched_each[i, :], wiener_deconvolution(signals[i, :], kernels[i, :], 0.5),
+                                       atol=1e-10)
+
+
+def test_wienerpass(debug=False):
+    np.random.seed(12345)
+    numvoxels = 50
+    tclen = 256
+    tr = 0.5
+    theregressor = np.random.randn(tclen)
+    thedelays = np.random.randint(-10, 10, numvoxels)
+    lagtc = np.zeros((numvoxels, tclen), dtype=np.float64)
+    for i in range(numvoxels):
+        lagtc[i, :] = np.roll(theregressor, thedelays[i])
+    fmri_data = 100.0 + np.random.uniform(1.0, 5.0, numvoxels)[:, None] * lagtc + 0.1 * np.random.randn(numvoxels, tclen)
+    fmri_data[0, :] = 0.0
+    optiondict = {'addedskip': 0, 'showprogressbar': False}
+
+    theoutputs = [np.zeros(numvoxels, dtype=np.float64) for i in range(5)] + \
+                 [np.zeros((numvoxels, tclen), dtype=np.float64) for i in range(2)]
+    wienerdeconv = np.zeros((numvoxels, tclen), dtype=np.float64)
+    wpeak = np.zeros(numvoxels, dtype=np.float64)
+    meanvalue, rvalue, r2value, fitcoff, fitNorm, datatoremove, filtereddata = theoutputs
+    volumetotal = wienerpass(numvoxels, 1000, fmri_data, 1.0, lagtc, optiondict,
+                             meanvalue=meanvalue, rvalue=rvalue, r2value=r2value, fitcoff=fitcoff, fitNorm=fitNorm,
+                             datatoremove=datatoremove, filtereddata=filtereddata,
+                             wienerdeconv=wienerdeconv, wpeak=wpeak, theregressor=theregressor,
+                             fmritr=tr, batchsize=16)
+
+    # the masked voxel is left alone
+    assert volumetotal == numvoxels - 1
+    assert rvalue[0] == 0.0
+    assert np.all(wienerdeconv[0, :] == 0.0)
+
+    # every other voxel matches a voxel by voxel fit
+    for i in range(1, numvoxels):
+        thefit, R = tide_fit.mlregress(lagtc[i, :], fmri_data[i, :])
+        np.testing.assert_allclose([meanvalue[i], fitcoff[i], rvalue[i]], [thefit[0, 0], thefit[0, 1], R], rtol=1e-8)
+        np.testing.assert_allclose(datatoremove[i, :], thefit[0, 1] * lagtc[i, :], rtol=1e-8)
+        np.testing.assert_allclose(filtereddata[i, :], fmri_data[i, :] - datatoremove[i, :], rtol=1e-8)
+
+    # the deconvolution peaks at each voxel's delay
+    if debug:
+        print(thedelays[1:] * tr)
+        print(wpeak[1:])
+    np.testing.assert_allclose(wpeak[1:], thedelays[1:] * tr)
+
+    # deconvolution alone, as rapidtide2x does it, gives the same result
+    deconvonly = np.zeros((numvoxels, tclen), dtype=np.float64)
+    wpeakonly = np.zeros(numvoxels, dtype=np.float64)
+    wienerpass(numvoxels, 1000, fmri_data, 1.0, lagtc, optiondict,
+               wienerdeconv=deconvonly, wpeak=wpeakonly, theregressor=theregressor, fmritr=tr, batchsize=16)
+    np.testing.assert_array_equal(deconvonly, wienerdeconv)
+    np.testing.assert_array_equal(wpeakonly, wpeak)
+
+
+def main():
+    test_wiener_deconvolution_batch(debug=True)
+    test_wienerpass(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2019 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from __future__ import print_function, division
+
+import gzip
+import os
+import threading
+
+import nibabel as nib
+import numpy as np
+
+import rapidtide.io as tide_io
+from rapidtide.tests.utils import get_test_temp_path, create_dir
+
+
+def test_writenifti(debug=False, display=False):
+    # create outputdir if it doesn't exist
+    create_dir(get_test_temp_path())
+
+    np.random.seed(12345)
+    thedata = np.random.randn(20, 18, 10, 30).astype(np.float32)
+    theheader = nib.Nifti1Image(thedata, np.eye(4)).header.copy()
+    thename = os.path.join(get_test_temp_path(), 'writenifti')
+
+    for compresslevel, nthreads, suffix in [(None, 1, '.nii.gz'),
+                                            (None, 4, '.nii.gz'),
+                                            (6, 1, '.nii.gz'),
+                                            (9, 3, '.nii.gz'),
+                                            (0, 1, '.nii')]:
+        for oldsuffix in ['.nii', '.nii.gz']:
+            if os.path.isfile(thename + oldsuffix):
+                os.remove(thename + oldsuffix)
+        tide_io.setniftiwriteoptions(compresslevel=compresslevel, nthreads=nthreads)
+        tide_io.getniftibyteswritten(reset=True)
+        tide_io.savetonifti(thedata, theheader, thename)
+        assert tide_io.getniftibyteswritten() == thedata.nbytes
+        assert os.path.isfile(thename + suffix)
+        if debug:
+            print(compresslevel, nthreads, os.path.getsize(thename + suffix))
+        if suffix == '.nii.gz':
+            # make sure the file is a valid gzip file as well as a valid nifti file
+            with gzip.open(thename + suffix, 'rb') as thefile:
+                assert len(thefile.read()) > thedata.nbytes
+        nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(thename + suffix)
+        np.testing.assert_array_equal(nim_data, thedata)
+    tide_io.setniftiwriteoptions()
+
+    # check that compressing in many blocks gives a valid gzip stream
+    thebytes = thedata.tobytes()
+    for nthreads in [1, 4]:
+        tide_io._writegzip(thebytes, thename + '.gz', 5, nthreads, blocksize=10000)
+        with gzip.open(thename + '.gz', 'rb') as thefile:
+            assert thefile.read() == thebytes
+
+
+def test_backgroundwriter(debug=False, display=False):
+    # create outputdir if it doesn't exist
+    create_dir(get_test_temp_path())
+
+    np.random.seed(12345)
+    thedata = np.random.randn(10, 12, 8, 20)
+    theheader = nib.Nifti1Image(thedata, np.eye(4)).header.copy()
+    thename = os.path.join(get_test_temp_path(), 'backgroundwriter')
+
+    # the budget holds less than one, exactly one, or many arrays, and the source array is changed after each
+    # submission
+    for maxpendingbytes in [0, thedata.nbytes // 2, thedata.nbytes, 100 * thedata.nbytes]:
+        thewriter = tide_io.backgroundwriter(maxpendingbytes=maxpendingbytes)
+        outputarray = thedata + 0.0
+        for i in range(4):
+            thewriter.savetonifti(outputarray, theheader, thename + '_' + str(i))
+            assert thewriter.pendingbytes <= maxpendingbytes
+            outputarray += 1.0
+        thewriter.close()
+        for i in range(4):
+            nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(thename + '_' + str(i))
+            np.testing.assert_allclose(nim_data, thedata + i)
+
+    # an array over the budget is written in place, after the smaller ones queued ahead of it
+    thewriter = tide_io.backgroundwriter(maxpendingbytes=thedata.nbytes)
+    thewriter.savetonifti(thedata[:, :, :, :10], theheader, thename + '_small')
+    thewriter.savetonifti(np.concatenate((thedata, thedata), axis=3), theheader, thename + '_big')
+    assert thewriter.pendingbytes == 0
+    assert len(thewriter.pending) == 0
+    nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(thename + '_small')
+    np.testing.assert_allclose(nim_data, thedata[:, :, :, :10])
+    nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(thename + '_big')
+    np.testing.assert_allclose(nim_data[:, :, :, 20:], thedata)
+    thewriter.close()
+
+    # a file that can't be written is reported by flush, rather than leaving it waiting forever
+    thewriter = tide_io.backgroundwriter()
+    thewriter.savetonifti(np.zeros((4, 4, 4), dtype=bool), theheader, thename + '_bad')
+    thewriter.savetonifti(thedata, theheader, thename + '_afterbad')
+    flushresult = []
+
+    def flushwriter():
+        try:
+            thewriter.flush()
+            flushresult.append('no error')
+        except SystemExit:
+            flushresult.append('exited')
+
+    flushthread = threading.Thread(target=flushwriter)
+    flushthread.daemon = True
+    flushthread.start()
+    flushthread.join(60.0)
+    assert not flushthread.is_alive()
+    assert flushresult == ['exited']
+    assert thewriter.pendingbytes == 0
+    thewriter.close()
+    assert thewriter.thread is None
+    nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(thename + '_afterbad')
+    np.testing.assert_allclose(nim_data, thedata)
+
+
+def main():
+    test_writenifti(debug=True)
+    test_backgroundwriter(debug=True)
+
+
+if __name__ == '__main__':
+    main()
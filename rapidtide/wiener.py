@@ -25,96 +25,106 @@
 
 from __future__ import print_function, division
 
+import sys
+
 import numpy as np
 
-import rapidtide.fit as tide_fit
-import rapidtide.multiproc as tide_multiproc
+import rapidtide.filter as tide_filter
+import rapidtide.glmpass as tide_glmpass
 import rapidtide.util as tide_util
 
 
-def _procOneVoxelWiener(vox,
-                        lagtc,
-                        inittc,
-                        rt_floatset=np.float64,
-                        rt_floattype='float64'):
-    thefit, R = tide_fit.mlregress(lagtc, inittc)
-    fitcoff = rt_floatset(thefit[0, 1])
-    datatoremove = rt_floatset(fitcoff * lagtc)
-    return vox, rt_floatset(thefit[0, 0]), rt_floatset(R), rt_floatset(R * R), fitcoff, \
-           rt_floatset(thefit[0, 1] / thefit[0, 0]), datatoremove, rt_floatset(inittc - datatoremove)
-
-
 def wienerpass(numspatiallocs,
                reportstep,
                fmri_data,
                threshval,
                lagtc,
                optiondict,
-               meanvalue,
-               rvalue,
-               r2value,
-               fitcoff,
-               fitNorm,
-               datatoremove,
-               filtereddata,
+               meanvalue=None,
+               rvalue=None,
+               r2value=None,
+               fitcoff=None,
+               fitNorm=None,
+               datatoremove=None,
+               filtereddata=None,
+               wienerdeconv=None,
+               wpeak=None,
+               theregressor=None,
+               lambd=None,
+               fmritr=1.0,
+               batchsize=1000,
                rt_floatset=np.float64,
                rt_floattype='float64'):
-    inputshape = np.shape(fmri_data)
-    themask = np.where(np.mean(fmri_data, axis=1) > threshval, 1, 0)
-    if optiondict['nprocs'] > 1:
-        # define the consumer function here so it inherits most of the arguments
-        def Wiener_consumer(inQ, outQ):
-            while True:
-                try:
-                    # get a new message
-                    val = inQ.get()
+    """Fit the lagged regressor to every voxel, and optionally Wiener deconvolve each voxel by the regressor.
 
-                    # this is the 'TERM' signal
-                    if val is None:
-                        break
+    Voxels are processed in blocks of batchsize, and the results are written directly into the output arrays.
+    Any of the fit outputs (meanvalue through filtereddata) may be None, in which case it is not filled.
 
-                    # process and send the data
-                    outQ.put(_procOneVoxelWiener(val,
-                                                 lagtc[val, :],
-                                                 fmri_data[val,
-                                                 optiondict['addedskip']:],
-                                                 rt_floatset=rt_floatset,
-                                                 rt_floattype=rt_floattype))
+    Parameters
+    ----------
+    numspatiallocs : int
+        Number of voxels in fmri_data
+    fmri_data : 2D array
+        The voxel timecourses
+    threshval : float
+        Voxels with a mean below this are skipped
+    lagtc : 2D array
+        The lagged regressor for each voxel
+    meanvalue, rvalue, r2value, fitcoff, fitNorm : 1D arrays, optional
+        If not None, receive the intercept, R, R^2, slope, and slope / intercept of the fit in each voxel
+    datatoremove, filtereddata : 2D arrays, optional
+        If not None, receive the fit regressor and the data with the fit regressor removed
+    wienerdeconv : 2D array, optional
+        If not None, receives the Wiener deconvolution of each voxel by theregressor
+    wpeak : 1D array, optional
+        If not None, receives the time (in seconds) of the peak of each deconvolved timecourse
+    theregressor : 1D array, optional
+        The (unshifted) regressor to deconvolve by.  Required if wienerdeconv or wpeak is given.
+    lambd : float, optional
+        The SNR in the fourier domain.  If None, use 0.1 times the peak of the regressor's amplitude spectrum.
+    fmritr : float
+        The sample time of the data, used to convert wpeak to seconds
+    batchsize : int
+        Number of voxels to process at once
 
-                except Exception as e:
-                    print("error!", e)
-                    break
+    Returns
+    -------
+    volumetotal : int
+        Number of voxels processed
+    """
+    addedskip = optiondict['addedskip']
+    themask = np.where(np.mean(fmri_data[:numspatiallocs, addedskip:], axis=1) >= threshval, 1, 0)
+    thevoxels = np.where(themask > 0)[0]
+    dofit = any([x is not None for x in [meanvalue, rvalue, r2value, fitcoff, fitNorm, datatoremove, filtereddata]])
+    dodeconv = (wienerdeconv is not None) or (wpeak is not None)
+    if dodeconv:
+        if theregressor is None:
+            print('wienerpass: theregressor must be supplied to do deconvolution')
+            sys.exit()
+        if lambd is None:
+            lambd = 0.1 * np.max(np.abs(np.fft.rfft(theregressor)))
 
-        data_out = tide_multiproc.run_multiproc(Wiener_consumer,
-                                                inputshape, themask,
-                                                nprocs=optiondict['nprocs'],
-                                                showprogressbar=True,
-                                                chunksize=optiondict['mp_chunksize'])
-        # unpack the data
-        volumetotal = 0
-        for voxel in data_out:
-            meanvalue[voxel[0]] = voxel[1]
-            rvalue[voxel[0]] = voxel[2]
-            r2value[voxel[0]] = voxel[3]
-            fitcoff[voxel[0]] = voxel[4]
-            fitNorm[voxel[0]] = voxel[5]
-            datatoremove[voxel[0], :] = voxel[6]
-            filtereddata[voxel[0], :] = voxel[7]
-            volumetotal += 1
-        data_out = []
-    else:
-        volumetotal = 0
-        for vox in range(0, numspatiallocs):
-            if (vox % reportstep == 0 or vox == numspatiallocs - 1) and optiondict['showprogressbar']:
-                tide_util.progressbar(vox + 1, numspatiallocs, label='Percent complete')
-            inittc = fmri_data[vox, optiondict['addedskip']:].copy()
-            if np.mean(inittc) >= threshval:
-                dummy, meanvalue[vox], rvalue[vox], r2value[vox], fitcoff[vox], fitNorm[vox], datatoremove[vox], \
-                filtereddata[vox] = _procOneVoxelWiener(vox,
-                                                        lagtc[vox, :],
-                                                        inittc,
-                                                        rt_floatset=rt_floatset,
-                                                        t_floattype=rt_floattype)
-            volumetotal += 1
+    batchsize = max(int(batchsize), 1)
+    volumetotal = 0
+    for blockstart in range(0, len(thevoxels), batchsize):
+        if optiondict['showprogressbar']:
+            tide_util.progressbar(blockstart + 1, len(thevoxels), label='Percent complete')
+        theblock = thevoxels[blockstart:blockstart + batchsize]
+        blockdata = fmri_data[theblock, addedskip:]
+        if dofit:
+            theresults = tide_glmpass.blockglm(lagtc[theblock, :], blockdata)
+            for theoutput, theresult in zip([meanvalue, rvalue, r2value, fitcoff, fitNorm, datatoremove, filtereddata],
+                                            theresults):
+                if theoutput is not None:
+                    theoutput[theblock] = theresult
+        if dodeconv:
+            deconvolved = tide_filter.wiener_deconvolution_batch(blockdata, theregressor, lambd)
+            if wienerdeconv is not None:
+                wienerdeconv[theblock, :] = deconvolved
+            if wpeak is not None:
+                wpeak[theblock] = (np.argmax(deconvolved, axis=1) - deconvolved.shape[1] // 2) * fmritr
+        volumetotal += len(theblock)
+    if optiondict['showprogressbar']:
+        tide_util.progressbar(len(thevoxels), len(thevoxels), label='Percent complete')
 
     return volumetotal
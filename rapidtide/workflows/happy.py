@@ -46,6 +46,7 @@ import rapidtide.correlate as tide_corr
 import rapidtide.multiproc as tide_multiproc
 import rapidtide.glmpass as tide_glmpass
 import rapidtide.helper_classes as tide_classes
+import rapidtide.npdlfilter as tide_npdlfilt
 
 from scipy.signal import welch, savgol_filter
 from scipy.stats import kurtosis, skew
@@ -63,14 +64,6 @@ try:
 except ImportError:
     mklexists = False
 
-try:
-    import rapidtide.dlfilter as tide_dlfilt
-
-    dlfilterexists = True
-    print('dlfilter exists')
-except ImportError:
-    dlfilterexists = False
-    print('dlfilter does not exist')
 
 
 def usage():
@@ -113,6 +106,9 @@ def usage():
     print(
         "                                     can really kill you on clusters unless you're very careful.  Use at your")
     print("                                     own risk.)")
+    print("    --outputqueuesize=MB           - Write output files in the background, holding up to MB megabytes of")
+    print("                                     pending output in memory (default is 1024).  0 writes files")
+    print("                                     immediately.")
     print("")
     print("Preprocessing:")
     print("    --numskip=SKIP                 - Skip SKIP tr's at the beginning of the fMRI file (default is 0).")
@@ -250,7 +246,6 @@ def physiofromimage(normdata_byslice,
     # make slice means
     print('making slice means...')
     hirestc = np.zeros((timepoints * numsteps), dtype=np.float64)
-    cycleaverage = np.zeros((numsteps), dtype=np.float64)
     sliceavs = np.zeros((numslices, timepoints), dtype=np.float64)
     slicenorms = np.zeros((numslices), dtype=np.float64)
     if not verbose:
@@ -259,32 +254,32 @@ def physiofromimage(normdata_byslice,
         thismask_byslice = appflips_byslice.astype(np.int64) * mask_byslice
     else:
         thismask_byslice = mask_byslice
-    for theslice in range(numslices):
-        if verbose:
-            print('averaging slice', theslice)
-        if usemask:
-            validvoxels = np.where(np.abs(thismask_byslice[:, theslice]) > 0)[0]
-        else:
-            validvoxels = np.where(np.abs(thismask_byslice[:, theslice] >= 0))[0]
-        if len(validvoxels) > 0:
-            if madnorm:
-                sliceavs[theslice, :], slicenorms[theslice] = tide_math.madnormalize(np.mean(
-                    normdata_byslice[validvoxels, theslice, :] * thismask_byslice[validvoxels, theslice, np.newaxis],
-                    axis=0), returnnormfac=True)
-            else:
-                sliceavs[theslice, :] = np.mean(
-                    normdata_byslice[validvoxels, theslice, :] * thismask_byslice[validvoxels, theslice, np.newaxis],
-                    axis=0)
-                slicenorms[theslice] = 1.0
-            for t in range(timepoints):
-                hirestc[numsteps * t + sliceoffsets[theslice]] += sliceavs[theslice, t]
-    for i in range(numsteps):
-        cycleaverage[i] = np.mean(hirestc[i:-1:numsteps])
-    for t in range(len(hirestc)):
-        if multiplicative:
-            hirestc[t] /= (cycleaverage[t % numsteps] + 1.0)
-        else:
-            hirestc[t] -= cycleaverage[t % numsteps]
+
+    # average all the slices at once, over the voxels selected in each
+    if usemask:
+        validmask = (np.abs(thismask_byslice) > 0)
+    else:
+        validmask = (thismask_byslice >= 0)
+    numvalid = np.sum(validmask, axis=0)
+    validslices = np.where(numvalid > 0)[0]
+    slicesums = np.einsum('vs,vst->st', np.where(validmask, thismask_byslice, 0.0), normdata_byslice)
+    sliceavs[validslices, :] = slicesums[validslices, :] / numvalid[validslices, None]
+    if madnorm:
+        for theslice in validslices:
+            sliceavs[theslice, :], slicenorms[theslice] = tide_math.madnormalize(sliceavs[theslice, :],
+                                                                               returnnormfac=True)
+    else:
+        slicenorms[validslices] = 1.0
+
+    # interleave the slice averages into the hires timecourse - slices acquired at the same time add
+    np.add.at(hirestc,
+              numsteps * np.arange(timepoints)[None, :] + sliceoffsets[validslices, None],
+              sliceavs[validslices, :])
+    cycleaverage = np.array([np.mean(hirestc[i:-1:numsteps]) for i in range(numsteps)], dtype=np.float64)
+    if multiplicative:
+        hirestc /= (np.tile(cycleaverage, timepoints) + 1.0)
+    else:
+        hirestc -= np.tile(cycleaverage, timepoints)
     if not verbose:
         print('done')
     slicesamplerate = 1.0 * numsteps / tr
@@ -363,13 +358,17 @@ def normalizevoxels(fmri_data, detrendorder, validvoxels, time, timings, showpro
     starttime = time.time()
     # detrend if we are going to
     numspatiallocs = fmri_data.shape[0]
-    reportstep = int(numspatiallocs // 100)
     if detrendorder > 0:
         print('detrending to order', detrendorder, '...')
-        for idx, thevox in enumerate(validvoxels):
-            if ((idx % reportstep == 0) or (idx == len(validvoxels) - 1)) and showprogressbar:
-                tide_util.progressbar(idx + 1, len(validvoxels), label='Percent complete')
-            fmri_data[thevox, :] = tide_fit.detrend(fmri_data[thevox, :], order=detrendorder, demean=False)
+        # detrend the voxels a block at a time
+        detrendblocksize = 10000
+        for blockstart in range(0, len(validvoxels), detrendblocksize):
+            if showprogressbar:
+                tide_util.progressbar(blockstart + 1, len(validvoxels), label='Percent complete')
+            theblock = validvoxels[blockstart:blockstart + detrendblocksize]
+            fmri_data[theblock, :] = tide_fit.detrend_batch(fmri_data[theblock, :], order=detrendorder, demean=False)
+        if showprogressbar:
+            tide_util.progressbar(len(validvoxels), len(validvoxels), label='Percent complete')
         timings.append(['Detrending finished', time.time(), numspatiallocs, 'voxels'])
         print(' done')
 
@@ -810,6 +809,7 @@ def happy_main(thearguments):
     stdfreq = 25.0
     nprocs = 1
     mklthreads = 1
+    outputqueuesize = 1024
     spatialglmdenoise = True
     savecardiacnoise = True
     forcedhr = None
@@ -826,6 +826,7 @@ def happy_main(thearguments):
     numskip = 0
     motskip = 0
     dodlfilter = False
+    dlfilterexists = False
     modelname = 'model_revised'
     motionhp = None
     motionlp = None
@@ -913,6 +914,7 @@ def happy_main(thearguments):
                                                            "stdfreq=",
                                                            "nprocs=",
                                                            'mklthreads=',
+                                                           "outputqueuesize=",
                                                            "arteriesonly",
                                                            "estmask=",
                                                            "projmask=",
@@ -1011,11 +1013,8 @@ def happy_main(thearguments):
             centric = False
             print('Performing noncentric projection')
         elif o == "--dodlfilter":
-            if dlfilterexists:
-                dodlfilter = True
-                print('Will apply deep learning filter to enhance the cardiac waveforms')
-            else:
-                print('dlfilter not found - check to make sure Keras is installed and working.  Disabling.')
+            dodlfilter = True
+            print('Will apply deep learning filter to enhance the cardiac waveforms')
         elif o == "--model":
             linkchar = '='
             modelname = a
@@ -1096,6 +1095,10 @@ def happy_main(thearguments):
                 print('Will use', mklthreads, 'MKL threads for accelerated numpy processing.')
             else:
                 print('MKL not present - ignoring --mklthreads')
+        elif o == "--outputqueuesize":
+            linkchar = '='
+            outputqueuesize = int(a)
+            print('Will hold up to', outputqueuesize, 'MB of output in memory while writing')
         elif o == "--stdfreq":
             linkchar = '='
             stdfreq = float(a)
@@ -1207,6 +1210,9 @@ def happy_main(thearguments):
     if mklexists:
         mkl.set_num_threads(mklthreads)
 
+    # start the output writer
+    theoutputwriter = tide_io.backgroundwriter(maxpendingbytes=outputqueuesize * 1048576)
+
     # if doglm is set, make sure we are generating app matrix
     if doglm and cardcalconly:
         print('doing glm fit requires phase projection - setting cardcalconly to False')
@@ -1260,7 +1266,7 @@ def happy_main(thearguments):
     theheader['dim'][4] = 1
     timings.append(['Mask created', time.time(), None, None])
     if outputlevel > 0:
-        tide_io.savetonifti(mask.reshape((xsize, ysize, numslices)), theheader, outputroot + '_mask')
+        theoutputwriter.savetonifti(mask.reshape((xsize, ysize, numslices)), theheader, outputroot + '_mask')
     timings.append(['Mask saved', time.time(), None, None])
     mask_byslice = mask.reshape((xsize * ysize, numslices))
 
@@ -1289,8 +1295,8 @@ def happy_main(thearguments):
         timings.append(['Motion filtering end', time.time(), numspatiallocs, 'voxels'])
         tide_io.writenpvecs(motionregressors, outputroot + '_orthogonalizedmotion.txt')
         if savemotionglmfilt:
-            tide_io.savetonifti(fmri_data.reshape((xsize, ysize, numslices, timepoints)), theheader,
-                                outputroot + '_motionfiltered')
+            theoutputwriter.savetonifti(fmri_data.reshape((xsize, ysize, numslices, timepoints)), theheader,
+                                        outputroot + '_motionfiltered')
             timings.append(['Motion filtered data saved', time.time(), numspatiallocs, 'voxels'])
 
     # get slice times
@@ -1425,18 +1431,31 @@ def happy_main(thearguments):
 
         # apply the deep learning filter if we're going to do that
         if dodlfilter:
-            if dlfilterexists:
+            modelpath = os.path.join(os.path.split(os.path.split(os.path.split(__file__)[0])[0])[0], 'rapidtide',
+                                     'data',
+                                     'models')
+            if tide_npdlfilt.npzmodelexists(modelpath, modelname):
+                # an exported model can be run without loading keras at all
+                thedlfilter = tide_npdlfilt.npdlfilter(modelpath=modelpath)
+                dlfilterexists = True
+            else:
                 if mpfix:
                     print('performing super dangerous openmp workaround')
                     os.environ['KMP_DUPLICATE_LIB_OK'] = "TRUE"
-                modelpath = os.path.join(os.path.split(os.path.split(os.path.split(__file__)[0])[0])[0], 'rapidtide',
-                                         'data',
-                                         'models')
-                thedlfilter = tide_dlfilt.dlfilter(modelpath=modelpath)
+                try:
+                    import rapidtide.dlfilter as tide_dlfilt
+
+                    thedlfilter = tide_dlfilt.dlfilter(modelpath=modelpath)
+                    dlfilterexists = True
+                except ImportError:
+                    dlfilterexists = False
+                    print('dlfilter not found - check to make sure Keras is installed and working, or export', modelname,
+                          'with exportdlfilter.  Disabling.')
+            if dlfilterexists:
                 thedlfilter.loadmodel(modelname)
                 infodict['dlfiltermodel'] = modelname
-                normdlfilteredcard = thedlfilter.apply(normcardfromfmri_stdres)
-                dlfilteredcard = thedlfilter.apply(cardfromfmri_stdres)
+                normdlfilteredcard, dlfilteredcard = thedlfilter.apply(
+                    np.vstack((normcardfromfmri_stdres, cardfromfmri_stdres)))
                 if thispass == numpasses - 1:
                     tide_io.writevec(normdlfilteredcard, outputroot + '_normcardfromfmri_dlfiltered_' + str(stdfreq) + 'Hz.txt')
                     tide_io.writevec(dlfilteredcard, outputroot + '_cardfromfmri_dlfiltered_' + str(stdfreq) + 'Hz.txt')
@@ -1638,6 +1657,7 @@ def happy_main(thearguments):
 
         if cardcalconly:
             print('cardiac waveform calculations done - exiting')
+            theoutputwriter.close()
             # Process and save timing information
             nodeline = 'Processed on ' + platform.node()
             tide_util.proctiminginfo(timings, outputfile=outputroot + '_runtimings.txt', extraheader=nodeline)
@@ -1802,19 +1822,17 @@ def happy_main(thearguments):
             validlocs = np.where(projmask_byslice[:, theslice] > 0)[0]
             #indexlist = range(0, len(phasevals[theslice, :]))
             if len(validlocs) > 0:
-                for t in proctrs:
-                    filteredmr = -demeandata_byslice[validlocs, theslice, t]
-                    cinemr = fmri_data_byslice[validlocs, theslice, t]
-                    thevals, theweights, theindices = tide_resample.congrid(outphases,
-                                                                            phasevals[theslice, t],
-                                                                            1.0,
-                                                                            congridbins,
-                                                                            kernel=gridkernel,
-                                                                            cyclic=True)
-                    for i in range(len(theindices)):
-                        weight_byslice[validlocs, theslice, theindices[i]] += theweights[i]
-                        rawapp_byslice[validlocs, theslice, theindices[i]] += theweights[i] * filteredmr
-                        cine_byslice[validlocs, theslice, theindices[i]] += theweights[i] * cinemr
+                # grid every projected tr for every valid voxel in the slice at once
+                gridmatrix = tide_resample.congridmatrix(outphases,
+                                                         phasevals[theslice, proctrs],
+                                                         congridbins,
+                                                         kernel=gridkernel,
+                                                         cyclic=True)
+                filteredmr = -demeandata_byslice[validlocs, theslice, :][:, proctrs]
+                cinemr = fmri_data_byslice[validlocs, theslice, :][:, proctrs]
+                weight_byslice[validlocs, theslice, :] += np.asarray(gridmatrix.sum(axis=0)).reshape((1, -1))
+                rawapp_byslice[validlocs, theslice, :] += gridmatrix.T.dot(filteredmr.T).T
+                cine_byslice[validlocs, theslice, :] += gridmatrix.T.dot(cinemr.T).T
                 for d in range(destpoints):
                     if weight_byslice[validlocs[0], theslice, d] == 0.0:
                         weight_byslice[validlocs, theslice, d] = 1.0
@@ -1836,21 +1854,21 @@ def happy_main(thearguments):
             if fliparteries:
                 corrected_rawapp_byslice[validlocs, theslice, :] = (rawapp_byslice[validlocs, theslice, :] - timecoursemean) \
                                                                   * appflips_byslice[validlocs, theslice, None] + timecoursemean
-                if doaliasedcorrelation and (thispass == numpasses - 1):
-                    for theloc in validlocs:
-                        thecorrfunc_byslice[theloc, theslice, :] = thecorrelator.apply(
-                            -appflips_byslice[theloc, theslice] * demeandata_byslice[theloc, theslice, :], -thetimes[theslice][0])
-                        maxloc = np.argmax(thecorrfunc_byslice[theloc, theslice, :])
-                        wavedelay_byslice[theloc, theslice] = corrsearchvals[maxloc]
-                        waveamp_byslice[theloc, theslice] = thecorrfunc_byslice[theloc, theslice, maxloc]
+                if doaliasedcorrelation and (thispass == numpasses - 1) and (len(validlocs) > 0):
+                    thecorrfunc_byslice[validlocs, theslice, :] = thecorrelator.applybatch(
+                        -appflips_byslice[validlocs, theslice, None] * demeandata_byslice[validlocs, theslice, :],
+                        -thetimes[theslice][0])
+                    maxlocs = np.argmax(thecorrfunc_byslice[validlocs, theslice, :], axis=1)
+                    wavedelay_byslice[validlocs, theslice] = corrsearchvals[maxlocs]
+                    waveamp_byslice[validlocs, theslice] = thecorrfunc_byslice[validlocs, theslice, maxlocs]
             else:
                 corrected_rawapp_byslice[validlocs, theslice, :] = rawapp_byslice[validlocs, theslice, :]
-                if doaliasedcorrelation and (thispass == numpasses - 1):
-                    for theloc in validlocs:
-                        thecorrfunc_byslice[theloc, theslice, :] = thecorrelator.apply(-demeandata_byslice[theloc,theslice, :], -thetimes[theslice][0])
-                        maxloc = np.argmax(np.abs(thecorrfunc_byslice[theloc, theslice, :]))
-                        wavedelay_byslice[theloc, theslice] = corrsearchvals[maxloc]
-                        waveamp_byslice[theloc, theslice] = thecorrfunc_byslice[theloc, theslice, maxloc]
+                if doaliasedcorrelation and (thispass == numpasses - 1) and (len(validlocs) > 0):
+                    thecorrfunc_byslice[validlocs, theslice, :] = thecorrelator.applybatch(
+                        -demeandata_byslice[validlocs, theslice, :], -thetimes[theslice][0])
+                    maxlocs = np.argmax(np.abs(thecorrfunc_byslice[validlocs, theslice, :]), axis=1)
+                    wavedelay_byslice[validlocs, theslice] = corrsearchvals[maxlocs]
+                    waveamp_byslice[validlocs, theslice] = thecorrfunc_byslice[validlocs, theslice, maxlocs]
             timecoursemin = np.min(corrected_rawapp_byslice[validlocs, theslice, :], axis=1).reshape((-1, 1))
             app_byslice[validlocs, theslice, :] = corrected_rawapp_byslice[validlocs, theslice, :] - timecoursemin
             normapp_byslice[validlocs, theslice, :] = np.nan_to_num(app_byslice[validlocs, theslice, :] / means_byslice[validlocs, theslice, None])
@@ -1865,11 +1883,11 @@ def happy_main(thearguments):
         theheader['toffset'] = -np.pi
         theheader['pixdim'][4] = 2.0 * np.pi / destpoints
         if thispass == numpasses - 1:
-            tide_io.savetonifti(app, theheader, outputroot + '_app')
-            tide_io.savetonifti(normapp, theheader, outputroot + '_normapp')
-            tide_io.savetonifti(cine, theheader, outputroot + '_cine')
+            theoutputwriter.savetonifti(app, theheader, outputroot + '_app')
+            theoutputwriter.savetonifti(normapp, theheader, outputroot + '_normapp')
+            theoutputwriter.savetonifti(cine, theheader, outputroot + '_cine')
             if outputlevel > 0:
-                tide_io.savetonifti(rawapp, theheader, outputroot + '_rawapp')
+                theoutputwriter.savetonifti(rawapp, theheader, outputroot + '_rawapp')
         timings.append(['Phase projected data saved' + passstring, time.time(), None, None])
 
         if doaliasedcorrelation and thispass == numpasses - 1:
@@ -1877,10 +1895,10 @@ def happy_main(thearguments):
             theheader['dim'][4] = aliasedcorrelationpts
             theheader['toffset'] = 0.0
             theheader['pixdim'][4] = corrsearchvals[1] - corrsearchvals[0]
-            tide_io.savetonifti(thecorrfunc, theheader, outputroot + '_corrfunc')
+            theoutputwriter.savetonifti(thecorrfunc, theheader, outputroot + '_corrfunc')
             theheader['dim'][4] = 1
-            tide_io.savetonifti(wavedelay,   theheader, outputroot + '_wavedelay')
-            tide_io.savetonifti(waveamp,     theheader, outputroot + '_waveamp')
+            theoutputwriter.savetonifti(wavedelay,   theheader, outputroot + '_wavedelay')
+            theoutputwriter.savetonifti(waveamp,     theheader, outputroot + '_waveamp')
 
         # make and save a voxel intensity histogram
         if unnormvesselmap:
@@ -1907,8 +1925,8 @@ def happy_main(thearguments):
         maskedapp2d[np.where(vesselmask.reshape(numspatiallocs) == 0)[0], :] = 0.0
         if outputlevel > 1:
             if thispass == numpasses - 1:
-                tide_io.savetonifti(maskedapp2d.reshape((xsize, ysize, numslices, destpoints)), theheader,
-                                outputroot + '_maskedapp')
+                theoutputwriter.savetonifti(maskedapp2d.reshape((xsize, ysize, numslices, destpoints)), theheader,
+                                        outputroot + '_maskedapp')
         del maskedapp2d
         timings.append(['Vessel masked phase projected data saved' + passstring, time.time(), None, None])
 
@@ -1927,12 +1945,12 @@ def happy_main(thearguments):
         theheader = copy.deepcopy(nim_hdr)
         theheader['dim'][4] = 1
         if thispass == numpasses - 1:
-            tide_io.savetonifti(vesselmask, theheader, outputroot + '_vesselmask')
+            theoutputwriter.savetonifti(vesselmask, theheader, outputroot + '_vesselmask')
             if outputlevel > 0:
-                tide_io.savetonifti(minphase, theheader, outputroot + '_minphase')
-                tide_io.savetonifti(maxphase, theheader, outputroot + '_maxphase')
-                tide_io.savetonifti(arteries, theheader, outputroot + '_arteries')
-                tide_io.savetonifti(veins, theheader, outputroot + '_veins')
+                theoutputwriter.savetonifti(minphase, theheader, outputroot + '_minphase')
+                theoutputwriter.savetonifti(maxphase, theheader, outputroot + '_maxphase')
+                theoutputwriter.savetonifti(arteries, theheader, outputroot + '_arteries')
+                theoutputwriter.savetonifti(veins, theheader, outputroot + '_veins')
         timings.append(['Masks saved' + passstring, time.time(), None, None])
 
         # now get ready to start again with a new mask
@@ -1943,13 +1961,13 @@ def happy_main(thearguments):
         vesselmap = np.max(app, axis=3)
     else:
         vesselmap = np.max(normapp, axis=3)
-    tide_io.savetonifti(vesselmap, theheader, outputroot + '_vesselmap')
-    tide_io.savetonifti(np.where(appflips_byslice.reshape((xsize, ysize, numslices)) < 0, vesselmap, 0.0),
-                        theheader,
-                        outputroot + '_arterymap')
-    tide_io.savetonifti(np.where(appflips_byslice.reshape((xsize, ysize, numslices)) > 0, vesselmap, 0.0),
-                        theheader,
-                        outputroot + '_veinmap')
+    theoutputwriter.savetonifti(vesselmap, theheader, outputroot + '_vesselmap')
+    theoutputwriter.savetonifti(np.where(appflips_byslice.reshape((xsize, ysize, numslices)) < 0, vesselmap, 0.0),
+                                theheader,
+                                outputroot + '_arterymap')
+    theoutputwriter.savetonifti(np.where(appflips_byslice.reshape((xsize, ysize, numslices)) > 0, vesselmap, 0.0),
+                                theheader,
+                                outputroot + '_veinmap')
 
     # now generate aliased cardiac signals and regress them out of the data
     if doglm:
@@ -1972,10 +1990,10 @@ def happy_main(thearguments):
         theheader = copy.deepcopy(nim_hdr)
         timings.append(['Cardiac signal generated', time.time(), None, None])
         if savecardiacnoise:
-            tide_io.savetonifti(cardiacnoise.reshape((xsize, ysize, numslices, timepoints)), theheader,
-                                outputroot + '_cardiacnoise')
-            tide_io.savetonifti(phaseindices.reshape((xsize, ysize, numslices, timepoints)), theheader,
-                                outputroot + '_phaseindices')
+            theoutputwriter.savetonifti(cardiacnoise.reshape((xsize, ysize, numslices, timepoints)), theheader,
+                                        outputroot + '_cardiacnoise')
+            theoutputwriter.savetonifti(phaseindices.reshape((xsize, ysize, numslices, timepoints)), theheader,
+                                        outputroot + '_phaseindices')
             timings.append(['Cardiac signal saved', time.time(), None, None])
 
         # now remove them
@@ -2041,20 +2059,21 @@ def happy_main(thearguments):
             timings.append(['Cardiac signal regression finished', time.time(), numspatiallocs, 'voxels'])
             theheader = copy.deepcopy(nim_hdr)
             theheader['dim'][4] = 1
-            tide_io.savetonifti(fitcoffs.reshape((xsize, ysize, numslices)), theheader,
-                                outputroot + '_fitamp')
-            tide_io.savetonifti(meanvals.reshape((xsize, ysize, numslices)), theheader,
-                                outputroot + '_fitamp')
-            tide_io.savetonifti(rvals.reshape((xsize, ysize, numslices)), theheader,
-                                outputroot + '_fitR')
+            theoutputwriter.savetonifti(fitcoffs.reshape((xsize, ysize, numslices)), theheader,
+                                        outputroot + '_fitamp')
+            theoutputwriter.savetonifti(meanvals.reshape((xsize, ysize, numslices)), theheader,
+                                        outputroot + '_fitamp')
+            theoutputwriter.savetonifti(rvals.reshape((xsize, ysize, numslices)), theheader,
+                                        outputroot + '_fitR')
 
         theheader = copy.deepcopy(nim_hdr)
-        tide_io.savetonifti(filtereddata.reshape((xsize, ysize, numslices, timepoints)), theheader,
-                            outputroot + '_filtereddata')
-        tide_io.savetonifti(datatoremove.reshape((xsize, ysize, numslices, timepoints)), theheader,
-                            outputroot + '_datatoremove')
+        theoutputwriter.savetonifti(filtereddata.reshape((xsize, ysize, numslices, timepoints)), theheader,
+                                    outputroot + '_filtereddata')
+        theoutputwriter.savetonifti(datatoremove.reshape((xsize, ysize, numslices, timepoints)), theheader,
+                                    outputroot + '_datatoremove')
         timings.append(['Cardiac signal regression files written', time.time(), None, None])
 
+    theoutputwriter.close()
     timings.append(['Done', time.time(), None, None])
 
     # Process and save timing information
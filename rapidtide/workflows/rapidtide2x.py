@@ -27,7 +27,6 @@ from __future__ import print_function, division
 
 import bisect
 import getopt
-import multiprocessing as mp
 import os
 import platform
 import sys
@@ -119,31 +118,6 @@ def maketmask(filename, timeaxis, maskvector, debug=False):
     return maskvector
 
 
-def numpy2shared(inarray, thetype):
-    thesize = inarray.size
-    theshape = inarray.shape
-    if thetype == np.float64:
-        inarray_shared = mp.RawArray('d', inarray.reshape(thesize))
-    else:
-        inarray_shared = mp.RawArray('f', inarray.reshape(thesize))
-    inarray = np.frombuffer(inarray_shared, dtype=thetype, count=thesize)
-    inarray.shape = theshape
-    return inarray, inarray_shared, theshape
-
-
-def allocshared(theshape, thetype):
-    thesize = int(1)
-    for element in theshape:
-        thesize *= int(element)
-    if thetype == np.float64:
-        outarray_shared = mp.RawArray('d', thesize)
-    else:
-        outarray_shared = mp.RawArray('f', thesize)
-    outarray = np.frombuffer(outarray_shared, dtype=thetype, count=thesize)
-    outarray.shape = theshape
-    return outarray, outarray_shared, theshape
-
-
 def readamask(maskfilename, nim_hdr, xsize, istext=False, valslist=None, maskname='the', verbose=False):
     if verbose:
         print('readamask called with filename:', maskfilename, 'vals:', valslist)
@@ -313,6 +287,11 @@ def usage():
     print("                                     correlations (default is 10000, set to 0 to disable)")
     print("    --permutationmethod=METHOD     - Method for permuting the regressor for significance estimation.  Default")
     print("                                     is shuffle")
+    print("    --sigtolerance=TOL             - Treat NREPS as a maximum, and stop doing null correlations once the")
+    print("                                     bootstrap confidence intervals on the significance thresholds are")
+    print("                                     within +/- TOL (default is to do all NREPS).")
+    print("    --nullseed=SEED                - Seed the null correlation permutations with SEED, so the significance")
+    print("                                     thresholds are reproducible (default is a random seed).")
     print("    --skipsighistfit               - Do not fit significance histogram with a Johnson SB function")
     print("    --windowfunc=FUNC              - Use FUNC window funcion prior to correlation.  Options are")
     print("                                     hamming (default), hann, blackmanharris, and None")
@@ -423,6 +402,11 @@ def usage():
     print("                                     unweighted averaging)")
     print("    --ica                          - Use ica to derive refined regressor (default is ")
     print("                                     unweighted averaging)")
+    print("    --pcasolver=SOLVER             - Method for finding the components for --pca and --ica.  Options are")
+    print("                                     full (default), randomized, and incremental.  randomized and")
+    print("                                     incremental only find the leading components, reading the shifted")
+    print("                                     timecourses in blocks, which is faster and uses much less memory")
+    print("                                     for large numbers of voxels.")
     print("    --weightedavg                  - Use weighted average to derive refined regressor ")
     print("                                     (default is unweighted averaging)")
     print("    --avg                          - Use unweighted average to derive refined regressor ")
@@ -462,6 +446,24 @@ def usage():
     print("    --nprocs=NPROCS                - Use NPROCS worker processes for multiprocessing.  Setting NPROCS")
     print("                                     less than 1 sets the number of worker processes to")
     print("                                     n_cpus - 1 (default).  Setting NPROCS enables --multiproc.")
+    print("    --corrbatchsize=NVOX           - Correlate, fit, timeshift, and GLM filter NVOX voxels (and null")
+    print("                                     permutations) at a time (default is 1000).  When multiprocessing")
+    print("                                     with shared memory, this is also the number of voxels sent to a")
+    print("                                     worker at once.  Set to 1 to process voxels one at a time.")
+    print("    --lagrangeonly                 - Only calculate the correlation function within the lag search")
+    print("                                     range, using direct sums or a pruned FFT, whichever is cheaper.")
+    print("    --outputcompression=LEVEL      - Compress nifti output files with gzip level LEVEL (0-9).  0 writes")
+    print("                                     uncompressed .nii files (default is the nibabel default, 1).")
+    print("    --outputthreads=NTHREADS       - Use NTHREADS threads to compress nifti output files (default is 1).")
+    print("    --outputqueuesize=MB           - Write output files in the background, holding up to MB megabytes of")
+    print("                                     pending output in memory (default is 1024).  0 writes files")
+    print("                                     immediately.")
+    print("    --resume                       - Restart an interrupted run from the last pass it completed, using the")
+    print("                                     checkpoint saved after each pass (OUTPUTNAME_passcheckpoint.npz).")
+    print("                                     All other options must be the same as in the original run.")
+    print("    --nullcachedir=DIR             - Save null correlation distributions and their fits in DIR, and reuse")
+    print("                                     them in later runs with the same regressor, filter, lag range, and")
+    print("                                     significance options instead of recalculating them.")
     print("    --debug                        - Enable additional information output")
     print("    --saveoptionsasjson            - Save the options file in json format rather than text.  Will eventually")
     print("                                     become the default, but for now I'm just trying it out.")
@@ -590,6 +592,8 @@ def rapidtide_main():
     # significance estimation options
     optiondict['numestreps'] = 10000  # the number of sham correlations to perform to estimate significance
     optiondict['permutationmethod'] = 'shuffle'
+    optiondict['sigtolerance'] = None   # if set, stop sham correlations when the thresholds are this precise
+    optiondict['nullseed'] = None       # seed for the sham correlation permutations
     optiondict['nohistzero'] = False  # if False, there is a spike at R=0 in the significance histogram
     optiondict['ampthreshfromsig'] = True
     optiondict['sighistlen'] = 1000
@@ -624,6 +628,7 @@ def rapidtide_main():
     optiondict['corrmaskvallist'] = None
     optiondict['refinetype'] = 'unweighted_average'
     optiondict['estimatePCAdims'] = False
+    optiondict['pcasolver'] = 'full'
     optiondict['filterbeforePCA'] = True
     optiondict['fmrifreq'] = 0.0
     optiondict['dodispersioncalc'] = False
@@ -647,10 +652,17 @@ def rapidtide_main():
     optiondict['nprocs'] = 1
     optiondict['mklthreads'] = 1
     optiondict['mp_chunksize'] = 50000
+    optiondict['corrbatchsize'] = 1000
+    optiondict['lagrangeonly'] = False
+    optiondict['outputcompression'] = None
+    optiondict['outputthreads'] = 1
+    optiondict['outputqueuesize'] = 1024
     optiondict['showprogressbar'] = True
     optiondict['savecorrmask'] = True
     optiondict['savedespecklemasks'] = True
     optiondict['checkpoint'] = False                    # save checkpoint information for tracking program state
+    optiondict['resume'] = False                        # restart from the last completed pass
+    optiondict['nullcachedir'] = None                   # directory for reusing null distributions between runs
 
     # package options
     optiondict['memprofilerexists'] = memprofilerexists
@@ -713,6 +725,7 @@ def rapidtide_main():
                                                                                                           'cleanrefined',
                                                                                                           'pca',
                                                                                                           'ica',
+                                                                                                          'pcasolver=',
                                                                                                           'weightedavg',
                                                                                                           'avg',
                                                                                                           'psdfilter',
@@ -723,7 +736,16 @@ def rapidtide_main():
                                                                                                           'multiproc',
                                                                                                           'mklthreads=',
                                                                                                           'permutationmethod=',
+                                                                                                          'sigtolerance=',
+                                                                                                          'nullseed=',
                                                                                                           'nprocs=',
+                                                                                                          'corrbatchsize=',
+                                                                                                          'lagrangeonly',
+                                                                                                          'outputcompression=',
+                                                                                                          'outputthreads=',
+                                                                                                          'outputqueuesize=',
+                                                                                                          'resume',
+                                                                                                          'nullcachedir=',
                                                                                                           'debug',
                                                                                                           'nonumba',
                                                                                                           'savemotionglmfilt',
@@ -785,6 +807,15 @@ def rapidtide_main():
             optiondict['permutationmethod'] = themethod
             linkchar = '='
             print('Will use', optiondict['permutationmethod'], 'as the permutation method for calculating null correlation threshold')
+        elif o == '--sigtolerance':
+            optiondict['sigtolerance'] = float(a)
+            linkchar = '='
+            print('Will stop null correlations when the significance thresholds are within',
+                  optiondict['sigtolerance'])
+        elif o == '--nullseed':
+            optiondict['nullseed'] = int(a)
+            linkchar = '='
+            print('Will seed null correlations with', optiondict['nullseed'])
         elif o == '--windowfunc':
             optiondict['usewindowfunc'] = True
             thewindow = a
@@ -900,6 +931,35 @@ def rapidtide_main():
                 print('will use n_cpus - 1 processes for calculation')
             else:
                 print('will use', optiondict['nprocs'], 'processes for calculation')
+        elif o == '--corrbatchsize':
+            optiondict['corrbatchsize'] = int(a)
+            linkchar = '='
+            print('will process', optiondict['corrbatchsize'], 'voxels at a time')
+        elif o == '--lagrangeonly':
+            optiondict['lagrangeonly'] = True
+            print('will only calculate correlations within the lag range')
+        elif o == '--outputcompression':
+            optiondict['outputcompression'] = int(a)
+            linkchar = '='
+            if (optiondict['outputcompression'] < 0) or (optiondict['outputcompression'] > 9):
+                print('outputcompression must be between 0 and 9')
+                sys.exit()
+            print('will write nifti files with compression level', optiondict['outputcompression'])
+        elif o == '--outputthreads':
+            optiondict['outputthreads'] = int(a)
+            linkchar = '='
+            print('will use', optiondict['outputthreads'], 'threads to compress nifti files')
+        elif o == '--outputqueuesize':
+            optiondict['outputqueuesize'] = int(a)
+            linkchar = '='
+            print('will hold up to', optiondict['outputqueuesize'], 'MB of output in memory while writing')
+        elif o == '--resume':
+            optiondict['resume'] = True
+            print('will resume from the last completed pass, if possible')
+        elif o == '--nullcachedir':
+            optiondict['nullcachedir'] = a
+            linkchar = '='
+            print('will cache null distributions in', optiondict['nullcachedir'])
         elif o == '--saveoptionsasjson':
             optiondict['saveoptionsasjson'] = True
             print('saving options file as json rather than text')
@@ -1103,6 +1163,13 @@ def rapidtide_main():
         elif o == '--pca':
             optiondict['refinetype'] = 'pca'
             print('Will use PCA procedure to refine regressor rather than simple averaging')
+        elif o == '--pcasolver':
+            if (a != 'full') and (a != 'randomized') and (a != 'incremental'):
+                print('illegal pca solver', a)
+                sys.exit()
+            optiondict['pcasolver'] = a
+            linkchar = '='
+            print('Will use the', optiondict['pcasolver'], 'solver for PCA and ICA refinement')
         elif o == '--numskip':
             optiondict['preprocskip'] = int(a)
             linkchar = '='
@@ -1330,6 +1397,11 @@ def rapidtide_main():
         optiondict['sharedmem'] = False
         print('running single process - disabled shared memory use')
 
+    # set up nifti output
+    tide_io.setniftiwriteoptions(compresslevel=optiondict['outputcompression'],
+                                 nthreads=optiondict['outputthreads'])
+    theoutputwriter = tide_io.backgroundwriter(maxpendingbytes=optiondict['outputqueuesize'] * 1048576)
+
     # disable numba now if we're going to do it (before any jits)
     if optiondict['nonumba']:
         tide_util.disablenumba()
@@ -1398,7 +1470,13 @@ def rapidtide_main():
         numspatiallocs = int(xsize)
         slicesize = numspatiallocs
     else:
-        nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(fmrifilename)
+        # keep the data in its type on disk (memory mapped if possible) until the valid voxels are selected,
+        # unless it is going to be smoothed in place
+        if optiondict['dogaussianfilter']:
+            nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(fmrifilename, mmap=True,
+                                                                              dtype=rt_floattype)
+        else:
+            nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(fmrifilename, mmap=True)
         if nim_hdr['intent_code'] == 3002:
             print('input file is CIFTI')
             optiondict['isgrayordinate'] = True
@@ -1580,14 +1658,14 @@ def rapidtide_main():
         else:
             theheader['dim'][0] = 3
             theheader['dim'][4] = 1
-        tide_io.savetonifti(corrmask.reshape(xsize, ysize, numslices), theheader, outputname + '_corrmask')
+        theoutputwriter.savetonifti(corrmask.reshape(xsize, ysize, numslices), theheader, outputname + '_corrmask')
 
     if optiondict['verbose']:
         print('image threshval =', threshval)
     validvoxels = np.where(corrmask > 0)[0]
     numvalidspatiallocs = np.shape(validvoxels)[0]
     print('validvoxels shape =', numvalidspatiallocs)
-    fmri_data_valid = fmri_data[validvoxels, :] + 0.0
+    fmri_data_valid = np.asarray(fmri_data[validvoxels, :], dtype=rt_floattype)
     print('original size =', np.shape(fmri_data), ', trimmed size =', np.shape(fmri_data_valid))
     if internalglobalmeanincludemask is not None:
         internalglobalmeanincludemask_valid = 1.0 * internalglobalmeanincludemask[validvoxels]
@@ -1619,7 +1697,7 @@ def rapidtide_main():
     if optiondict['sharedmem']:
         print('moving fmri data to shared memory')
         timings.append(['Start moving fmri_data to shared memory', time.time(), None, None])
-        numpy2shared_func = addmemprofiling(numpy2shared,
+        numpy2shared_func = addmemprofiling(tide_multiproc.numpy2shared,
                                             optiondict['memprofile'],
                                             memfile,
                                             'before fmri data move')
@@ -1638,14 +1716,20 @@ def rapidtide_main():
         print('regressing out motion')
 
         timings.append(['Motion filtering start', time.time(), None, None])
-        motionregressors, fmri_data_valid = tide_glmpass.motionregress(optiondict['motionfilename'],
-                                                                    fmri_data_valid,
-                                                                    tr,
-                                                                    motstart=validstart,
-                                                                    motend=validend + 1,
-                                                                    position=optiondict['mot_pos'],
-                                                                    deriv=optiondict['mot_deriv'],
-                                                                    derivdelayed=optiondict['mot_delayderiv'])
+        motionregressors, motionfiltered = tide_glmpass.motionregress(optiondict['motionfilename'],
+                                                                   fmri_data_valid,
+                                                                   tr,
+                                                                   motstart=validstart,
+                                                                   motend=validend + 1,
+                                                                   position=optiondict['mot_pos'],
+                                                                   deriv=optiondict['mot_deriv'],
+                                                                   derivdelayed=optiondict['mot_delayderiv'])
+        if optiondict['sharedmem']:
+            # keep the filtered data in shared memory, where the worker pool can read it
+            fmri_data_valid[:] = motionfiltered
+        else:
+            fmri_data_valid = motionfiltered
+        del motionfiltered
 
         timings.append(['Motion filtering end', time.time(), fmri_data_valid.shape[0], 'voxels'])
         tide_io.writenpvecs(motionregressors, outputname + '_orthogonalizedmotion.txt')
@@ -1661,8 +1745,8 @@ def rapidtide_main():
                 tide_io.writenpvecs(outfmriarray.reshape((numspatiallocs, validtimepoints)),
                                 outputname + '_motionfiltered' + '' + '.txt')
             else:
-                tide_io.savetonifti(outfmriarray.reshape((xsize, ysize, numslices, validtimepoints)), nim_hdr,
-                                outputname + '_motionfiltered' + '')
+                theoutputwriter.savetonifti(outfmriarray.reshape((xsize, ysize, numslices, validtimepoints)), nim_hdr,
+                                        outputname + '_motionfiltered' + '')
 
 
     # read in the timecourse to resample
@@ -1686,8 +1770,8 @@ def rapidtide_main():
         else:
             theheader['dim'][0] = 3
             theheader['dim'][4] = 1
-        tide_io.savetonifti(fullmeanmask.reshape((xsize, ysize, numslices)), theheader,
-                            outputname + '_meanmask' + '')
+        theoutputwriter.savetonifti(fullmeanmask.reshape((xsize, ysize, numslices)), theheader,
+                                    outputname + '_meanmask' + '')
         optiondict['preprocskip'] = 0
     else:
         if inputfreq is None:
@@ -1823,7 +1907,8 @@ def rapidtide_main():
                                          usewindowfunc=optiondict['usewindowfunc'],
                                          detrendorder=optiondict['detrendorder'],
                                          windowfunc=optiondict['windowfunc'],
-                                         corrweighting=optiondict['corrweighting'])
+                                         corrweighting=optiondict['corrweighting'],
+                                         lagrangeonly=optiondict['lagrangeonly'])
     thecorrelator.setreftc(np.zeros((optiondict['oversampfactor'] * (validtimepoints - optiondict['addedskip'])),
                                     dtype=np.float))
     numccorrlags = thecorrelator.corrlen
@@ -1859,13 +1944,23 @@ def rapidtide_main():
             nativespaceshape = (xsize, ysize, numslices)
     internalspaceshape = numspatiallocs
     internalvalidspaceshape = numvalidspatiallocs
-    meanval = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
-    lagtimes = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
-    lagstrengths = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
-    lagsigma = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
-    lagmask = np.zeros(internalvalidspaceshape, dtype='uint16')
-    failimage = np.zeros(internalvalidspaceshape, dtype='uint16')
-    R2 = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
+    if optiondict['sharedmem']:
+        # the worker processes write these directly
+        meanval, dummy, dummy = tide_multiproc.allocshared((internalvalidspaceshape,), rt_floatset)
+        lagtimes, dummy, dummy = tide_multiproc.allocshared((internalvalidspaceshape,), rt_floatset)
+        lagstrengths, dummy, dummy = tide_multiproc.allocshared((internalvalidspaceshape,), rt_floatset)
+        lagsigma, dummy, dummy = tide_multiproc.allocshared((internalvalidspaceshape,), rt_floatset)
+        lagmask, dummy, dummy = tide_multiproc.allocshared((internalvalidspaceshape,), np.uint16)
+        failimage, dummy, dummy = tide_multiproc.allocshared((internalvalidspaceshape,), np.uint16)
+        R2, dummy, dummy = tide_multiproc.allocshared((internalvalidspaceshape,), rt_floatset)
+    else:
+        meanval = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
+        lagtimes = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
+        lagstrengths = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
+        lagsigma = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
+        lagmask = np.zeros(internalvalidspaceshape, dtype='uint16')
+        failimage = np.zeros(internalvalidspaceshape, dtype='uint16')
+        R2 = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
     outmaparray = np.zeros(internalspaceshape, dtype=rt_floattype)
     tide_util.logmem('after main array allocation', file=memfile)
 
@@ -1881,10 +1976,10 @@ def rapidtide_main():
     internalvalidcorrshape = (numvalidspatiallocs, corroutlen)
     print('allocating memory for correlation arrays', internalcorrshape, internalvalidcorrshape)
     if optiondict['sharedmem']:
-        corrout, dummy, dummy = allocshared(internalvalidcorrshape, rt_floatset)
-        gaussout, dummy, dummy = allocshared(internalvalidcorrshape, rt_floatset)
-        windowout, dummy, dummy = allocshared(internalvalidcorrshape, rt_floatset)
-        outcorrarray, dummy, dummy = allocshared(internalcorrshape, rt_floatset)
+        corrout, dummy, dummy = tide_multiproc.allocshared(internalvalidcorrshape, rt_floatset)
+        gaussout, dummy, dummy = tide_multiproc.allocshared(internalvalidcorrshape, rt_floatset)
+        windowout, dummy, dummy = tide_multiproc.allocshared(internalvalidcorrshape, rt_floatset)
+        outcorrarray, dummy, dummy = tide_multiproc.allocshared(internalcorrshape, rt_floatset)
     else:
         corrout = np.zeros(internalvalidcorrshape, dtype=rt_floattype)
         gaussout = np.zeros(internalvalidcorrshape, dtype=rt_floattype)
@@ -1901,19 +1996,22 @@ def rapidtide_main():
             nativefmrishape = (xsize, ysize, numslices, np.shape(initial_fmri_x)[0])
     internalfmrishape = (numspatiallocs, np.shape(initial_fmri_x)[0])
     internalvalidfmrishape = (numvalidspatiallocs, np.shape(initial_fmri_x)[0])
-    lagtc = np.zeros(internalvalidfmrishape, dtype=rt_floattype)
+    if optiondict['sharedmem']:
+        lagtc, dummy, dummy = tide_multiproc.allocshared(internalvalidfmrishape, rt_floatset)
+    else:
+        lagtc = np.zeros(internalvalidfmrishape, dtype=rt_floattype)
     tide_util.logmem('after lagtc array allocation', file=memfile)
 
     if optiondict['passes'] > 1:
         if optiondict['sharedmem']:
-            shiftedtcs, dummy, dummy = allocshared(internalvalidfmrishape, rt_floatset)
-            weights, dummy, dummy = allocshared(internalvalidfmrishape, rt_floatset)
+            shiftedtcs, dummy, dummy = tide_multiproc.allocshared(internalvalidfmrishape, rt_floatset)
+            weights, dummy, dummy = tide_multiproc.allocshared(internalvalidfmrishape, rt_floatset)
         else:
             shiftedtcs = np.zeros(internalvalidfmrishape, dtype=rt_floattype)
             weights = np.zeros(internalvalidfmrishape, dtype=rt_floattype)
         tide_util.logmem('after refinement array allocation', file=memfile)
     if optiondict['sharedmem']:
-        outfmriarray, dummy, dummy = allocshared(internalfmrishape, rt_floatset)
+        outfmriarray, dummy, dummy = tide_multiproc.allocshared(internalfmrishape, rt_floatset)
     else:
         outfmriarray = np.zeros(internalfmrishape, dtype=rt_floattype)
 
@@ -1951,7 +2049,51 @@ def rapidtide_main():
                                              enforcethresh=optiondict['enforcethresh'],
                                              hardlimit=optiondict['hardlimit'])
 
-    for thepass in range(1, optiondict['passes'] + 1):
+    # the variables that change from pass to pass, and are needed to start the next one
+    passcheckpointname = outputname + '_passcheckpoint.npz'
+    passcheckpointoptions = ['offsettime', 'offsettime_total', 'lagmod', 'acwidth', 'absmaxsigma', 'despeckle_thresh',
+                             'ampthresh']
+    startpass = 1
+    if optiondict['resume']:
+        if os.path.isfile(passcheckpointname):
+            print('resuming from', passcheckpointname)
+            thecheckpoint = tide_io.readcheckpoint(passcheckpointname)
+            if not np.array_equal(thecheckpoint['validvoxels'], validvoxels):
+                print('ERROR: the checkpoint was made with a different correlation mask - exiting')
+                sys.exit()
+            lagtimes[:] = thecheckpoint['lagtimes']
+            lagstrengths[:] = thecheckpoint['lagstrengths']
+            lagsigma[:] = thecheckpoint['lagsigma']
+            lagmask[:] = thecheckpoint['lagmask']
+            failimage[:] = thecheckpoint['failimage']
+            R2[:] = thecheckpoint['R2']
+            refinemask = thecheckpoint['refinemask']
+            resampref_y = thecheckpoint['resampref_y']
+            resampnonosref_y = thecheckpoint['resampnonosref_y']
+            genlagtc = tide_resample.fastresampler(initial_fmri_x, thecheckpoint['normoutputdata'],
+                                                   padvalue=padvalue)
+            for key in thecheckpoint:
+                if key.startswith('option_'):
+                    optiondict[key[len('option_'):]] = thecheckpoint[key].item()
+            startpass = int(thecheckpoint['thepass']) + 1
+            print('starting at pass', startpass)
+            timings.append(['Resumed from checkpoint after pass ' + str(startpass - 1), time.time(), None, None])
+            del thecheckpoint
+        else:
+            print('no checkpoint found - starting from the beginning')
+
+    # start a persistent pool of workers for the passes, so that only changed state has to be sent to them
+    if optiondict['nprocs'] > 1 and optiondict['sharedmem']:
+        poolarrays = [fmri_data_valid, corrout, gaussout, windowout, lagtc, meanval, lagtimes, lagstrengths,
+                      lagsigma, lagmask, failimage, R2]
+        if optiondict['passes'] > 1:
+            poolarrays += [shiftedtcs, weights]
+        thepool = tide_multiproc.workerpool(optiondict['nprocs'], sharedarrays=poolarrays)
+    else:
+        thepool = None
+
+    thenullresults = {}
+    for thepass in range(startpass, optiondict['passes'] + 1):
         # initialize the pass
         if optiondict['passes'] > 1:
             print('\n\n*********************')
@@ -2087,6 +2229,7 @@ def rapidtide_main():
             thecorrelator.setreftc(cleaned_resampref_y)
             dummy, trimmedcorrscale, dummy = thecorrelator.getcorrelation()
             thefitter.setcorrtimeaxis(trimmedcorrscale)
+            thepercentiles = np.array([0.95, 0.99, 0.995, 0.999])
             corrdistdata = getNullDistributionData_func(cleaned_resampref_y,
                                                          oversampfreq,
                                                          thecorrelator,
@@ -2098,12 +2241,19 @@ def rapidtide_main():
                                                          permutationmethod=optiondict['permutationmethod'],
                                                          fixdelay=optiondict['fixdelay'],
                                                          fixeddelayvalue=optiondict['fixeddelayvalue'],
+                                                         batchsize=optiondict['corrbatchsize'],
+                                                         thepool=thepool,
+                                                         cachedir=optiondict['nullcachedir'],
+                                                         sigtolerance=optiondict['sigtolerance'],
+                                                         sigpercentiles=thepercentiles,
+                                                         twotail=optiondict['bipolar'],
+                                                         nozero=optiondict['nohistzero'],
+                                                         seed=optiondict['nullseed'],
                                                          rt_floatset=np.float64,
                                                          rt_floattype='float64')
             tide_io.writenpvecs(corrdistdata, outputname + '_corrdistdata_pass' + str(thepass) + '.txt')
 
             # calculate percentiles for the crosscorrelation from the distribution data
-            thepercentiles = np.array([0.95, 0.99, 0.995, 0.999])
             thepvalnames = []
             for thispercentile in thepercentiles:
                 thepvalnames.append("{:.3f}".format(1.0 - thispercentile).replace('.', 'p'))
@@ -2112,7 +2262,8 @@ def rapidtide_main():
                                                                         thepercentiles, twotail=optiondict['bipolar'],
                                                                         displayplots=optiondict['displayplots'],
                                                                         nozero=optiondict['nohistzero'],
-                                                                        dosighistfit=optiondict['dosighistfit'])
+                                                                        dosighistfit=optiondict['dosighistfit'],
+                                                                        cachedir=optiondict['nullcachedir'])
             if optiondict['ampthreshfromsig']:
                 if pcts is not None:
                     print('setting ampthresh to the p<', "{:.3f}".format(1.0 - thepercentiles[0]), ' threshhold')
@@ -2128,9 +2279,10 @@ def rapidtide_main():
                 else:
                     print('leaving ampthresh unchanged')
 
-            del corrdistdata
-            timings.append(['Significance estimation end, pass ' + str(thepass), time.time(), optiondict['numestreps'],
+            timings.append(['Significance estimation end, pass ' + str(thepass), time.time(), len(corrdistdata),
                             'repetitions'])
+            thenullresults = {'corrdistdata': corrdistdata, 'pcts': pcts, 'pcts_fit': pcts_fit, 'sigfit': sigfit}
+            del corrdistdata
 
         # Step 1 - Correlation step
         print('\n\nCorrelation calculation, pass ' + str(thepass))
@@ -2156,6 +2308,9 @@ def rapidtide_main():
                                                                interptype=optiondict['interptype'],
                                                                showprogressbar=optiondict['showprogressbar'],
                                                                chunksize=optiondict['mp_chunksize'],
+                                                               batchsize=optiondict['corrbatchsize'],
+                                                               usesharedmem=optiondict['sharedmem'],
+                                                               thepool=thepool,
                                                                rt_floatset=rt_floatset,
                                                                rt_floattype=rt_floattype)
 
@@ -2173,8 +2328,8 @@ def rapidtide_main():
                 tide_io.writenpvecs(outcorrarray.reshape(nativecorrshape),
                                     outputname + '_corrout_prefit_pass' + str(thepass) + outsuffix4d + '.txt')
             else:
-                tide_io.savetonifti(outcorrarray.reshape(nativecorrshape), theheader,
-                                    outputname + '_corrout_prefit_pass' + str(thepass)+ outsuffix4d)
+                theoutputwriter.savetonifti(outcorrarray.reshape(nativecorrshape), theheader,
+                                            outputname + '_corrout_prefit_pass' + str(thepass)+ outsuffix4d)
 
         timings.append(['Correlation calculation end, pass ' + str(thepass), time.time(), voxelsprocessed_cp, 'voxels'])
 
@@ -2198,6 +2353,9 @@ def rapidtide_main():
                                           fixdelay=optiondict['fixdelay'],
                                           showprogressbar=optiondict['showprogressbar'],
                                           chunksize=optiondict['mp_chunksize'],
+                                          batchsize=optiondict['corrbatchsize'],
+                                          usesharedmem=optiondict['sharedmem'],
+                                          thepool=thepool,
                                           despeckle_thresh=optiondict['despeckle_thresh'],
                                           rt_floatset=rt_floatset,
                                           rt_floattype=rt_floattype
@@ -2236,6 +2394,9 @@ def rapidtide_main():
                                                               fixdelay=optiondict['fixdelay'],
                                                               showprogressbar=optiondict['showprogressbar'],
                                                               chunksize=optiondict['mp_chunksize'],
+                                                              batchsize=optiondict['corrbatchsize'],
+                                                              usesharedmem=optiondict['sharedmem'],
+                                                              thepool=thepool,
                                                               despeckle_thresh=optiondict['despeckle_thresh'],
                                                               initiallags=initlags,
                                                               rt_floatset=rt_floatset,
@@ -2256,8 +2417,8 @@ def rapidtide_main():
                 else:
                     theheader['dim'][0] = 3
                     theheader['dim'][4] = 1
-                tide_io.savetonifti((np.where(np.abs(outmaparray - medianlags) > optiondict['despeckle_thresh'], medianlags, 0.0)).reshape(nativespaceshape), theheader,
-                                 outputname + '_despecklemask_pass' + str(thepass))
+                theoutputwriter.savetonifti((np.where(np.abs(outmaparray - medianlags) > optiondict['despeckle_thresh'], medianlags, 0.0)).reshape(nativespaceshape), theheader,
+                                         outputname + '_despecklemask_pass' + str(thepass))
             print('\n\n', voxelsprocessed_fc_ds, 'voxels despeckled in', optiondict['despeckle_passes'], 'passes')
             timings.append(
                 ['Correlation despeckle end, pass ' + str(thepass), time.time(), voxelsprocessed_fc_ds, 'voxels'])
@@ -2295,7 +2456,8 @@ def rapidtide_main():
                 includemask=internalrefineincludemask_valid,
                 excludemask=internalrefineexcludemask_valid,
                 rt_floatset=rt_floatset,
-                rt_floattype=rt_floattype)
+                rt_floattype=rt_floattype,
+                thepool=thepool)
             normoutputdata = tide_math.stdnormalize(theprefilter.apply(fmrifreq, outputdata))
             tide_io.writenpvecs(normoutputdata, outputname + '_refinedregressor_pass' + str(thepass) + '.txt')
 
@@ -2340,6 +2502,31 @@ def rapidtide_main():
             timings.append(
                 ['Regressor refinement end, pass ' + str(thepass), time.time(), voxelsprocessed_rr, 'voxels'])
 
+            # save everything needed to restart at the next pass
+            thecheckpoint = {'thepass': thepass,
+                             'validvoxels': validvoxels,
+                             'lagtimes': lagtimes,
+                             'lagstrengths': lagstrengths,
+                             'lagsigma': lagsigma,
+                             'lagmask': lagmask,
+                             'failimage': failimage,
+                             'R2': R2,
+                             'refinemask': refinemask,
+                             'normoutputdata': normoutputdata,
+                             'resampref_y': resampref_y,
+                             'resampnonosref_y': resampnonosref_y}
+            thecheckpoint.update(thenullresults)
+            for key in passcheckpointoptions + [key for key in optiondict if key.startswith('acsidelobe')]:
+                if key in optiondict:
+                    thecheckpoint['option_' + key] = optiondict[key]
+            tide_io.writecheckpoint(thecheckpoint, passcheckpointname)
+            del thecheckpoint
+            timings.append(['Checkpoint saved, pass ' + str(thepass), time.time(), None, None])
+
+    # the remaining steps don't use the pool
+    if thepool is not None:
+        thepool.shutdown()
+
     # Post refinement step 0 - Wiener deconvolution
     if optiondict['dodeconv']:
         timings.append(['Wiener deconvolution start', time.time(), None, None])
@@ -2347,21 +2534,24 @@ def rapidtide_main():
         reportstep = 1000
 
         # now allocate the arrays needed for Wiener deconvolution
-        wienerdeconv = np.zeros(internalvalidspaceshape, dtype=rt_outfloattype)
+        wienerdeconv = np.zeros(internalvalidfmrishape, dtype=rt_outfloattype)
         wpeak = np.zeros(internalvalidspaceshape, dtype=rt_outfloattype)
 
         wienerpass_func = addmemprofiling(tide_wiener.wienerpass,
                                           optiondict['memprofile'],
                                           memfile,
                                           'before wienerpass')
-        voxelsprocessed_wiener = wienerpass_func(numspatiallocs,
+        voxelsprocessed_wiener = wienerpass_func(numvalidspatiallocs,
                                                  reportstep,
                                                  fmri_data_valid,
                                                  threshval,
+                                                 lagtc,
                                                  optiondict,
-                                                 wienerdeconv,
-                                                 wpeak,
-                                                 resampref_y,
+                                                 wienerdeconv=wienerdeconv,
+                                                 wpeak=wpeak,
+                                                 theregressor=resampnonosref_y,
+                                                 fmritr=fmritr,
+                                                 batchsize=optiondict['corrbatchsize'],
                                                  rt_floatset=rt_floatset,
                                                  rt_floattype=rt_floattype
                                                  )
@@ -2375,31 +2565,35 @@ def rapidtide_main():
         if optiondict['dogaussianfilter'] or (optiondict['glmsourcefile'] is not None):
             if optiondict['glmsourcefile'] is not None:
                 print('reading in ', optiondict['glmsourcefile'], 'for GLM filter, please wait')
-                if optiondict['textio']:
-                    nim_data = tide_io.readvecs(optiondict['glmsourcefile'])
-                else:
-                    nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(optiondict['glmsourcefile'])
+                glmsourcefilename = optiondict['glmsourcefile']
             else:
                 print('rereading', fmrifilename, ' for GLM filter, please wait')
+                glmsourcefilename = fmrifilename
+            if optiondict['textio'] or fileiscifti:
                 if optiondict['textio']:
-                    nim_data = tide_io.readvecs(fmrifilename)
+                    nim_data = tide_io.readvecs(glmsourcefilename)
                 else:
-                    nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(fmrifilename)
-            fmri_data_valid = (nim_data.reshape((numspatiallocs, timepoints))[:, validstart:validend + 1])[validvoxels,
-                              :] + 0.0
+                    nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(glmsourcefilename)
+                fmri_data_valid = (nim_data.reshape((numspatiallocs, timepoints))[:, validstart:validend + 1])[
+                                  validvoxels, :] + 0.0
+                del nim_data
+            else:
+                # only read the voxels and timepoints we need
+                fmri_data_valid = tide_io.readniftivoxels(glmsourcefilename, validvoxels=validvoxels,
+                                                          startpoint=validstart, endpoint=validend,
+                                                          dtype=rt_floattype)
 
             # move fmri_data_valid into shared memory
             if optiondict['sharedmem']:
                 print('moving fmri data to shared memory')
                 timings.append(['Start moving fmri_data to shared memory', time.time(), None, None])
-                numpy2shared_func = addmemprofiling(numpy2shared,
+                numpy2shared_func = addmemprofiling(tide_multiproc.numpy2shared,
                                                     optiondict['memprofile'],
                                                     memfile,
                                                     'before movetoshared (glm)')
                 fmri_data_valid, fmri_data_valid_shared, fmri_data_valid_shared_shape = numpy2shared_func(
                     fmri_data_valid, rt_floatset)
                 timings.append(['End moving fmri_data to shared memory', time.time(), None, None])
-            del nim_data
 
         # now allocate the arrays needed for GLM filtering
         meanvalue = np.zeros(internalvalidspaceshape, dtype=rt_outfloattype)
@@ -2408,8 +2602,8 @@ def rapidtide_main():
         fitNorm = np.zeros(internalvalidspaceshape, dtype=rt_outfloattype)
         fitcoff = np.zeros(internalvalidspaceshape, dtype=rt_outfloattype)
         if optiondict['sharedmem']:
-            datatoremove, dummy, dummy = allocshared(internalvalidfmrishape, rt_outfloatset)
-            filtereddata, dummy, dummy = allocshared(internalvalidfmrishape, rt_outfloatset)
+            datatoremove, dummy, dummy = tide_multiproc.allocshared(internalvalidfmrishape, rt_outfloatset)
+            filtereddata, dummy, dummy = tide_multiproc.allocshared(internalvalidfmrishape, rt_outfloatset)
         else:
             datatoremove = np.zeros(internalvalidfmrishape, dtype=rt_outfloattype)
             filtereddata = np.zeros(internalvalidfmrishape, dtype=rt_outfloattype)
@@ -2442,6 +2636,7 @@ def rapidtide_main():
                                            showprogressbar=optiondict['showprogressbar'],
                                            addedskip=optiondict['addedskip'],
                                            mp_chunksize=optiondict['mp_chunksize'],
+                                           batchsize=optiondict['corrbatchsize'],
                                            rt_floatset=rt_floatset,
                                            rt_floattype=rt_floattype
                                            )
@@ -2459,7 +2654,7 @@ def rapidtide_main():
         if optiondict['textio']:
             nim_data = tide_io.readvecs(fmrifilename)
         else:
-            nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(fmrifilename)
+            nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(fmrifilename, mmap=True)
         fmri_data = nim_data.reshape((numspatiallocs, timepoints))[:, validstart:validend + 1]
         meanvalue = np.mean(fmri_data, axis=1)
 
@@ -2491,6 +2686,7 @@ def rapidtide_main():
 
     # do ones with one time point first
     timings.append(['Start saving maps', time.time(), None, None])
+    tide_io.getniftibyteswritten(reset=True)
     if not optiondict['textio']:
         theheader = copy.deepcopy(nim_hdr)
         if fileiscifti:
@@ -2515,8 +2711,19 @@ def rapidtide_main():
             tide_io.writenpvecs(outmaparray.reshape(nativespaceshape, 1),
                                 outputname + '_' + mapname + outsuffix3d + '.txt')
         else:
-            tide_io.savetonifti(outmaparray.reshape(nativespaceshape), theheader,
-                                outputname + '_' + mapname + outsuffix3d)
+            theoutputwriter.savetonifti(outmaparray.reshape(nativespaceshape), theheader,
+                                        outputname + '_' + mapname + outsuffix3d)
+
+    if optiondict['dodeconv']:
+        outmaparray[:] = 0.0
+        outmaparray[validvoxels] = wpeak[:]
+        if optiondict['textio']:
+            tide_io.writenpvecs(outmaparray.reshape(nativespaceshape),
+                                outputname + '_wienerpeak' + outsuffix3d + '.txt')
+        else:
+            theoutputwriter.savetonifti(outmaparray.reshape(nativespaceshape), theheader,
+                                        outputname + '_wienerpeak' + outsuffix3d)
+        del wpeak
 
     if optiondict['doglmfilt']:
         for mapname, mapsuffix in [('rvalue', 'fitR'), ('r2value', 'fitR2'), ('meanvalue', 'mean'),
@@ -2531,8 +2738,8 @@ def rapidtide_main():
                 tide_io.writenpvecs(outmaparray.reshape(nativespaceshape),
                                     outputname + '_' + mapsuffix + outsuffix3d + '.txt')
             else:
-                tide_io.savetonifti(outmaparray.reshape(nativespaceshape), theheader,
-                                    outputname + '_' + mapsuffix + outsuffix3d)
+                theoutputwriter.savetonifti(outmaparray.reshape(nativespaceshape), theheader,
+                                            outputname + '_' + mapsuffix + outsuffix3d)
         del rvalue
         del r2value
         del meanvalue
@@ -2550,8 +2757,8 @@ def rapidtide_main():
                 tide_io.writenpvecs(outmaparray.reshape(nativespaceshape),
                                     outputname + '_' + mapsuffix + outsuffix3d + '.txt')
             else:
-                tide_io.savetonifti(outmaparray.reshape(nativespaceshape), theheader,
-                                    outputname + '_' + mapsuffix + outsuffix3d)
+                theoutputwriter.savetonifti(outmaparray.reshape(nativespaceshape), theheader,
+                                            outputname + '_' + mapsuffix + outsuffix3d)
         del meanvalue
 
     if optiondict['numestreps'] > 0:
@@ -2566,8 +2773,8 @@ def rapidtide_main():
                 tide_io.writenpvecs(outmaparray.reshape(nativespaceshape),
                                     outputname + '_p_lt_' + thepvalnames[i] + '_mask' + outsuffix3d + '.txt')
             else:
-                tide_io.savetonifti(outmaparray.reshape(nativespaceshape), theheader,
-                                    outputname + '_p_lt_' + thepvalnames[i] + '_mask' + outsuffix3d)
+                theoutputwriter.savetonifti(outmaparray.reshape(nativespaceshape), theheader,
+                                            outputname + '_p_lt_' + thepvalnames[i] + '_mask' + outsuffix3d)
 
     if optiondict['passes'] > 1:
         outmaparray[:] = 0.0
@@ -2576,8 +2783,8 @@ def rapidtide_main():
             tide_io.writenpvecs(outfmriarray.reshape(nativefmrishape),
                                 outputname + '_lagregressor' + outsuffix4d + '.txt')
         else:
-            tide_io.savetonifti(outmaparray.reshape(nativespaceshape), theheader,
-                                outputname + '_refinemask' + outsuffix3d)
+            theoutputwriter.savetonifti(outmaparray.reshape(nativespaceshape), theheader,
+                                        outputname + '_refinemask' + outsuffix3d)
         del refinemask
 
     # clean up arrays that will no longer be needed
@@ -2602,8 +2809,8 @@ def rapidtide_main():
         tide_io.writenpvecs(outcorrarray.reshape(nativecorrshape),
                             outputname + '_gaussout' + outsuffix4d + '.txt')
     else:
-        tide_io.savetonifti(outcorrarray.reshape(nativecorrshape), theheader,
-                            outputname + '_gaussout' + outsuffix4d)
+        theoutputwriter.savetonifti(outcorrarray.reshape(nativecorrshape), theheader,
+                                    outputname + '_gaussout' + outsuffix4d)
     del gaussout
     outcorrarray[:, :] = 0.0
     outcorrarray[validvoxels, :] = windowout[:, :]
@@ -2611,8 +2818,8 @@ def rapidtide_main():
         tide_io.writenpvecs(outcorrarray.reshape(nativecorrshape),
                             outputname + '_windowout' + outsuffix4d + '.txt')
     else:
-        tide_io.savetonifti(outcorrarray.reshape(nativecorrshape), theheader,
-                            outputname + '_windowout' + outsuffix4d)
+        theoutputwriter.savetonifti(outcorrarray.reshape(nativecorrshape), theheader,
+                                    outputname + '_windowout' + outsuffix4d)
     del windowout
     outcorrarray[:, :] = 0.0
     outcorrarray[validvoxels, :] = corrout[:, :]
@@ -2620,8 +2827,8 @@ def rapidtide_main():
         tide_io.writenpvecs(outcorrarray.reshape(nativecorrshape),
                             outputname + '_corrout' + outsuffix4d + '.txt')
     else:
-        tide_io.savetonifti(outcorrarray.reshape(nativecorrshape), theheader,
-                            outputname + '_corrout' + outsuffix4d)
+        theoutputwriter.savetonifti(outcorrarray.reshape(nativecorrshape), theheader,
+                                    outputname + '_corrout' + outsuffix4d)
     del corrout
 
     if not optiondict['textio']:
@@ -2639,8 +2846,8 @@ def rapidtide_main():
             tide_io.writenpvecs(outfmriarray.reshape(nativefmrishape),
                                 outputname + '_lagregressor' + outsuffix4d + '.txt')
         else:
-            tide_io.savetonifti(outfmriarray.reshape(nativefmrishape), theheader,
-                                outputname + '_lagregressor' + outsuffix4d)
+            theoutputwriter.savetonifti(outfmriarray.reshape(nativefmrishape), theheader,
+                                        outputname + '_lagregressor' + outsuffix4d)
         del lagtc
 
     if optiondict['passes'] > 1:
@@ -2650,10 +2857,20 @@ def rapidtide_main():
                 tide_io.writenpvecs(outfmriarray.reshape(nativefmrishape),
                                     outputname + '_shiftedtcs' + outsuffix4d + '.txt')
             else:
-                tide_io.savetonifti(outfmriarray.reshape(nativefmrishape), theheader,
-                                    outputname + '_shiftedtcs' + outsuffix4d)
+                theoutputwriter.savetonifti(outfmriarray.reshape(nativefmrishape), theheader,
+                                            outputname + '_shiftedtcs' + outsuffix4d)
         del shiftedtcs
 
+    if optiondict['dodeconv']:
+        outfmriarray[validvoxels, :] = wienerdeconv[:, :]
+        if optiondict['textio']:
+            tide_io.writenpvecs(outfmriarray.reshape(nativefmrishape),
+                                outputname + '_wienerdeconv' + outsuffix4d + '.txt')
+        else:
+            theoutputwriter.savetonifti(outfmriarray.reshape(nativefmrishape), theheader,
+                                        outputname + '_wienerdeconv' + outsuffix4d)
+        del wienerdeconv
+
     if optiondict['doglmfilt'] and optiondict['saveglmfiltered']:
         if optiondict['savedatatoremove']:
             outfmriarray[validvoxels, :] = datatoremove[:, :]
@@ -2661,19 +2878,24 @@ def rapidtide_main():
                 tide_io.writenpvecs(outfmriarray.reshape(nativefmrishape),
                                 outputname + '_datatoremove' + outsuffix4d + '.txt')
             else:
-                tide_io.savetonifti(outfmriarray.reshape(nativefmrishape), theheader,
-                                outputname + '_datatoremove' + outsuffix4d)
+                theoutputwriter.savetonifti(outfmriarray.reshape(nativefmrishape), theheader,
+                                        outputname + '_datatoremove' + outsuffix4d)
         del datatoremove
         outfmriarray[validvoxels, :] = filtereddata[:, :]
         if optiondict['textio']:
             tide_io.writenpvecs(outfmriarray.reshape(nativefmrishape),
                                 outputname + '_filtereddata' + outsuffix4d + '.txt')
         else:
-            tide_io.savetonifti(outfmriarray.reshape(nativefmrishape), theheader,
-                                outputname + '_filtereddata' + outsuffix4d)
+            theoutputwriter.savetonifti(outfmriarray.reshape(nativefmrishape), theheader,
+                                        outputname + '_filtereddata' + outsuffix4d)
         del filtereddata
 
-    timings.append(['Finished saving maps', time.time(), None, None])
+    theoutputwriter.close()
+    timings.append(['Finished saving maps', time.time(), tide_io.getniftibyteswritten(), 'bytes'])
+
+    # the run is complete, so the pass checkpoint is no longer needed
+    if os.path.isfile(passcheckpointname):
+        os.remove(passcheckpointname)
     memfile.close()
     print('done')
 
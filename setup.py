@@ -47,6 +47,8 @@ modules_list = ['rapidtide/miscmath',
                 'rapidtide/helper_classes',
                 'rapidtide/glmpass',
                 'rapidtide/dlfilter',
+                'rapidtide/npdlfilter',
+                'rapidtide/dlfilterdata',
                 'rapidtide/wiener',
                 'rapidtide/refine',
                 'rapidtide/workflows/parser_funcs']
@@ -89,6 +91,7 @@ script_list = ['rapidtide/scripts/rapidtide2',
                'rapidtide/scripts/happyx',
                'rapidtide/scripts/happywarp',
                'rapidtide/scripts/applydlfilter',
+               'rapidtide/scripts/exportdlfilter',
                'rapidtide/scripts/threeD',
                'rapidtide/scripts/tcfrom3col',
                'rapidtide/scripts/physiofreq',
@@ -195,8 +198,7 @@ setup(
     # your project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
-    install_requires=["numpy>=1.16; python_version>='3.0'",
-                        "numpy>=1.16,<1.17; python_version<'3.0'",
+    install_requires=['numpy>=1.17',
                         'scipy',
                         'pandas',
                         'scikit-image',